@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+import random
+import re
+import sqlite3
+import time
+
+import to_sql
+
+# Columns returned by search()
+COLUMNS = ['element', 'id', 'street', 'housenumber', 'postcode', 'city',
+           'lat', 'lon']
+
+# Full-text index of the addresses, built from the addr:street,
+# addr:housenumber, addr:postcode and addr:city tags as fix.get_tags()
+# normalized them. remove_diacritics folds "Plaça" to "placa" both in the
+# index and in the queries, so either spelling finds it. The prefix indexes
+# make the queries for the first few letters of a word a single lookup.
+ADDRESS_INDEX = [
+    'DROP TABLE IF EXISTS address;',
+    '''
+    CREATE VIRTUAL TABLE address USING fts5 (
+        street, housenumber, postcode, city,
+        element UNINDEXED, id UNINDEXED, lat UNINDEXED, lon UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3 4'
+        );
+    '''
+]
+
+# One row per element with an address, at the node or the centroid of the
+# way. The rowid is 2 * id for nodes and 2 * id + 1 for ways, so that
+# update_index() can replace the row of an element.
+ADDRESSES = '''
+    INSERT INTO address (rowid, element, id, street, housenumber, postcode,
+                         city, lat, lon)
+    SELECT 2 * t.id + {way}, '{element}', t.id,
+           MAX(CASE WHEN t.key = 'street' THEN t.value END),
+           MAX(CASE WHEN t.key = 'housenumber' THEN t.value END),
+           MAX(CASE WHEN t.key = 'postcode' THEN t.value END),
+           MAX(CASE WHEN t.key = 'city' THEN t.value END),
+           c.{lat}, c.{lon}
+    FROM {element}_tags AS t LEFT JOIN {coords} AS c ON c.id = t.id
+    WHERE t.type = 'addr' AND t.value != ''
+      AND t.key IN ('street', 'housenumber', 'postcode', 'city') {where}
+    GROUP BY t.id;
+    '''
+
+NODE_ADDRESSES = dict(way=0, element='node', coords='node', lat='lat',
+                      lon='lon')
+WAY_ADDRESSES = dict(way=1, element='way', coords='way_geometry',
+                     lat='centroid_lat', lon='centroid_lon')
+
+SEARCH = '''
+    SELECT rowid, {} FROM address WHERE address MATCH ?
+    ORDER BY rank, rowid LIMIT ?;
+    '''.format(', '.join(COLUMNS))
+
+# What search() replaces: a LIKE scan over the street names of the tags,
+# used by benchmark(). Unlike search() it only finds the exact spelling.
+SEARCH_LIKE = '''
+    SELECT 'node', id FROM node_tags
+    WHERE type = 'addr' AND key = 'street' AND value LIKE ?
+    UNION ALL
+    SELECT 'way', id FROM way_tags
+    WHERE type = 'addr' AND key = 'street' AND value LIKE ?;
+    '''
+
+WORD = re.compile(r'[^\W_]+', re.UNICODE)
+
+# Articles that are in most street names ("Carrer de la Marina", "Carrer de
+# l'Hospital"): searching for them matches nearly every address and makes
+# the ranking slow, so they are left out of queries with other words
+STOP_WORDS = frozenset(['d', 'de', 'del', 'dels', 'el', 'els', 'i', 'l', 'la',
+                        'las', 'les', 'los', 'y'])
+
+
+def build_index(conn):
+    cur = conn.cursor()
+    for statement in ADDRESS_INDEX:
+        cur.execute(statement)
+    for params in (NODE_ADDRESSES, WAY_ADDRESSES):
+        cur.execute(ADDRESSES.format(where='', **params))
+    conn.commit()
+
+
+# update_index() replaces the rows of the changed elements, for osc.py.
+# Ways move with their nodes, so changed_ways has to include the ways of the
+# changed nodes, see osc.update_geometry().
+def update_index(conn, changed_nodes, changed_ways):
+    for params, ids in ((NODE_ADDRESSES, changed_nodes),
+                        (WAY_ADDRESSES, changed_ways)):
+        statement = ADDRESSES.format(where='AND t.id = ?', **params)
+        for element_id in ids:
+            conn.execute('DELETE FROM address WHERE rowid = ?;',
+                         (2 * element_id + params['way'],))
+            conn.execute(statement, (element_id,))
+
+
+# search() returns the addresses that match every word of text as a prefix,
+# best match first, as dicts with their coordinates: "pl catalunya 1" finds
+# Plaça de Catalunya 1, 10, 12... in any city. Case and accents are ignored.
+def search(conn, text, limit=10):
+    query = match_query(text)
+    if not query:
+        return []
+    return [dict(zip(COLUMNS, row[1:]))
+            for row in conn.execute(SEARCH, (query, limit))]
+
+
+# match_query() turns free text into an FTS5 query of quoted prefixes, so
+# that punctuation in the text is never read as FTS5 syntax
+def match_query(text):
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    words = WORD.findall(text)
+    words = [word for word in words
+             if word.lower() not in STOP_WORDS] or words
+    return ' '.join(u'"{}"*'.format(word) for word in words)
+
+
+# benchmark() times n searches for random addresses of the index, typed as
+# the first letters of each word, against a LIKE scan of the street names.
+# found is the number of searches that return the address they were made
+# from. The samples are the first addresses with a street from random
+# rowids, wrapping around to the first one, so an index without streets
+# gives no samples.
+def benchmark(conn, n=100, limit=10, seed=0):
+    rnd = random.Random(seed)
+    total, = conn.execute('SELECT MAX(rowid) FROM address;').fetchone()
+    samples = []
+    while total and len(samples) < n:
+        row = sample(conn, rnd.randint(0, total)) or sample(conn, 0)
+        if row is None:
+            break
+        samples.append(row)
+
+    results = {}
+    latencies = []
+    found = 0
+    start = time.time()
+    for rowid, street, housenumber in samples:
+        words = WORD.findall(street.decode('utf-8'))
+        text = ' '.join([word[:4] for word in words] + [housenumber or ''])
+        t = time.time()
+        rows = conn.execute(SEARCH, (match_query(text), limit)).fetchall()
+        latencies.append(time.time() - t)
+        found += any(row[0] == rowid for row in rows)
+    results['fts'] = timings(latencies, time.time() - start, found)
+
+    latencies = []
+    start = time.time()
+    for _, street, _ in samples:
+        t = time.time()
+        conn.execute(SEARCH_LIKE, ('%' + street + '%',) * 2).fetchall()
+        latencies.append(time.time() - t)
+    results['like'] = timings(latencies, time.time() - start)
+
+    for name in ('fts', 'like'):
+        print "%s: %d queries, %.2f ms/query, p95 %.2f ms%s" % (
+            name, results[name]['queries'], results[name]['ms_per_query'],
+            results[name]['p95_ms'], ', found %d' % results[name]['found']
+            if 'found' in results[name] else '')
+    return results
+
+
+def sample(conn, rowid):
+    return conn.execute(
+        'SELECT rowid, street, housenumber FROM address '
+        'WHERE rowid >= ? AND street IS NOT NULL ORDER BY rowid LIMIT 1;',
+        (rowid,)).fetchone()
+
+
+def timings(latencies, elapsed, found=None):
+    latencies = sorted(latencies)
+    result = {'queries': len(latencies), 'seconds': elapsed,
+              'ms_per_query': 1000 * elapsed / max(1, len(latencies)),
+              'p95_ms': 1000 * latencies[int(0.95 * (len(latencies) - 1))]
+              if latencies else 0}
+    if found is not None:
+        result['found'] = found
+    return result
+
+
+if __name__ == "__main__":
+    conn = sqlite3.connect(to_sql.SQLITE_FILE)
+    conn.text_factory = str
+    benchmark(conn)
+    conn.close()
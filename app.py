@@ -1,5 +1,11 @@
 # -*- coding: utf-8 -*-
+import argparse
+
 import audit
+import geocode
+import metrics
+import osmfile
+import shard
 import to_csv
 import to_sql
 import time
@@ -8,12 +14,68 @@ PATH = "data/"
 FILE = "bcn_sample.osm"
 OSM_PATH = "{}/{}".format(PATH, FILE)
 
+# DIRECT_LOAD streams the .osm file straight into the database in one pass;
+# set it to False to go through the intermediate csv files instead
+DIRECT_LOAD = True
+
+# Number of processes used to parse the .osm file, see parallel.py. With
+# "-" as the input, the .osm file is read from stdin and shaped in batches by
+# the workers as it arrives (for instance from curl or bzcat).
+WORKERS = 1
+
+# XML parser backend, 'etree' or 'expat' (see sax.py); both give the same
+# output
+PARSER = 'etree'
+
+# METRICS prints a progress line every few seconds and writes the time spent
+# in each stage to data/metrics.json, see metrics.py
+METRICS = False
+
+# CHECKPOINTS saves the progress of the run every few hundred MB of input, so
+# that an interrupted run can be continued with --resume, see checkpoint.py
+CHECKPOINTS = True
+
+# SHARDS also splits the database in one file per tile of a grid over the
+# city once it is loaded, for parallel regional queries, see shard.py
+SHARDS = False
+
+# GEOCODER builds the nearest street index of geocode.py once the database
+# is loaded
+GEOCODER = False
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load an .osm file into "
+                                     "the database")
+    parser.add_argument('osm_file', nargs='?', default=OSM_PATH,
+                        help="the .osm file, or - for stdin (default: "
+                             "{})".format(OSM_PATH))
+    parser.add_argument('--resume', action='store_true',
+                        help="continue an interrupted run from its last "
+                             "checkpoint")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
+    args = parse_args()
+    # Streams cannot be read again from a checkpoint
+    checkpoints = CHECKPOINTS and not osmfile.is_stream(args.osm_file)
     with open("{}/{}".format(PATH, FILE), "r") as f:
         # audit.quick_print(f)
-        # audit.audit_nodes(f)
-        # audit.audit_ways(f)
+        # audit.audit(f)
         pass
-    to_csv.process_map(OSM_PATH, validate=False)
-    time.sleep(5)
-    to_sql.main()
+    with metrics.instrument(args.osm_file, METRICS):
+        if DIRECT_LOAD:
+            to_sql.load_map(args.osm_file, validate=False, csv_out=False,
+                            workers=WORKERS, parser=PARSER,
+                            checkpoints=checkpoints, resume=args.resume)
+        else:
+            to_csv.process_map(args.osm_file, validate=False, workers=WORKERS,
+                               parser=PARSER, checkpoints=checkpoints,
+                               resume=args.resume)
+            time.sleep(5)
+            to_sql.main(checkpoints=CHECKPOINTS, resume=args.resume)
+    if SHARDS:
+        shard.build()
+    if GEOCODER:
+        geocode.build()
@@ -5,6 +5,10 @@ import pprint
 import re
 import xml.etree.cElementTree as ET
 
+import idset
+import osmfile
+import sax
+
 # Values that can be cast integers
 ATTR_INT = ['id', 'uid', 'version', 'changeset']
 
@@ -17,7 +21,7 @@ problemchars = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
 # Used by load_nodes_data() and load_tag_map() for manual testing and
 # correction purposes
-ID = set()
+ID = idset.IdSet()
 UID = set()
 CHANGESET = set()
 VERSION = set()
@@ -28,151 +32,152 @@ KS = dict()
 VS = dict()
 
 
-def audit_nodes(f):
+# audit() is the single pass audit driver: it parses the file once, runs the
+# checks registered in CHECKS for every element whose tag is in tags and
+# clears the tree as it goes, so memory stays flat regardless of file size.
+# The checks raise ValueError on the first invalid element.
+# f can be a .bz2 or .gz file, see osmfile.open_osm(). parser='expat' reads
+# it without ElementTree, see iter_elements().
+def audit(f, tags=('node', 'way'), workers=1, parser='etree'):
+    reports = dict((tag, new_report()) for tag in tags)
+
+    for element in iter_elements(f, tags, workers, parser):
+        report = reports[element.tag]
+        report["total"] += 1
+        for check in CHECKS[element.tag]:
+            check(element, report)
+
+    for tag in tags:
+        print_report(tag, reports[tag])
+    return reports
+
+
+# iter_elements() yields the top level elements in tags, from ElementTree
+# (parser='etree') or as sax.Element objects, without building a tree
+# (parser='expat')
+def iter_elements(f, tags, workers=1, parser='etree'):
+    if parser == 'expat':
+        for element in sax.iter_elements(f, tags, workers):
+            yield element
+        return
+
+    with osmfile.open_osm(f, workers) as source:
+        context = ET.iterparse(source, events=('start', 'end'))
+        _, root = next(context)
+        for event, element in context:
+            if event == 'end' and element.tag in tags:
+                yield element
+                root.clear()
 
-    # Used at the end of audit_nodes() to evaluate if the arrtib id is unique
-    n_id = set()
-    total_nodes = 0
 
-    n_street_types = defaultdict(int)
-    n_key_types = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
+def audit_nodes(f):
+    return audit(f, tags=('node',))
 
-    for _, element in ET.iterparse(f):
 
-        if element.tag == "node":
-            total_nodes += 1
-            # Store node_id for further reference in Error messages
-            node_id = element.attrib["id"]
-            n_id.add(node_id)
-
-            # Loop through the fields expected to be int within a certain
-            # range (id, uid, version, changeset) to detect possible problems
-            for att in ATTR_INT:
-                v = element.attrib[att]
-
-                # isInt() checks if a number can be casted to integer
-                if not isInt(v):
-                    raise ValueError("Invalid attrib.{} in node {}".format(att, node_id))
-
-                # inRange() checks if a number sits between a predefined range
-                if not inRange(v, att):
-                    raise ValueError("Detected out of range value for attrib.{} in node {}".format(att, node_id))
-
-            # Assignment of Latitude and Longitude
-            lat = element.attrib["lat"]
-            lon = element.attrib["lon"]
-
-            # isFloat() checks if a number can be casted to float
-            if not isFloat(lat):
-                raise ValueError("Invalid attrib.lat in node {}".format(node_id))
-            if not isFloat(lon):
-                raise ValueError("Invalid attrib.lon in node {}".format(node_id))
-
-            # inBCN() checks if a pair of coordinates match the city location
-            if not inBCN(lat, lon):
-                raise ValueError("Invalid set of coordinates in node {}".format(node_id))
-
-            # Assignment of Timestamp
-            tstamp = element.attrib["timestamp"]
-
-            # properDate() checks through a RegEx if a given timestamp follows
-            # the correct format
-            if not properDate(tstamp):
-                raise ValueError("Invalid timestamp format in node {}".format(node_id))
-
-            # For each node, loop through all its tags
-            for tag in element.iter("tag"):
+def audit_ways(f):
+    return audit(f, tags=('way',))
 
-                # tag_has_two() checks if a tag element has 2 attributes (k, v)
-                if not tag_has_two(tag):
-                    raise ValueError("Tag in node {} had too many attributes".format(node_id))
 
-                # is_street_name() checks if the attribute k = addr:street
-                if is_street_name(tag):
-                    street_name = tag.attrib["v"]
-                    audit_street_type(n_street_types, street_name)
+def new_report():
+    return {"total": 0,
+            # Used at the end of audit() to evaluate if the attrib id is unique
+            "ids": idset.IdSet(),
+            "street_types": defaultdict(int),
+            "key_types": {"lower": 0, "lower_colon": 0, "problemchars": 0,
+                          "other": 0}
+            }
 
-                # audit_key_type() looks for format problems in the keys
-                audit_key_type(tag, n_key_types)
 
+def print_report(tag, report):
     # Checks if all the parsed ids are unique
-    if not len(n_id) == total_nodes:
+    if report["ids"].duplicates:
         raise ValueError("Found attribte id not unique")
 
+    # Files written by osmosis and the planet dumps are sorted by id
+    if report["ids"].out_of_order:
+        print "\n{}S: {} ids out of order".format(tag.upper(), report["ids"].out_of_order)
+
     # ***** LOGS *****
     # ================
 
-    # Prints a list of all the keys found in tags
-    # print "\nALL KEYS", "\n", "="*8
-    # pprint.pprint(all_keys)
-    # Prints a list of all the values found in tags
-    # print "\nALL VALUES", "\n", "="*10
-    # pprint.pprint(all_values)
     # Prints a list of all the street types found in the data set
-    print "\nNODES: STREET TYPES", "\n", "="*19
-    print_sorted_dict(n_street_types)
+    title = "\n{}S: STREET TYPES".format(tag.upper())
+    print title, "\n", "="*(len(title) - 1)
+    print_sorted_dict(report["street_types"])
     # Prints a list of the key types based on audit_key_type()
-    print "\nNODES: KEY TYPES", "\n", "="*16
-    print_sorted_dict(n_key_types)
-    return
+    title = "\n{}S: KEY TYPES".format(tag.upper())
+    print title, "\n", "="*(len(title) - 1)
+    print_sorted_dict(report["key_types"])
 
 
-# Since audit_ways() shares most of its functions with audit_nodes(), code in
-# this function is not commented, for further reference check audit_nodes()
-def audit_ways(f):
+# ***** CHECKS *****
+# ==================
 
-    w_id = set()
-    total_ways = 0
+# Every check takes the element and the report of its element type
 
-    w_street_types = defaultdict(int)
-    w_key_types = {"lower": 0, "lower_colon": 0, "problemchars": 0, "other": 0}
+def check_id(element, report):
+    # Store the id for the uniqueness and order checks in print_report()
+    report["ids"].add(element.attrib["id"])
 
-    for _, element in ET.iterparse(f):
 
-        if element.tag == "way":
-            total_ways += 1
+def check_int_attribs(element, report):
+    # Loop through the fields expected to be int within a certain
+    # range (id, uid, version, changeset) to detect possible problems
+    for att in ATTR_INT:
+        v = element.attrib[att]
 
-            way_id = element.attrib["id"]
-            w_id.add(way_id)
+        # isInt() checks if a number can be casted to integer
+        if not isInt(v):
+            raise ValueError("Invalid attrib.{} in {} {}".format(att, element.tag, element.attrib["id"]))
 
-            for att in ATTR_INT:
-                v = element.attrib[att]
+        # inRange() checks if a number sits between a predefined range
+        if not inRange(v, att):
+            raise ValueError("Detected out of range value for attrib.{} in {} {}".format(att, element.tag, element.attrib["id"]))
 
-                if not isInt(v):
-                    raise ValueError("Invalid attrib.{} in way {}".format(att, way_id))
 
-                if not inRange(v, att):
-                    raise ValueError("Detected out of range value for attrib.{} in way {}".format(att, way_id))
+def check_coordinates(element, report):
+    lat = element.attrib["lat"]
+    lon = element.attrib["lon"]
 
-            tstamp = element.attrib["timestamp"]
+    # isFloat() checks if a number can be casted to float
+    if not isFloat(lat):
+        raise ValueError("Invalid attrib.lat in {} {}".format(element.tag, element.attrib["id"]))
+    if not isFloat(lon):
+        raise ValueError("Invalid attrib.lon in {} {}".format(element.tag, element.attrib["id"]))
 
-            if not properDate(tstamp):
-                raise ValueError("Invalid timestamp format in way {}".format(way_id))
+    # inBCN() checks if a pair of coordinates match the city location
+    if not inBCN(lat, lon):
+        raise ValueError("Invalid set of coordinates in {} {}".format(element.tag, element.attrib["id"]))
 
-            for tag in element.iter("tag"):
 
-                if not tag_has_two(tag):
-                    raise ValueError("Tag in way {} had too many attributes".format(way_id))
+def check_timestamp(element, report):
+    # properDate() checks through a RegEx if a given timestamp follows
+    # the correct format
+    if not properDate(element.attrib["timestamp"]):
+        raise ValueError("Invalid timestamp format in {} {}".format(element.tag, element.attrib["id"]))
 
-                if is_street_name(tag):
-                    street_name = tag.attrib["v"]
-                    audit_street_type(w_street_types, street_name)
 
-                audit_key_type(tag, w_key_types)
+def check_tags(element, report):
+    for tag in element.iter("tag"):
 
-    if not len(w_id) == total_ways:
-        raise ValueError("Found attribte id not unique")
+        # tag_has_two() checks if a tag element has 2 attributes (k, v)
+        if not tag_has_two(tag):
+            raise ValueError("Tag in {} {} had too many attributes".format(element.tag, element.attrib["id"]))
 
-    # ***** LOGS *****
-    # ================
+        # is_street_name() checks if the attribute k = addr:street
+        if is_street_name(tag):
+            audit_street_type(report["street_types"], tag.attrib["v"])
 
-    # Prints a list of all the street types found in the data set
-    print "\nWAYS: STREET TYPES", "\n", "="*18
-    print_sorted_dict(w_street_types)
-    # Prints a list of the key types based on audit_key_type()
-    print "\nWAYS: KEY TYPES", "\n", "="*15
-    print_sorted_dict(w_key_types)
-    return
+        # audit_key_type() looks for format problems in the keys
+        audit_key_type(tag, report["key_types"])
+
+
+# Registry of the checks run by audit() for each element type
+CHECKS = {
+    "node": [check_int_attribs, check_id, check_coordinates, check_timestamp,
+             check_tags],
+    "way": [check_int_attribs, check_id, check_timestamp, check_tags]
+}
 
 
 # ***** SUPPORT FUNCTIONS *****
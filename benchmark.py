@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import fix
+import synthetic
+import to_csv
+import to_sql
+
+BENCHMARK_FILE = "data/benchmark.osm"
+
+# Nodes of the synthetic file generated when no input is given (~25 MB)
+BENCHMARK_NODES = 100000
+
+STAGES = ['get_element', 'shape_element', 'get_tags', 'validate_element',
+          'UnicodeWriter', 'to_sql.main']
+
+
+# benchmark() times each stage of the pipeline on its own, in a fresh child
+# process so that its peak RSS is not mixed with the other stages. The input
+# of a stage (parsed or shaped elements, csv files) is prepared in the child
+# before the timer starts; peak_rss_mb includes it, setup_rss_mb is the peak
+# before the timed part. Every rate is relative to the .osm file, so the
+# stages can be compared: elements/s over its nodes, ways and relations (the
+# in-memory stages only go through nodes and ways) and MB/s over its size.
+# Returns a dict that can be dumped as JSON and compared across commits.
+def benchmark(osm_file, stages=STAGES):
+    results = {
+        'file': osm_file,
+        'size': os.path.getsize(osm_file),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'stages': []
+    }
+    for stage in stages:
+        result = run_child(stage, osm_file)
+        result['mb_per_s'] = results['size'] / 1e6 / result['seconds'] \
+            if result.get('seconds') else None
+        results['stages'].append(result)
+    return results
+
+
+def run_child(stage, osm_file):
+    parent, child = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=measure,
+                                      args=(stage, osm_file, child))
+    process.start()
+    child.close()
+    try:
+        result = parent.recv()
+    except EOFError:
+        result = {'stage': stage, 'error': 'exit code %s' % process.exitcode}
+    process.join()
+    return result
+
+
+def measure(stage, osm_file, conn):
+    # The loaders print progress, keep stdout for the results
+    sys.stdout = open(os.devnull, 'w')
+    tmp = tempfile.mkdtemp()
+    try:
+        run = prepare(stage, osm_file, tmp)
+        setup_rss = peak_rss()
+        start = time.time()
+        elements, extra = run()
+        seconds = time.time() - start
+        result = {
+            'stage': stage,
+            'elements': elements,
+            'seconds': round(seconds, 4),
+            'elements_per_s': round(elements / seconds) if seconds else None,
+            'setup_rss_mb': setup_rss,
+            'peak_rss_mb': peak_rss()
+        }
+        result.update(extra)
+    except Exception:
+        result = {'stage': stage, 'error': traceback.format_exc()}
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    conn.send(result)
+    conn.close()
+
+
+# prepare() builds the input of a stage and returns the function to time,
+# which returns the number of elements handled and any extra counts
+def prepare(stage, osm_file, tmp):
+    if stage == 'get_element':
+        return lambda: parse(osm_file)
+
+    elements = read_elements(osm_file)
+    if stage == 'shape_element':
+        return lambda: shape(elements)
+    if stage == 'get_tags':
+        return lambda: get_tags(elements)
+
+    shaped = [to_csv.shape_element(element) for element in elements]
+    if stage == 'validate_element':
+        return lambda: validate(shaped)
+    if stage == 'UnicodeWriter':
+        return lambda: write_csv(shaped, tmp)
+    if stage == 'to_sql.main':
+        write_csv(shaped, tmp)
+        return lambda: load_sql(tmp, len(shaped))
+    raise ValueError("unknown stage: %s" % stage)
+
+
+def parse(osm_file):
+    n = 0
+    for element in to_csv.get_element(osm_file):
+        if element.tag == 'relation':
+            for _ in element.iter():
+                pass
+        n += 1
+    return n, {}
+
+
+# read_elements() keeps the parsed nodes and ways in memory; get_element()
+# clears them from the root but they keep their own children
+def read_elements(osm_file):
+    return list(to_csv.get_element(osm_file, tags=('node', 'way')))
+
+
+def shape(elements):
+    for element in elements:
+        to_csv.shape_element(element)
+    return len(elements), {}
+
+
+def get_tags(elements):
+    tags = 0
+    for element in elements:
+        tags += len(fix.get_tags(element, element.attrib['id'],
+                                 to_csv.PROBLEMCHARS, 'regular'))
+    return len(elements), {'tags': tags}
+
+
+# Invalid elements are counted instead of stopping the run, like with a
+# quarantine (the default synthetic file has invalid postcodes)
+def validate(shaped):
+    invalid = 0
+    for el in shaped:
+        try:
+            to_csv.validate_element(el)
+        except Exception:
+            invalid += 1
+    return len(shaped), {'invalid': invalid}
+
+
+def write_csv(shaped, tmp):
+    with to_csv.open_writers(csv_paths(tmp)) as writers:
+        for el in shaped:
+            to_csv.write_element(writers, el)
+    rows = sum(len(el[table]) if isinstance(el[table], list) else 1
+               for el in shaped for table in el)
+    return len(shaped), {'rows': rows}
+
+
+# load_sql() runs to_sql.main() on the csv files of tmp; this is a child
+# process, so its module paths can be pointed there
+def load_sql(tmp, elements):
+    to_sql.CSV_PATHS = csv_paths(tmp)
+    to_sql.SQLITE_FILE = os.path.join(tmp, 'benchmark.db')
+    to_sql.main()
+    return elements, {}
+
+
+def csv_paths(tmp, paths=to_csv.CSV_PATHS):
+    return dict((table, os.path.join(tmp, os.path.basename(path)))
+                for table, path in paths.iteritems())
+
+
+# peak_rss() is the peak resident set size of this process in MB
+# (ru_maxrss is in kilobytes on Linux, bytes on macOS)
+def peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss /= 1024
+    return round(rss / 1024.0, 1)
+
+
+def git_commit():
+    try:
+        with open(os.devnull, 'w') as null:
+            return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'], stderr=null,
+                cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Time each stage of the pipeline and print the results "
+                    "as JSON")
+    parser.add_argument('osm_file', nargs='?',
+                        help="input file, a synthetic one is generated in "
+                             "%s if left out" % BENCHMARK_FILE)
+    parser.add_argument('--nodes', type=int, default=BENCHMARK_NODES,
+                        help="nodes of the synthetic file")
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help="comma separated, default all: %(default)s")
+    parser.add_argument('--out', help="also write the results to this file")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    osm_file = args.osm_file
+    if osm_file is None:
+        osm_file = BENCHMARK_FILE
+        # Keep stdout for the JSON
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        synthetic.generate(osm_file, nodes=args.nodes)
+        sys.stdout = stdout
+
+    results = benchmark(osm_file, args.stages.split(','))
+    output = json.dumps(results, indent=2, sort_keys=True)
+    print output
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(output + '\n')
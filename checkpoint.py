@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+import itertools
+import json
+import os
+
+import geometry
+import osmfile
+import parallel
+import to_csv
+
+CHECKPOINT_PATH = "data/checkpoint.json"
+
+# Input bytes between two checkpoints. Plain .osm files are read one range
+# of this size at a time (see parallel.find_chunks()); the parallel runs
+# save one after each of their chunks instead.
+CHECKPOINT_SIZE = 256 * 1024 * 1024
+
+# Elements between two checkpoints of a .bz2, .gz or .osm.pbf file. These
+# cannot be read from an offset, so a resumed run parses them again from the
+# start, skipping the elements before the checkpoint.
+CHECKPOINT_ELEMENTS = 1000000
+
+# Runs that fill the database keep their checkpoint in it, so that it is
+# committed with the rows. The table is dropped once the load is complete.
+CHECKPOINT_TABLE = '''
+    CREATE TABLE IF NOT EXISTS checkpoint (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        state TEXT
+        );
+        '''
+
+
+class Checkpoint(object):
+    """Progress of a run, saved as it goes so that it can be resumed.
+
+    The state is a dict saved as JSON to path, or to the checkpoint table of
+    conn for the runs that fill the database. Besides the position in the
+    input (see shaped()), it holds the size of every output file, so that
+    whatever was written after the checkpoint is cut off when resuming, the
+    state of the node index and the quarantine count.
+
+    With resume=True the state of the interrupted run is read and its
+    outputs truncated; state is None when there was none, complete is True
+    when the run had finished. With enabled=False nothing is saved and
+    shaped() is to_csv.iter_shaped().
+    """
+
+    def __init__(self, file_in=None, enabled=True, resume=False, conn=None,
+                 path=CHECKPOINT_PATH):
+        if (enabled or resume) and file_in is not None and \
+                osmfile.is_stream(file_in):
+            raise ValueError("Checkpoints need the path of the input file, "
+                             "a stream cannot be resumed")
+
+        self.file_in = file_in
+        self.enabled = enabled or resume
+        self.conn = conn
+        self.path = path
+        self.state = None
+        self.complete = False
+        self.tracked = {}
+
+        if resume:
+            self.state, self.complete = self.load()
+        if self.complete:
+            return
+        if conn is not None:
+            conn.execute(CHECKPOINT_TABLE)
+            conn.commit()
+        if self.state is None:
+            self.clear()
+        else:
+            self.restore()
+        self.saves = self.get('saves', 0)
+
+    @property
+    def resumed(self):
+        return self.state is not None
+
+    def get(self, key, default=None):
+        return self.state.get(key, default) if self.state else default
+
+    def load(self):
+        """(state, complete) of the run to resume"""
+        if self.conn is not None:
+            tables = set(name for name, in self.conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table';"))
+            if 'checkpoint' not in tables:
+                return None, 'node' in tables
+            row = self.conn.execute('SELECT state FROM checkpoint;').fetchone()
+            state = json.loads(row[0]) if row else None
+        elif os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                state = json.load(f)
+            if state.get('done'):
+                return None, True
+        else:
+            state = None
+
+        if state is not None and state['input'] != identity(self.file_in):
+            raise ValueError("The checkpoint of {} is for another input, {}"
+                             .format(self.conn and 'the database' or self.path,
+                                     json.dumps(state['input'])))
+        return state, False
+
+    def restore(self):
+        for path, size in self.state.get('outputs', {}).iteritems():
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+        print "resuming from checkpoint %d: %s" % (
+            self.state['saves'], json.dumps(self.get('position') or {
+                'table': self.get('table'), 'rows': self.get('rows')}))
+
+    # track() gives the objects whose state is saved with every checkpoint:
+    # the csv writers and the quarantine (the size of their files), the
+    # geometry.NodeIndex and a dict of counts. flush is called first, to
+    # write what the run buffers.
+    def track(self, writers=None, quarantine=None, index=None, counts=None,
+              flush=None):
+        self.tracked = {'writers': writers, 'quarantine': quarantine,
+                        'index': index, 'counts': counts, 'flush': flush}
+
+    def node_index(self):
+        if not self.get('index'):
+            return geometry.NodeIndex()
+        return geometry.NodeIndex.resume(self.state['index'])
+
+    def quarantined(self):
+        return self.get('quarantined')
+
+    # save() stores the position and the tracked objects, with any other
+    # values given. In the database it is committed with the rows inserted
+    # so far.
+    def save(self, position=None, **values):
+        if not self.enabled:
+            return
+
+        tracked = self.tracked
+        if tracked.get('flush') is not None:
+            tracked['flush']()
+
+        self.saves += 1
+        state = dict(values, input=identity(self.file_in), saves=self.saves,
+                     position=position, outputs=self.outputs())
+        if tracked.get('quarantine') is not None:
+            state['quarantined'] = tracked['quarantine'].count
+        if tracked.get('index') is not None:
+            state['index'] = tracked['index'].state()
+        if tracked.get('counts') is not None:
+            state['counts'] = tracked['counts']
+
+        data = json.dumps(state)
+        if self.conn is not None:
+            self.conn.execute('INSERT OR REPLACE INTO checkpoint (id, state) '
+                              'VALUES (0, ?);', (data,))
+            self.conn.commit()
+        else:
+            with open(self.path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.rename(self.path + '.tmp', self.path)
+
+    def outputs(self):
+        files = [writer.stream for writer in
+                 (self.tracked.get('writers') or {}).values()]
+        quarantine = self.tracked.get('quarantine')
+        if quarantine is not None:
+            quarantine.flush()
+            files.append(quarantine.f)
+
+        sizes = {}
+        for f in files:
+            f.flush()
+            sizes[f.name] = os.fstat(f.fileno()).st_size
+        return sizes
+
+    # finish() marks the run as complete: a later resume has nothing to do,
+    # and the node index is not needed any more
+    def finish(self):
+        if self.tracked.get('index') is not None:
+            self.tracked['index'].remove()
+        if self.conn is not None:
+            self.conn.execute('DROP TABLE IF EXISTS checkpoint;')
+            self.conn.commit()
+        elif self.enabled:
+            with open(self.path, 'wb') as f:
+                json.dump({'done': True}, f)
+
+    def clear(self):
+        if self.conn is not None:
+            self.conn.execute('DELETE FROM checkpoint;')
+            self.conn.commit()
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+    # shaped() yields the shaped elements of the input from the position of
+    # the checkpoint, saving a new one every CHECKPOINT_SIZE bytes or
+    # CHECKPOINT_ELEMENTS elements. A checkpoint is saved when the next
+    # element is asked for, once the previous one has been written.
+    def shaped(self, workers=1, parser='etree'):
+        if not self.enabled:
+            return to_csv.iter_shaped(self.file_in, workers, parser)
+        if osmfile.is_splittable(self.file_in):
+            return self.shaped_ranges(parser)
+        return self.shaped_elements(workers, parser)
+
+    # Plain .osm files are read in ranges starting at an element, the
+    # position is the offset of the next range
+    def shaped_ranges(self, parser):
+        position = self.get('position') or {'offset': 0, 'last': None}
+        last = position['last']
+        for start, end in parallel.find_chunks(
+                self.file_in, 1, position['offset'], CHECKPOINT_SIZE):
+            chunk = parallel.RangeFile(self.file_in, start, end)
+            for el in to_csv.iter_shaped(chunk, parser=parser):
+                yield el
+                last = element_key(el)
+            self.save({'offset': end, 'last': last})
+
+    # The other files are read from the start, the position is the number of
+    # elements read. The last one is checked, in case the file changed.
+    def shaped_elements(self, workers, parser):
+        position = self.get('position') or {'elements': 0, 'last': None}
+        elements = to_csv.iter_shaped(self.file_in, workers, parser)
+
+        last = None
+        for el in itertools.islice(elements, position['elements']):
+            last = element_key(el)
+        if last != position['last']:
+            raise ValueError("Element {} of {} is {}, the checkpoint expected "
+                             "{}".format(position['elements'], self.file_in,
+                                         last, position['last']))
+
+        count = position['elements']
+        for el in elements:
+            yield el
+            count += 1
+            last = element_key(el)
+            if count % CHECKPOINT_ELEMENTS == 0:
+                self.save({'elements': count, 'last': last})
+
+
+# identity() tells the input of a checkpoint apart from a changed or
+# different file, in the form it is read back from JSON
+def identity(file_in):
+    if file_in is None:
+        return None
+    st = os.stat(file_in)
+    return json.loads(json.dumps({'path': os.path.abspath(file_in),
+                                  'size': st.st_size,
+                                  'mtime': int(st.st_mtime)}))
+
+
+def element_key(el):
+    for tag in to_csv.ELEMENTS:
+        if tag in el:
+            return [tag, str(el[tag].id)]
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import calendar
+import os
+import struct
+
+import numpy
+
+import geometry
+import to_csv
+
+COLUMNS_PATH = "data/columns"
+
+# Number of values buffered per column before they are appended to its file
+BUFFER_SIZE = 100000
+
+# Size of the .npy header, padded so that the final length always fits in it
+# and the data stays 64 byte aligned
+HEADER_SIZE = 128
+
+# Columns written for each element, as (name, dtype). lat and lon are fixed
+# point like in geometry.NodeIndex: divide them by geometry.SCALE to get
+# degrees. timestamp is in seconds since the epoch, uid is -1 for anonymous
+# edits.
+NODE_COLUMNS = [('id', '<i8'),
+                ('lat', '<i4'),
+                ('lon', '<i4'),
+                ('uid', '<i8'),
+                ('changeset', '<i8'),
+                ('version', '<i4'),
+                ('timestamp', '<i8')]
+
+# The node refs of way i are way_node_refs[way_node_offsets[i]:
+# way_node_offsets[i + 1]] (CSR layout), see way_refs()
+WAY_COLUMNS = [('id', '<i8'),
+               ('uid', '<i8'),
+               ('changeset', '<i8'),
+               ('version', '<i4'),
+               ('timestamp', '<i8'),
+               ('node_offsets', '<i8'),
+               ('node_refs', '<i8')]
+
+
+# process_map() is the columnar counterpart of to_csv.process_map(): it
+# writes the numeric attributes of nodes and ways as typed .npy columns in
+# path, one file per column (node_id.npy, node_lat.npy, ..., way_id.npy,
+# way_node_refs.npy), that load_columns() maps in memory without reading
+# them. Tags and user names stay in the csv files and the database.
+def process_map(file_in, path=COLUMNS_PATH, workers=1):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    writers = {}
+    for tag, columns in (('node', NODE_COLUMNS), ('way', WAY_COLUMNS)):
+        for name, dtype in columns:
+            writers[tag + '_' + name] = NpyWriter(
+                os.path.join(path, '{}_{}.npy'.format(tag, name)), dtype)
+
+    try:
+        offset = 0
+        writers['way_node_offsets'].append(offset)
+        for element in to_csv.get_element(file_in, tags=('node', 'way'),
+                                          workers=workers):
+            tag = element.tag
+            attrib = element.attrib
+            writers[tag + '_id'].append(int(attrib['id']))
+            writers[tag + '_uid'].append(int(attrib.get('uid', -1)))
+            writers[tag + '_changeset'].append(int(attrib['changeset']))
+            writers[tag + '_version'].append(int(attrib['version']))
+            writers[tag + '_timestamp'].append(epoch(attrib['timestamp']))
+
+            if tag == 'node':
+                writers['node_lat'].append(
+                    int(round(float(attrib['lat']) * geometry.SCALE)))
+                writers['node_lon'].append(
+                    int(round(float(attrib['lon']) * geometry.SCALE)))
+            else:
+                refs = [int(nd.attrib['ref']) for nd in element.iter('nd')]
+                writers['way_node_refs'].extend(refs)
+                offset += len(refs)
+                writers['way_node_offsets'].append(offset)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    print "nodes: %d, ways: %d, way node refs: %d" % (
+        writers['node_id'].count, writers['way_id'].count,
+        writers['way_node_refs'].count)
+
+
+# load_columns() opens the columns written by process_map() as read-only
+# memory-mapped arrays, keyed by file name without the extension
+def load_columns(path=COLUMNS_PATH):
+    return dict((name[:-len('.npy')],
+                 numpy.load(os.path.join(path, name), mmap_mode='r'))
+                for name in os.listdir(path) if name.endswith('.npy'))
+
+
+def way_refs(columns, i):
+    offsets = columns['way_node_offsets']
+    return columns['way_node_refs'][offsets[i]:offsets[i + 1]]
+
+
+# epoch() converts an OSM timestamp (2016-05-12T10:11:12Z) to seconds since
+# the epoch, without going through time.strptime()
+def epoch(timestamp):
+    return calendar.timegm((int(timestamp[0:4]), int(timestamp[5:7]),
+                            int(timestamp[8:10]), int(timestamp[11:13]),
+                            int(timestamp[14:16]), int(timestamp[17:19])))
+
+
+class NpyWriter(object):
+    """Appends values to a one dimensional .npy file.
+
+    The header is written first with a length of 0 and rewritten by close()
+    with the final length, so the values can be streamed to the file without
+    knowing how many there are.
+    """
+
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = numpy.dtype(dtype)
+        self.f = open(path, 'wb')
+        self.f.write(npy_header(self.dtype, 0))
+        self.buffer = []
+        self.count = 0
+
+    def append(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= BUFFER_SIZE:
+            self.flush()
+
+    def extend(self, values):
+        self.buffer.extend(values)
+        if len(self.buffer) >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            numpy.array(self.buffer, dtype=self.dtype).tofile(self.f)
+            self.count += len(self.buffer)
+            del self.buffer[:]
+
+    def close(self):
+        self.flush()
+        self.f.seek(0)
+        self.f.write(npy_header(self.dtype, self.count))
+        self.f.close()
+
+
+# npy_header() is a version 1.0 .npy header padded to HEADER_SIZE bytes
+def npy_header(dtype, length):
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%d,), }" % (
+        dtype.str, length)
+    header = header.ljust(HEADER_SIZE - 10 - 1) + '\n'
+    return numpy.lib.format.magic(1, 0) + struct.pack('<H', len(header)) + \
+        header
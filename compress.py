@@ -1,27 +0,0 @@
-# -*- coding: utf-8 -*-
-import xml.etree.ElementTree as ET
-
-OSM_FILE = "../../_data/bcn.osm"
-SAMPLE_FILE = "bcn_sample.osm"
-
-k = 25
-
-
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    context = iter(ET.iterparse(osm_file, events=('start', 'end')))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
-            yield elem
-            root.clear()
-
-
-with open(SAMPLE_FILE, 'wb') as output:
-    output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    output.write('<osm>\n  ')
-
-    for i, element in enumerate(get_element(OSM_FILE)):
-        if i % k == 0:
-            output.write(ET.tostring(element, encoding='utf-8'))
-
-    output.write('</osm>')
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import argparse
+import bz2
+import gzip
+import os
+import xml.etree.cElementTree as ET
+
+import idset
+import osmfile
+import pbf
+
+OSM_FILE = "../../_data/bcn.osm"
+SAMPLE_FILE = "data/bcn_sample.osm"
+
+ELEMENTS = ('node', 'way', 'relation')
+
+# Rough size of the .osm XML relative to each compressed format, used to
+# pick k when extracting to a target size
+COMPRESSION_RATIOS = {'.bz2': 14, '.gz': 9, '.pbf': 20}
+
+
+class Selection(object):
+    """Ids of the nodes, ways and relations that go in the extract"""
+
+    def __init__(self):
+        self.ids = dict((tag, idset.IdSet()) for tag in ELEMENTS)
+
+    def add(self, tag, element_id):
+        self.ids[tag].add(element_id)
+
+    def __contains__(self, element):
+        return element.attrib['id'] in self.ids[element.tag]
+
+    def add_way(self, way):
+        self.add('way', way.attrib['id'])
+        for nd in way.iter('nd'):
+            self.add('node', nd.attrib['ref'])
+
+    def has_member(self, member):
+        return member.attrib['ref'] in self.ids[member.attrib['type']]
+
+    # Relations are kept when one of their members is, see write_extract()
+    def add_relation(self, relation):
+        if any(self.has_member(m) for m in relation.iter('member')):
+            self.add('relation', relation.attrib['id'])
+
+
+# extract() writes a self-contained sample of osm_file to out: the ways are
+# selected by bounding box, every k-th, or every k-th with k picked to get
+# close to target_size bytes. Every node a selected way references is
+# included, so no way points to a missing node. The input is read twice,
+# once to select the ids (kept in compact idset.IdSet bitmaps) and once to
+# write the elements, so memory does not grow with the size of the file.
+def extract(osm_file, out, bbox=None, k=None, target_size=None):
+    if target_size is not None:
+        k = max(1, int(round(estimate_size(osm_file) / float(target_size))))
+        print "extracting every %d-th way" % k
+
+    if bbox is not None:
+        selection = select_bbox(osm_file, bbox)
+    else:
+        selection = select_every(osm_file, k or 1)
+
+    write_extract(osm_file, out, selection, bbox)
+
+    counts = ', '.join('%s: %d' % (tag, len(selection.ids[tag]))
+                       for tag in ELEMENTS)
+    print "%s (%.1f MB) %s" % (out, os.path.getsize(out) / 1e6, counts)
+    return selection
+
+
+# select_bbox() selects the nodes inside the bounding box, the ways with at
+# least one of those nodes (and all of their nodes) and their relations
+def select_bbox(osm_file, bbox):
+    min_lat, min_lon, max_lat, max_lon = bbox
+    selection = Selection()
+    inside = idset.IdSet()
+
+    for element in iter_elements(osm_file):
+        if element.tag == 'node':
+            if min_lat <= float(element.attrib['lat']) <= max_lat and \
+                    min_lon <= float(element.attrib['lon']) <= max_lon:
+                inside.add(element.attrib['id'])
+                selection.add('node', element.attrib['id'])
+        elif element.tag == 'way':
+            if any(nd.attrib['ref'] in inside for nd in element.iter('nd')):
+                selection.add_way(element)
+        else:
+            selection.add_relation(element)
+    return selection
+
+
+# select_every() selects every k-th node and every k-th way (and all of its
+# nodes), and their relations
+def select_every(osm_file, k):
+    selection = Selection()
+    seen = dict((tag, 0) for tag in ELEMENTS)
+
+    for element in iter_elements(osm_file):
+        if element.tag == 'relation':
+            selection.add_relation(element)
+        elif seen[element.tag] % k == 0:
+            if element.tag == 'node':
+                selection.add('node', element.attrib['id'])
+            else:
+                selection.add_way(element)
+        seen[element.tag] += 1
+    return selection
+
+
+# write_extract() writes the selected elements in file order. Members that
+# are not in the extract are left out of their relations, so the sample only
+# references elements it contains.
+def write_extract(osm_file, out, selection, bbox=None):
+    with open_output(out) as output:
+        output.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        output.write('<osm version="0.6" generator="extract.py">\n')
+        if bbox is not None:
+            output.write(' <bounds minlat="%s" minlon="%s" maxlat="%s" '
+                         'maxlon="%s"/>\n' % tuple(bbox))
+
+        for element in iter_elements(osm_file):
+            if element not in selection:
+                continue
+            if element.tag == 'relation':
+                for member in list(element.iter('member')):
+                    if not selection.has_member(member):
+                        element.remove(member)
+            element.tail = '\n'
+            output.write('  ' + ET.tostring(element, encoding='utf-8'))
+
+        output.write('</osm>\n')
+
+
+# iter_elements() yields the top level elements of an .osm, .osm.bz2,
+# .osm.gz or .osm.pbf file, clearing each one once it has been handled
+def iter_elements(osm_file):
+    if osmfile.is_pbf(osm_file):
+        for element in pbf.get_element(osm_file):
+            yield element
+        return
+
+    with osmfile.open_osm(osm_file) as source:
+        context = ET.iterparse(source, events=('start', 'end'))
+        _, root = next(context)
+        for event, element in context:
+            if event == 'end' and element.tag in ELEMENTS:
+                yield element
+                root.clear()
+
+
+def open_output(path):
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'wb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'wb')
+    return open(path, 'wb')
+
+
+def estimate_size(osm_file):
+    size = os.path.getsize(osm_file)
+    for extension, ratio in COMPRESSION_RATIOS.iteritems():
+        if osm_file.endswith(extension):
+            return size * ratio
+    return size
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Write a self-contained sample of an OSM file")
+    parser.add_argument('osm_file', nargs='?', default=OSM_FILE)
+    parser.add_argument('out', nargs='?', default=SAMPLE_FILE)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--bbox', type=lambda s: [float(c) for c in
+                                                s.split(',')],
+                      help="min_lat,min_lon,max_lat,max_lon")
+    mode.add_argument('--every', type=int, default=25, metavar='K',
+                      help="every k-th node and way (default 25)")
+    mode.add_argument('--size', type=float, metavar='MB',
+                      help="approximate size of the extract")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    extract(args.osm_file, args.out, bbox=args.bbox, k=args.every,
+            target_size=args.size * 1e6 if args.size else None)
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
+from collections import defaultdict, OrderedDict
 import re
 
 import audit
+import records
 
 street_type_re = re.compile(r'\b\S+\.?$', re.IGNORECASE)
 
@@ -51,26 +53,24 @@ MAPPING = {"av": "Avinguda",
            }
 
 NON_CASE = ["de", "del", "la", "les", "el", "els", "i"]
-uncaught_st = set()
 
-# n_xxx keep track of the number of fixes applied to the data set
-n_fix_lang = 0
+# Maximum number of distinct addr:street values kept by the normalizer cache
+CACHE_SIZE = 50000
 
 
+# The attributes are looked up in the order of the record fields, missing
+# ones (user and uid of anonymous edits) are None
 def map_node(element, node_attr_fields):
-    node_attribs = {}
-    for attr in element.attrib:
-        if attr in node_attr_fields:
-            node_attribs[attr] = element.attrib[attr]
-    return node_attribs
+    return records.Node._make(map(element.attrib.get, node_attr_fields))
 
 
 def map_way(element, way_attr_fields):
-    way_attribs = {}
-    for attr in element.attrib:
-        if attr in way_attr_fields:
-            way_attribs[attr] = element.attrib[attr]
-    return way_attribs
+    return records.Way._make(map(element.attrib.get, way_attr_fields))
+
+
+def map_relation(element, relation_attr_fields):
+    return records.Relation._make(map(element.attrib.get,
+                                      relation_attr_fields))
 
 
 def get_tags(element, unique_id,
@@ -80,64 +80,172 @@ def get_tags(element, unique_id,
     tags = []
     # NODE/WAY_TAGS_FIELDS
     for tag in element.iter("tag"):
-        t = {}
-        # NODE/WAY_TAGS_FIELDS[0]:id
-        # id maps to the top level node/way id attribute value
-        t["id"] = unique_id
-
-        # NODE/WAY_TAGS_FIELDS[1]:key
-        # if there's no ":" key maps to the full "k" attribute
-        # if there's ":" key only maps to the characters after the colon
-        # NODE/WAY_TAGS_FIELDS[3]:type
-        # type maps to the characters before the colon in the tag
-        # type equals "regular" if there's no ":"
-        k = tag.attrib["k"]
-        m = problem_chars.search(k)
-        if not m:
-            if ":" not in k:
-                t["key"] = k
-                t["type"] = default_tag_type
-            else:
-                cut = k.find(":") + 1
-                t["key"] = k[cut:]
-                t["type"] = k[:cut - 1]
+        tags.append(get_tag(tag, unique_id, problem_chars, default_tag_type))
+    return tags
+
+
+def get_tag(tag, unique_id,
+            problem_chars,
+            default_tag_type):
+
+    # NODE/WAY_TAGS_FIELDS[1]:key
+    # if there's no ":" key maps to the full "k" attribute
+    # if there's ":" key only maps to the characters after the colon
+    # NODE/WAY_TAGS_FIELDS[3]:type
+    # type maps to the characters before the colon in the tag
+    # type equals "regular" if there's no ":"
+    # keys with problem characters are left out (None)
+    k = tag.attrib["k"]
+    key = None
+    tag_type = default_tag_type
+    if not problem_chars.search(k):
+        if ":" not in k:
+            key = k
         else:
-            t["type"] = default_tag_type
+            cut = k.find(":") + 1
+            key = k[cut:]
+            tag_type = k[:cut - 1]
 
-        # NODE/WAY_TAGS_FIELDS[2]:value
-        v = tag.attrib["v"]
+    # NODE/WAY_TAGS_FIELDS[2]:value
+    v = tag.attrib["v"]
 
-        if audit.is_postcode(tag):
-            if len(v) != 5:
-                v = None
-            elif v[:2] != "08":
-                v = None
+    if audit.is_postcode(tag):
+        if len(v) != 5:
+            v = None
+        elif v[:2] != "08":
+            v = None
 
-        if audit.is_street_name(tag):
-            st_type = get_street_type(v)
-            st_name = v[len(st_type) + 1:]
+    if audit.is_street_name(tag):
+        v = STREETS.normalize(v)
 
-            if st_type.lower() in LANG_MAPPING:
-                v = fix_lang(st_type, st_name)
+    # NODE/WAY_TAGS_FIELDS[0]:id
+    # id maps to the top level node/way id attribute value
+    # value maps to the full "v" attribute
+    return records.Tag(unique_id, key, v, tag_type)
 
-            elif st_type.lower() in EXPECTED:
-                st_type = fix_case(st_type)
-                st_name = fix_case(st_name)
-                v = st_type + " " + st_name
 
-            elif st_type.lower() in MAPPING:
-                st_type = MAPPING[st_type.lower()]
-                st_name = fix_case(st_name)
-                v = st_type + " " + st_name
+def get_member(member, unique_id, position):
+    # RELATION_MEMBERS_FIELDS[0]:id
+    # id maps to the top level relation id attribute value
+    # RELATION_MEMBERS_FIELDS[1]:member_id
+    # member_id maps to the ref attribute value of the member tag
+    # RELATION_MEMBERS_FIELDS[2]:member_type
+    # member_type is node, way or relation
+    # RELATION_MEMBERS_FIELDS[3]:role
+    # RELATION_MEMBERS_FIELDS[4]:position
+    # position maps to the index starting at 0 of the member tag
+    attrib = member.attrib
+    return records.Member(unique_id, attrib["ref"], attrib["type"],
+                          attrib.get("role", ""), position)
 
-            else:
-                st_type = fix_case(st_type)
-                uncaught_st.add(st_type)
 
-        # value maps to the full "v" attribute
-        t["value"] = v
-        tags.append(t)
-    return tags
+# compile_rules() merges LANG_MAPPING, EXPECTED and MAPPING into a single
+# lookup of lowercase street type -> (rule, replacement). When a type is in
+# more than one table the precedence of the original if/elif chain is kept:
+# LANG_MAPPING, then EXPECTED, then MAPPING.
+def compile_rules():
+    rules = {}
+    for st_type, fixed in MAPPING.items():
+        rules[st_type] = ("mapping", fixed)
+    for st_type in EXPECTED:
+        rules[st_type] = ("case", None)
+    for st_type, fixed in LANG_MAPPING.items():
+        rules[st_type] = ("lang", fixed)
+    return rules
+
+
+class StreetNormalizer(object):
+    """Normalizes addr:street values.
+
+    The same few thousand street names repeat all over the file, so the
+    normalized value of each raw value is kept in an LRU cache of cache_size
+    entries. hits/misses count cache lookups and fixes counts the values
+    handled by each rule ("lang", "case", "mapping" or "uncaught"), cached
+    or not. uncaught counts the street types no rule knows about.
+    """
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.rules = compile_rules()
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.clear_stats()
+
+    # clear_stats() resets the counters, the cache is kept
+    def clear_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.fixes = defaultdict(int)
+        self.uncaught = defaultdict(int)
+
+    def normalize(self, v):
+        try:
+            fixed, rule, st_type = self.cache.pop(v)
+            self.hits += 1
+        except KeyError:
+            fixed, rule, st_type = self.fix_street(v)
+            self.misses += 1
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        # Reinserting the entry marks it as the most recently used
+        self.cache[v] = (fixed, rule, st_type)
+
+        self.fixes[rule] += 1
+        if rule == "uncaught":
+            self.uncaught[st_type] += 1
+        return fixed
+
+    def fix_street(self, v):
+        st_type = get_street_type(v)
+        st_name = v[len(st_type) + 1:]
+        rule, fixed_type = self.rules.get(st_type.lower(), ("uncaught", None))
+
+        if rule == "lang":
+            v = fix_lang(st_type, st_name)
+        elif rule == "case":
+            v = fix_case(st_type) + " " + fix_case(st_name)
+        elif rule == "mapping":
+            v = fixed_type + " " + fix_case(st_name)
+        else:
+            st_type = fix_case(st_type)
+        return v, rule, st_type
+
+    def stats(self):
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "fixes": dict(self.fixes),
+                "uncaught": dict(self.uncaught)}
+
+    # add_stats() adds the stats() of another normalizer, such as the one of
+    # a parallel worker, to the counters
+    def add_stats(self, stats):
+        self.hits += stats["hits"]
+        self.misses += stats["misses"]
+        for rule, count in stats["fixes"].iteritems():
+            self.fixes[rule] += count
+        for st_type, count in stats["uncaught"].iteritems():
+            self.uncaught[st_type] += count
+
+    # print_stats() prints the counters for the summary of a run, with the
+    # n most frequent uncaught street types
+    def print_stats(self, n=10):
+        looked_up = self.hits + self.misses
+        print "streets: %d addr:street values, %.1f%% cache hits%s" % (
+            looked_up, 100.0 * self.hits / looked_up if looked_up else 0,
+            ''.join(", %s %d" % (rule, self.fixes[rule])
+                    for rule in sorted(self.fixes)))
+        # By count only: the types can be byte strings and non-ASCII unicode
+        uncaught = sorted(self.uncaught.iteritems(),
+                          key=lambda item: -item[1])[:n]
+        if uncaught:
+            print "streets: uncaught types %s" % ', '.join(
+                "%s %d" % (st_type.encode('utf-8')
+                           if isinstance(st_type, unicode) else st_type,
+                           count) for st_type, count in uncaught)
+
+
+# Shared by get_tags(), its stats() cover the whole run: the loaders clear
+# them when they start, and add those of their parallel workers
+STREETS = StreetNormalizer()
 
 
 def get_street_type(v):
@@ -165,7 +273,11 @@ def fix_case(s):
     return s_fix_case
 
 
+# Most LANG_MAPPING values are UTF-8 byte strings, decoded when the name is
+# unicode (non-ASCII, as ElementTree returns it)
 def fix_lang(st_type, st_name):
     st_type_fix_lang = LANG_MAPPING[st_type.lower()]
+    if isinstance(st_name, unicode) and isinstance(st_type_fix_lang, str):
+        st_type_fix_lang = st_type_fix_lang.decode('utf-8')
     street_fix_lang = st_type_fix_lang + ' ' + st_name
     return street_fix_lang
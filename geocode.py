@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+import argparse
+import json
+import math
+import os
+import random
+import sqlite3
+import time
+
+import numpy
+
+import fix
+import sax
+import spatial
+import to_sql
+
+GEOCODER_PATH = 'data/geocoder'
+GRID_FILE = 'grid.json'
+
+# Side of the grid cells, in meters
+CELL_SIZE = 100.0
+
+# Lookups farther than this from any street return None
+MAX_DISTANCE = 1000.0
+
+# Points looked up together by Geocoder.lookup_many()
+BATCH_SIZE = 10000
+
+# The streets are the ways with a highway and a name tag
+STREETS = '''
+    CREATE TEMP TABLE street AS
+    SELECT id, value AS name FROM way_tags
+    WHERE key = 'name' AND type = 'regular' AND value != ''
+      AND id IN (SELECT id FROM way_tags
+                 WHERE key = 'highway' AND type = 'regular');
+    '''
+
+# Nodes missing from the extract are skipped, like in geometry.py: the way
+# goes straight from the node before to the node after
+STREET_POINTS = '''
+    SELECT wn.id, n.lat, n.lon
+    FROM way_nodes AS wn JOIN node AS n ON n.id = wn.node_id
+    WHERE wn.id IN (SELECT id FROM temp.street)
+    ORDER BY wn.id, wn.position;
+    '''
+
+
+# build() writes the reverse geocoding index of the streets of sqlite_file
+# to path: their segments in a local equirectangular projection (meters
+# east and north of the corner of the grid), the segments of each cell_size
+# cell of a uniform grid over them, and the id and normalized name of each
+# street. Every array is a .npy file, with the CSR layout of columns.py for
+# the lists, so that Geocoder maps them in memory instead of reading them.
+def build(sqlite_file=to_sql.SQLITE_FILE, path=GEOCODER_PATH,
+          cell_size=CELL_SIZE):
+    start = time.time()
+    conn = sqlite3.connect(sqlite_file)
+    conn.text_factory = str
+    conn.execute('DROP TABLE IF EXISTS temp.street;')
+    conn.execute(STREETS)
+
+    # The name tags are not normalized by the load, only addr:street. They
+    # are given to fix.py as the loader does, see sax.decode().
+    normalizer = fix.StreetNormalizer()
+    ids, names = [], []
+    for way_id, name in conn.execute(
+            'SELECT id, name FROM temp.street ORDER BY id;'):
+        ids.append(way_id)
+        name = normalizer.normalize(sax.decode(name))
+        names.append(name.encode('utf-8') if isinstance(name, unicode)
+                     else name)
+
+    rows = conn.execute(STREET_POINTS).fetchall()
+    conn.close()
+    points = numpy.array([(lat, lon) for _, lat, lon in rows],
+                         dtype='<f8').reshape(-1, 2)
+    point_ways = numpy.searchsorted(numpy.array(ids, dtype='<i8'),
+                                    [way_id for way_id, _, _ in rows])
+
+    # Segments join the consecutive points of a way
+    same = point_ways[1:] == point_ways[:-1]
+    first = points[:-1][same]
+    second = points[1:][same]
+    segment_ways = point_ways[:-1][same]
+
+    grid = projection(points, cell_size)
+    x1, y1 = project(grid, first[:, 0], first[:, 1])
+    x2, y2 = project(grid, second[:, 0], second[:, 1])
+    x1, y1, x2, y2, segment_ways = split_segments(x1, y1, x2, y2,
+                                                  segment_ways, cell_size)
+    grid['cols'] = int(max(x1.max(), x2.max()) // cell_size) + 1 \
+        if len(x1) else 1
+    grid['rows'] = int(max(y1.max(), y2.max()) // cell_size) + 1 \
+        if len(y1) else 1
+    cell_offsets, cell_segments = grid_cells(grid, x1, y1, x2, y2)
+
+    arrays = {
+        'segments': numpy.column_stack([x1, y1, x2, y2]).astype('<f8'),
+        'segment_ways': segment_ways.astype('<i4'),
+        'cell_offsets': cell_offsets,
+        'cell_segments': cell_segments,
+        'way_ids': numpy.array(ids, dtype='<i8'),
+        'name_offsets': numpy.cumsum([0] + [len(n) for n in names],
+                                     dtype='<i8'),
+        'names': numpy.array(bytearray(''.join(names)), dtype='u1')
+    }
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name, array in arrays.iteritems():
+        numpy.save(os.path.join(path, name + '.npy'), array)
+    with open(os.path.join(path, GRID_FILE), 'w') as f:
+        json.dump(grid, f, indent=2, sort_keys=True)
+
+    print "geocoder: %d streets, %d segments, %dx%d cells in %.1fs" % (
+        len(ids), len(segment_ways), grid['rows'], grid['cols'],
+        time.time() - start)
+    return grid
+
+
+# projection() centers the projection on the points, with the corner of the
+# grid at their minimum. Over a city the error of the flat projection is well
+# below 1%.
+def projection(points, cell_size):
+    if not len(points):
+        return {'lat0': 0.0, 'lon0': 0.0, 'scale': 1.0,
+                'cell_size': cell_size}
+    lat0, lon0 = points.min(axis=0)
+    mid_lat = (points[:, 0].min() + points[:, 0].max()) / 2
+    return {'lat0': float(lat0), 'lon0': float(lon0),
+            'scale': math.cos(math.radians(mid_lat)),
+            'cell_size': cell_size}
+
+
+def project(grid, lat, lon):
+    return ((lon - grid['lon0']) * grid['scale'] * spatial.METERS_PER_DEGREE,
+            (lat - grid['lat0']) * spatial.METERS_PER_DEGREE)
+
+
+def unproject(grid, x, y):
+    return (grid['lat0'] + y / spatial.METERS_PER_DEGREE,
+            grid['lon0'] + x / (grid['scale'] * spatial.METERS_PER_DEGREE))
+
+
+# split_segments() cuts the segments longer than max_length in equal pieces
+# no longer than it, so that each one is in 4 cells at most: a long
+# straight segment would otherwise be in every cell of its bounding box. The
+# nearest point of a segment is the nearest point of its nearest piece.
+def split_segments(x1, y1, x2, y2, ways, max_length):
+    pieces = numpy.maximum(1, numpy.ceil(numpy.hypot(x2 - x1, y2 - y1) /
+                                         max_length)).astype('<i8')
+    segments = numpy.repeat(numpy.arange(len(pieces)), pieces)
+    k = numpy.arange(pieces.sum()) - numpy.repeat(numpy.cumsum(pieces) -
+                                                  pieces, pieces)
+    n = pieces[segments].astype('<f8')
+    start, end = k / n, (k + 1) / n
+
+    dx, dy = (x2 - x1)[segments], (y2 - y1)[segments]
+    x, y = x1[segments], y1[segments]
+    return (x + start * dx, y + start * dy, x + end * dx, y + end * dy,
+            ways[segments])
+
+
+# grid_cells() puts every segment in each cell its bounding box overlaps and
+# returns the segments of cell (row * cols + col) as cell_segments[
+# cell_offsets[cell]:cell_offsets[cell + 1]]
+def grid_cells(grid, x1, y1, x2, y2):
+    size = grid['cell_size']
+    cx0 = (numpy.minimum(x1, x2) // size).astype('<i8')
+    cx1 = (numpy.maximum(x1, x2) // size).astype('<i8')
+    cy0 = (numpy.minimum(y1, y2) // size).astype('<i8')
+    cy1 = (numpy.maximum(y1, y2) // size).astype('<i8')
+
+    # One entry per (segment, cell) pair, k numbering the cells of each
+    # segment's bounding box row by row
+    width = cx1 - cx0 + 1
+    counts = width * (cy1 - cy0 + 1)
+    segments = numpy.repeat(numpy.arange(len(counts)), counts)
+    k = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) -
+                                                  counts, counts)
+    width = numpy.repeat(width, counts)
+    cells = (numpy.repeat(cy0, counts) + k // width) * grid['cols'] + \
+        numpy.repeat(cx0, counts) + k % width
+
+    order = numpy.argsort(cells, kind='mergesort')
+    n_cells = grid['rows'] * grid['cols']
+    offsets = numpy.zeros(n_cells + 1, dtype='<i8')
+    numpy.cumsum(numpy.bincount(cells, minlength=n_cells), out=offsets[1:])
+    return offsets, segments[order].astype('<i4')
+
+
+class Geocoder(object):
+    """Nearest street of a coordinate, from the index written by build().
+
+    The arrays are memory-mapped, so opening the index is instant and only
+    the cells that are looked up are read from disk. A lookup searches the
+    cells around the point in growing rings, and stops once no segment
+    outside of the rings searched can be closer than the best one found.
+    """
+
+    def __init__(self, path=GEOCODER_PATH):
+        with open(os.path.join(path, GRID_FILE)) as f:
+            self.grid = json.load(f)
+        # Plain ndarray views of the maps: slicing a numpy.memmap is several
+        # times slower
+        for name in ('segments', 'segment_ways', 'cell_offsets',
+                     'cell_segments', 'way_ids', 'name_offsets', 'names'):
+            array = numpy.load(os.path.join(path, name + '.npy'),
+                               mmap_mode='r')
+            setattr(self, name, array.view(numpy.ndarray))
+        self.size = self.grid['cell_size']
+        self.rows = self.grid['rows']
+        self.cols = self.grid['cols']
+
+    # lookup() returns the nearest street within max_distance meters of (lat,
+    # lon) as a dict with its way id, normalized name, distance in meters and
+    # the nearest point on it, or None
+    def lookup(self, lat, lon, max_distance=MAX_DISTANCE):
+        x, y = project(self.grid, lat, lon)
+        col = int(x // self.size)
+        row = int(y // self.size)
+
+        best, best_distance = None, None
+        ring = 0
+        while True:
+            candidates = self.ring_segments(row, col, ring)
+            if len(candidates):
+                distances, t = self.distances(candidates, x, y)
+                i = distances.argmin()
+                if best is None or distances[i] < best_distance:
+                    best, best_distance = (candidates[i], t[i]), distances[i]
+
+            # Anything outside of the rings is at least ring * size away
+            reach = ring * self.size
+            if best is not None and best_distance <= reach:
+                break
+            if reach > max_distance or self.outside(row, col, ring):
+                break
+            ring += 1
+
+        if best is None or best_distance > max_distance:
+            return None
+        return self.result(best[0], best[1], best_distance)
+
+    # lookup_many() is lookup() for a sequence of (lat, lon) points
+    def lookup_many(self, points, max_distance=MAX_DISTANCE):
+        points = numpy.asarray(points, dtype='<f8').reshape(-1, 2)
+        results = []
+        for start in range(0, len(points), BATCH_SIZE):
+            results.extend(self.lookup_batch(
+                points[start:start + BATCH_SIZE], max_distance))
+        return results
+
+    # lookup_batch() searches the first two rings of all the points at once,
+    # as arrays of (point, segment) pairs. That settles every point with a
+    # street less than a cell away; the others go through lookup().
+    def lookup_batch(self, points, max_distance):
+        x, y = project(self.grid, points[:, 0], points[:, 1])
+        rows = (y // self.size).astype('<i8')
+        cols = (x // self.size).astype('<i8')
+
+        # The (point, cell) pairs of the 3 x 3 cells around each point
+        pair_rows = (rows[:, None] + numpy.repeat([-1, 0, 1], 3)).ravel()
+        pair_cols = (cols[:, None] + numpy.tile([-1, 0, 1], 3)).ravel()
+        owners = numpy.repeat(numpy.arange(len(points)), 9)
+        inside = (pair_rows >= 0) & (pair_rows < self.rows) & \
+            (pair_cols >= 0) & (pair_cols < self.cols)
+        cells = pair_rows[inside] * self.cols + pair_cols[inside]
+        owners = owners[inside]
+
+        # The (point, segment) pairs, with the CSR expansion of grid_cells()
+        starts = self.cell_offsets[cells]
+        counts = self.cell_offsets[cells + 1] - starts
+        owners = numpy.repeat(owners, counts)
+        k = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) -
+                                                      counts, counts)
+        segments = self.cell_segments[numpy.repeat(starts, counts) + k]
+        distances, t = self.distances(segments, x[owners], y[owners])
+
+        # The pairs of each point are together, in point order: its nearest
+        # segment is the first of its pairs at the minimum distance
+        firsts = []
+        if len(owners):
+            starts = numpy.flatnonzero(numpy.concatenate(
+                [[True], owners[1:] != owners[:-1]]))
+            nearest = numpy.minimum.reduceat(distances, starts)
+            lengths = numpy.diff(numpy.append(starts, len(owners)))
+            firsts = numpy.flatnonzero(
+                distances == numpy.repeat(nearest, lengths))
+            firsts = firsts[numpy.concatenate(
+                [[True], owners[firsts][1:] != owners[firsts][:-1]])]
+
+        results = [None] * len(points)
+        settled = numpy.zeros(len(points), dtype=bool)
+        for i in firsts:
+            if distances[i] <= self.size:
+                settled[owners[i]] = True
+                if distances[i] <= max_distance:
+                    results[owners[i]] = self.result(segments[i], t[i],
+                                                     distances[i])
+        for i in numpy.flatnonzero(~settled):
+            results[i] = self.lookup(points[i, 0], points[i, 1],
+                                     max_distance)
+        return results
+
+    # ring_segments() returns the segments of the cells at Chebyshev
+    # distance ring of (row, col), without repeats
+    def ring_segments(self, row, col, ring):
+        parts = []
+        offsets = self.cell_offsets
+        for r in range(max(0, row - ring), min(self.rows, row + ring + 1)):
+            # Whole rows at the top and bottom of the ring, only the two
+            # ends in between
+            if abs(r - row) == ring:
+                cols = range(max(0, col - ring), min(self.cols,
+                                                     col + ring + 1))
+            else:
+                cols = [c for c in (col - ring, col + ring)
+                        if 0 <= c < self.cols]
+            for c in cols:
+                cell = r * self.cols + c
+                start, end = offsets[cell], offsets[cell + 1]
+                if end > start:
+                    parts.append(self.cell_segments[start:end])
+        if not parts:
+            return numpy.zeros(0, dtype='<i4')
+        return numpy.unique(numpy.concatenate(parts))
+
+    def outside(self, row, col, ring):
+        return row - ring <= 0 and col - ring <= 0 and \
+            row + ring >= self.rows - 1 and col + ring >= self.cols - 1
+
+    # distances() returns the distance from (x, y) to each segment and the
+    # position of the nearest point along it (0 to 1)
+    def distances(self, candidates, x, y):
+        seg = self.segments[candidates]
+        x1, y1, x2, y2 = seg[:, 0], seg[:, 1], seg[:, 2], seg[:, 3]
+        dx, dy = x2 - x1, y2 - y1
+        length = dx * dx + dy * dy
+        t = ((x - x1) * dx + (y - y1) * dy) / numpy.where(length > 0, length,
+                                                          1)
+        t = numpy.clip(t, 0, 1)
+        return numpy.hypot(x1 + t * dx - x, y1 + t * dy - y), t
+
+    def result(self, segment, t, distance):
+        way = self.segment_ways[segment]
+        start, end = self.name_offsets[way], self.name_offsets[way + 1]
+        x1, y1, x2, y2 = self.segments[segment]
+        lat, lon = unproject(self.grid, x1 + t * (x2 - x1),
+                             y1 + t * (y2 - y1))
+        return {'id': int(self.way_ids[way]),
+                'name': self.names[start:end].tostring(),
+                'distance': float(distance),
+                'lat': float(lat), 'lon': float(lon)}
+
+
+# benchmark() times n lookups of random points in the area of the streets
+def benchmark(path=GEOCODER_PATH, n=10000, seed=0):
+    start = time.time()
+    geocoder = Geocoder(path)
+    opened = time.time() - start
+
+    rnd = random.Random(seed)
+    grid = geocoder.grid
+    max_lat, max_lon = unproject(grid, grid['cols'] * grid['cell_size'],
+                                 grid['rows'] * grid['cell_size'])
+    points = [(rnd.uniform(grid['lat0'], max_lat),
+               rnd.uniform(grid['lon0'], max_lon)) for _ in range(n)]
+
+    start = time.time()
+    results = geocoder.lookup_many(points)
+    elapsed = time.time() - start
+    found = sum(1 for result in results if result is not None)
+    print "opened in %.1f ms, %d lookups (%d found) in %.2fs, %d/s" % (
+        1000 * opened, n, found, elapsed, n / elapsed)
+    return {'open_ms': 1000 * opened, 'lookups': n, 'found': found,
+            'seconds': elapsed, 'per_second': n / elapsed}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Nearest street of a coordinate")
+    parser.add_argument('point', nargs='*', type=float, metavar='LAT LON',
+                        help="look up a point instead of building the index "
+                             "and timing random lookups")
+    parser.add_argument('--cell-size', type=float, default=CELL_SIZE,
+                        help="in meters (default {})".format(CELL_SIZE))
+    args = parser.parse_args()
+    if len(args.point) not in (0, 2):
+        parser.error("a point is LAT LON")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.point:
+        print Geocoder().lookup(*args.point)
+    else:
+        build(cell_size=args.cell_size)
+        benchmark()
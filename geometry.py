@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+import bisect
+import csv
+import itertools
+import math
+import mmap
+import os
+import struct
+
+import numpy
+
+import records
+
+NODE_INDEX_PATH = "data/node_index"
+
+# Coordinates are stored as fixed point integers with 7 decimals, which is
+# the precision of the coordinates in the .osm files
+SCALE = 10000000
+
+# Number of nodes buffered in memory before they are appended to the index
+BUFFER_SIZE = 100000
+
+# Number of nodes rewritten at a time when sorting the index
+SORT_BLOCK = 1000000
+
+EARTH_RADIUS = 6371008.8
+
+ID_STRUCT = struct.Struct('<q')
+COORDS_STRUCT = struct.Struct('<ii')
+ID_DTYPE = numpy.dtype('<i8')
+COORD_DTYPE = numpy.dtype('<i4')
+
+WAY_GEOMETRY_FIELDS = list(records.WayGeometry._fields)
+
+
+class NodeIndex(object):
+    """On-disk node id -> (lat, lon) index.
+
+    Made of two files: path.ids, the sorted node ids as int64, and
+    path.coords, the matching (lat, lon) pairs as fixed point int32. Nodes
+    are appended with add() during the node pass, then freeze() maps both
+    files in memory and get() looks them up with a binary search on the ids,
+    so the coordinates never have to be loaded in the Python heap. The index
+    is frozen at the first way: the nodes that come after it (in files not
+    sorted nodes first) are left out and counted in skipped, the ways that
+    use them count them as missing. remove() deletes the files once the run
+    is done.
+    """
+
+    def __init__(self, path=NODE_INDEX_PATH):
+        self.path = path
+        self.ids_file = open(path + '.ids', 'w+b')
+        self.coords_file = open(path + '.coords', 'w+b')
+        self.ids_buffer = []
+        self.coords_buffer = []
+        self.count = 0
+        self.skipped = 0
+        self.last = None
+        self.sorted = True
+        self.ids = None
+        self.coords = None
+
+    @classmethod
+    def open(cls, path=NODE_INDEX_PATH):
+        """Open an index written by a previous run, read only"""
+        index = cls.__new__(cls)
+        index.path = path
+        index.ids_file = open(path + '.ids', 'rb')
+        index.coords_file = open(path + '.coords', 'rb')
+        index.ids_buffer = None
+        index.coords_buffer = None
+        index.skipped = 0
+        index.sorted = True
+        index.map_files()
+        index.count = len(index.ids)
+        return index
+
+    @classmethod
+    def resume(cls, state, path=NODE_INDEX_PATH):
+        """Reopen the index of an interrupted run as it was at state (see
+        state()), dropping the nodes added after it"""
+        index = cls.__new__(cls)
+        index.path = path
+        index.ids_file = open(path + '.ids', 'r+b')
+        index.coords_file = open(path + '.coords', 'r+b')
+        index.count = state['count']
+        index.skipped = state.get('skipped', 0)
+        index.ids_file.truncate(index.count * ID_STRUCT.size)
+        index.coords_file.truncate(index.count * COORDS_STRUCT.size)
+        index.ids_file.seek(0, os.SEEK_END)
+        index.coords_file.seek(0, os.SEEK_END)
+        index.ids_buffer = []
+        index.coords_buffer = []
+        index.last = state['last']
+        index.sorted = state['sorted']
+        index.ids = None
+        index.coords = None
+        if state['frozen']:
+            index.map_files()
+        return index
+
+    def state(self):
+        """Write the buffered nodes and return what resume() needs"""
+        self.flush()
+        self.ids_file.flush()
+        self.coords_file.flush()
+        return {'count': self.count, 'skipped': self.skipped,
+                'last': self.last, 'sorted': self.sorted,
+                'frozen': self.ids is not None}
+
+    def add(self, node_id, lat, lon):
+        if self.ids is not None:
+            if not self.skipped:
+                print "warning: node {} comes after the first way, the " \
+                    "nodes after it are left out of the way " \
+                    "geometries".format(node_id)
+            self.skipped += 1
+            return
+
+        node_id = int(node_id)
+        if self.last is not None and node_id <= self.last:
+            self.sorted = False
+        self.last = node_id
+
+        self.ids_buffer.append(node_id)
+        self.coords_buffer.append(int(round(float(lat) * SCALE)))
+        self.coords_buffer.append(int(round(float(lon) * SCALE)))
+        self.count += 1
+        if len(self.ids_buffer) >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.ids_buffer:
+            self.ids_file.write(struct.pack('<%dq' % len(self.ids_buffer),
+                                            *self.ids_buffer))
+            self.coords_file.write(struct.pack(
+                '<%di' % len(self.coords_buffer), *self.coords_buffer))
+            del self.ids_buffer[:]
+            del self.coords_buffer[:]
+
+    def freeze(self):
+        """Finish the node pass and map the index for lookups"""
+        if self.ids is not None:
+            return
+        self.flush()
+        if not self.sorted:
+            self.sort()
+        self.map_files()
+
+    def sort(self):
+        # Only needed for files that are not sorted by id. Both files are
+        # mapped and rewritten in id order SORT_BLOCK nodes at a time, so
+        # only the order (8 bytes per node) is held in memory.
+        self.ids_file.flush()
+        self.coords_file.flush()
+        ids = numpy.memmap(self.ids_file, dtype=ID_DTYPE, mode='r')
+        coords = numpy.memmap(self.coords_file, dtype=COORD_DTYPE,
+                              mode='r').reshape(-1, 2)
+        order = numpy.argsort(ids, kind='mergesort')
+
+        with open(self.path + '.ids.tmp', 'wb') as ids_out, \
+                open(self.path + '.coords.tmp', 'wb') as coords_out:
+            for start in xrange(0, len(order), SORT_BLOCK):
+                block = order[start:start + SORT_BLOCK]
+                ids[block].tofile(ids_out)
+                coords[block].tofile(coords_out)
+        del ids, coords
+
+        for name in ('ids', 'coords'):
+            f = getattr(self, name + '_file')
+            f.close()
+            os.rename(f.name + '.tmp', f.name)
+            f = open(f.name, 'r+b')
+            f.seek(0, os.SEEK_END)
+            setattr(self, name + '_file', f)
+        self.sorted = True
+
+    def map_files(self):
+        self.ids_file.flush()
+        self.coords_file.flush()
+        self.ids = Column(self.ids_file, ID_STRUCT)
+        self.coords = Column(self.coords_file, COORDS_STRUCT)
+
+    def get(self, node_id):
+        """(lat, lon) of node_id, None if it is not in the index"""
+        node_id = int(node_id)
+        i = bisect.bisect_left(self.ids, node_id)
+        if i == len(self.ids) or self.ids[i] != node_id:
+            return None
+        lat, lon = self.coords[i]
+        return float(lat) / SCALE, float(lon) / SCALE
+
+    def close(self):
+        if self.ids_file.closed:
+            return
+        self.flush()
+        for column in (self.ids, self.coords):
+            if column is not None:
+                column.close()
+        self.ids_file.close()
+        self.coords_file.close()
+
+    def remove(self):
+        self.close()
+        for f in (self.ids_file, self.coords_file):
+            if os.path.exists(f.name):
+                os.remove(f.name)
+
+    def way_geometry(self, way_id, node_ids):
+        """Resolve the node references of a way into its geometry row,
+        see geometry_row()"""
+        self.freeze()
+
+        points = []
+        missing = 0
+        for node_id in node_ids:
+            point = self.get(node_id)
+            if point is None:
+                missing += 1
+            else:
+                points.append(point)
+
+        return geometry_row(way_id, points, missing)
+
+
+# geometry_row() builds the way_geometry row of a way from the (lat, lon) of
+# its nodes in order: bounding box, centroid, length in meters and number of
+# nodes missing. None if none of its nodes were found.
+def geometry_row(way_id, points, missing=0):
+    if not points:
+        return None
+
+    lats = [p[0] for p in points]
+    lons = [p[1] for p in points]
+
+    # The closing node of an area is not counted twice in the centroid
+    vertices = points[:-1] if len(points) > 1 and points[0] == points[-1] \
+        else points
+
+    return records.WayGeometry(
+        id=way_id,
+        min_lat=min(lats),
+        min_lon=min(lons),
+        max_lat=max(lats),
+        max_lon=max(lons),
+        centroid_lat=sum(p[0] for p in vertices) / len(vertices),
+        centroid_lon=sum(p[1] for p in vertices) / len(vertices),
+        length=sum(distance(a, b) for a, b in zip(points, points[1:])),
+        missing=missing)
+
+
+class Column(object):
+    """Read-only sequence over the fixed size records of a mapped file"""
+
+    def __init__(self, f, record):
+        size = os.fstat(f.fileno()).st_size
+        self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+            if size else ''
+        self.record = record
+        self.length = size // record.size
+        self.single = len(record.format.lstrip('<')) == 1
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        values = self.record.unpack_from(self.mm, i * self.record.size)
+        return values[0] if self.single else values
+
+    def close(self):
+        if self.mm:
+            self.mm.close()
+
+
+# distance() is the haversine distance in meters between two (lat, lon)
+def distance(a, b):
+    lat1, lon1 = math.radians(a[0]), math.radians(a[1])
+    lat2, lon2 = math.radians(b[0]), math.radians(b[1])
+    h = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, h)))
+
+
+# add_geometry() is called on every shaped element, in file order: nodes are
+# added to the index and ways get their way_geometry row
+def add_geometry(el, index):
+    if 'node' in el:
+        node = el['node']
+        index.add(node.id, node.lat, node.lon)
+    elif 'way' in el:
+        row = index.way_geometry(el['way'].id,
+                                 [w.node_id for w in el['way_nodes']])
+        el['way_geometry'] = [row] if row else []
+
+
+# chunk_geometry() does the same as add_geometry() for the headerless csv
+# files written by a parallel worker (see parallel.py): it adds the nodes of
+# the chunk to the index and yields the way_geometry rows of its ways
+def chunk_geometry(index, paths):
+    with open(paths['node'], 'rb') as f:
+        for row in csv.reader(f):
+            index.add(row[0], row[1], row[2])
+
+    with open(paths['way_nodes'], 'rb') as f:
+        for way_id, rows in itertools.groupby(csv.reader(f),
+                                              key=lambda r: r[0]):
+            row = index.way_geometry(way_id, [r[1] for r in rows])
+            if row:
+                yield row
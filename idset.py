@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import array
+import bisect
+
+# Ids covered by each chunk. OSM ids are allocated sequentially, so the ids
+# of a region mostly fall in a few dense ranges, but a sample or a sparse
+# selection spreads a handful of ids over many chunks.
+CHUNK_BITS = 1 << 16
+CHUNK_SHIFT = 16
+CHUNK_MASK = CHUNK_BITS - 1
+
+# A chunk is a sorted array of the 2 byte offsets of its ids until it holds
+# more than this many, then a bitmap of CHUNK_BITS bits, which takes the
+# same CHUNK_BITS >> 3 bytes
+SPARSE_MAX = CHUNK_BITS >> 4
+
+
+class IdSet(object):
+    """Compact set of integer ids.
+
+    Ids are stored in chunks keyed on id >> CHUNK_SHIFT: a sorted array of
+    offsets while the chunk has few ids, a fixed size bytearray bitmap once
+    it has more than SPARSE_MAX. That takes 1 bit per id in a dense range
+    and 2 bytes per scattered id, instead of the ~70 bytes of a str in a
+    Python set. It also counts the duplicated and the out of order ids
+    (smaller than the previous one) it is fed.
+    """
+
+    def __init__(self):
+        self.chunks = {}
+        self.count = 0
+        self.duplicates = 0
+        self.out_of_order = 0
+        self.last = None
+
+    def add(self, i):
+        """Add id i, returns False if it was already in the set"""
+        i = int(i)
+        if self.last is not None and i < self.last:
+            self.out_of_order += 1
+        self.last = i
+
+        bit = i & CHUNK_MASK
+        chunk = self.chunks.get(i >> CHUNK_SHIFT)
+        if type(chunk) is not bytearray:
+            chunk = self.add_sparse(i >> CHUNK_SHIFT, bit, chunk)
+            if chunk is None:
+                return False
+            if chunk is True:
+                return True
+
+        mask = 1 << (bit & 7)
+        if chunk[bit >> 3] & mask:
+            self.duplicates += 1
+            return False
+        chunk[bit >> 3] |= mask
+        self.count += 1
+        return True
+
+    # add_sparse() adds bit to the sorted array chunk (None for a new chunk).
+    # Returns True if it was added, None if it was already there, or the
+    # bitmap the chunk turned into for add() to set the bit in.
+    def add_sparse(self, key, bit, chunk):
+        if chunk is None:
+            chunk = self.chunks[key] = array.array('H')
+
+        # Ids in order are appended
+        if not chunk or bit > chunk[-1]:
+            position = len(chunk)
+        else:
+            position = bisect.bisect_left(chunk, bit)
+            if chunk[position] == bit:
+                self.duplicates += 1
+                return None
+        if len(chunk) >= SPARSE_MAX:
+            chunk = self.chunks[key] = bitmap(chunk)
+            return chunk
+        chunk.insert(position, bit)
+        self.count += 1
+        return True
+
+    def __contains__(self, i):
+        i = int(i)
+        chunk = self.chunks.get(i >> CHUNK_SHIFT)
+        bit = i & CHUNK_MASK
+        if type(chunk) is bytearray:
+            return bool(chunk[bit >> 3] & (1 << (bit & 7)))
+        if chunk is None:
+            return False
+        position = bisect.bisect_left(chunk, bit)
+        return position < len(chunk) and chunk[position] == bit
+
+    def __len__(self):
+        return self.count
+
+    def nbytes(self):
+        """Memory used by the chunks"""
+        return sum(len(chunk) * getattr(chunk, 'itemsize', 1)
+                   for chunk in self.chunks.itervalues())
+
+
+def bitmap(offsets):
+    chunk = bytearray(CHUNK_BITS >> 3)
+    for bit in offsets:
+        chunk[bit >> 3] |= 1 << (bit & 7)
+    return chunk
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import functools
+import json
+import os
+import time
+
+import fix
+import geometry
+import osmfile
+import sax
+import to_csv
+import to_sql
+
+METRICS_PATH = "data/metrics.json"
+
+# Seconds between progress lines
+INTERVAL = 10
+
+# The clock is only checked for a progress line every CHECK_EVERY elements
+CHECK_EVERY = 1000
+
+
+class Metrics(object):
+    """Cumulative time and calls per stage of a run, with progress lines.
+
+    Stages nest: shape_element includes fix.get_tags. Whatever is not in a
+    stage is reported as other. With parser='expat' the elements are read
+    and shaped in one stage, sax.shape_elements. Only this process is
+    measured, the stage times of the parallel workers are not included.
+    """
+
+    def __init__(self, file_in=None, interval=INTERVAL):
+        self.file_in = file_in
+        self.size = None if osmfile.is_stream(file_in) \
+            else os.path.getsize(file_in)
+        self.interval = interval
+        self.stages = {}
+        self.elements = 0
+        self.pid = os.getpid()
+        self.start = self.last = time.time()
+
+    def add(self, stage, seconds):
+        totals = self.stages.get(stage)
+        if totals is None:
+            totals = self.stages[stage] = [0.0, 0]
+        totals[0] += seconds
+        totals[1] += 1
+
+    def timed(self, stage, func):
+        """func timed as stage, or as stage(*args) when stage is callable"""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(stage(*args) if callable(stage) else stage,
+                         time.time() - start)
+        return wrapper
+
+    def timed_iter(self, stage, func):
+        """Generator function func, timed as stage while it produces each
+        item; every item counts as an element for the progress lines"""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            items = func(*args, **kwargs)
+            while True:
+                start = time.time()
+                try:
+                    item = next(items)
+                finally:
+                    self.add(stage, time.time() - start)
+                self.count()
+                yield item
+        return wrapper
+
+    def count(self):
+        self.elements += 1
+        if self.elements % CHECK_EVERY == 0 and os.getpid() == self.pid:
+            now = time.time()
+            if now - self.last >= self.interval:
+                self.last = now
+                print self.progress()
+
+    def progress(self):
+        elapsed = max(time.time() - self.start, 1e-3)
+        line = "[%s] %d elements (%d/s)" % (
+            format_time(elapsed), self.elements, self.elements / elapsed)
+
+        offset = input_offset(self.file_in)
+        if offset and self.size:
+            rate = offset / elapsed
+            line += ", %.1f/%.1f MB (%.0f%%, %.1f MB/s), ETA %s" % (
+                offset / 1e6, self.size / 1e6, 100.0 * offset / self.size,
+                rate / 1e6, format_time((self.size - offset) / rate))
+
+        busiest = sorted(self.stages.iteritems(), key=lambda s: -s[1][0])[:3]
+        return line + " | " + ", ".join(
+            "%s %.0f%%" % (stage, 100 * seconds / elapsed)
+            for stage, (seconds, _) in busiest)
+
+    def report(self):
+        elapsed = max(time.time() - self.start, 1e-3)
+        stages = dict((stage, {'seconds': round(seconds, 3),
+                               'calls': calls,
+                               'share': round(seconds / elapsed, 4)})
+                      for stage, (seconds, calls) in self.stages.iteritems())
+        # Top level stages only, nested ones are already counted in them
+        accounted = sum(seconds for stage, (seconds, _) in
+                        self.stages.iteritems() if stage not in NESTED)
+        stages['other'] = {'seconds': round(max(0, elapsed - accounted), 3)}
+        return {
+            'file': self.file_in,
+            'size': self.size,
+            'elapsed': round(elapsed, 3),
+            'elements': self.elements,
+            'elements_per_s': round(self.elements / elapsed),
+            'mb_per_s': round(self.size / 1e6 / elapsed, 3)
+            if self.size else None,
+            'stages': stages
+        }
+
+
+def table_stage(conn, table, *args):
+    return 'load_csv:' + table
+
+
+def write_stage(writer, table, *args):
+    return 'write_batch:' + table
+
+
+def insert_stage(cur, table, *args):
+    return 'insert_batch:' + table
+
+
+# Functions timed by instrument(), as (module, name, stage). Generator
+# functions are timed per item. The tables loaded by to_sql.main(), and
+# written and inserted in batches by to_sql.load_map(), are timed
+# separately, see table_stage().
+HOOKS = [
+    (to_csv, 'get_element', 'get_element'),
+    (to_csv, 'shape_element', 'shape_element'),
+    (fix, 'get_tags', 'fix.get_tags'),
+    (sax, 'shape_elements', 'sax.shape_elements'),
+    (to_csv, 'check_element', 'check_element'),
+    (geometry, 'add_geometry', 'add_geometry'),
+    (to_csv, 'write_element', 'write_element'),
+    (to_sql, 'write_batch', write_stage),
+    (to_sql, 'insert_batch', insert_stage),
+    (to_sql, 'load_csv', table_stage),
+    (to_sql, 'build_indexes', 'build_indexes')
+]
+
+GENERATORS = ['get_element', 'shape_elements']
+
+# Stages that run inside another one
+NESTED = ['fix.get_tags']
+
+
+# instrument() times the stages in HOOKS while the block runs, printing a
+# progress line every interval seconds and the per stage times at the end,
+# also written as JSON to path. With enabled=False it yields None and
+# nothing is wrapped, so the pipeline runs exactly as without it.
+@contextlib.contextmanager
+def instrument(file_in=None, enabled=True, path=METRICS_PATH,
+               interval=INTERVAL):
+    if not enabled:
+        yield None
+        return
+
+    metrics = Metrics(file_in, interval)
+    originals = []
+    for module, name, stage in HOOKS:
+        func = getattr(module, name)
+        originals.append((module, name, func))
+        timed = metrics.timed_iter if name in GENERATORS else metrics.timed
+        setattr(module, name, timed(stage, func))
+
+    try:
+        yield metrics
+    finally:
+        for module, name, func in originals:
+            setattr(module, name, func)
+
+    report = metrics.report()
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print metrics.progress()
+    print "metrics written to %s" % path
+
+
+# input_offset() is the position of this process in file_in, read from
+# /proc (Linux only, None elsewhere or when the file is not open). For
+# compressed files it is the position in the compressed file.
+def input_offset(file_in):
+    if not isinstance(file_in, basestring) or not os.path.isdir('/proc/self'):
+        return None
+
+    path = os.path.realpath(file_in)
+    for fd in os.listdir('/proc/self/fd'):
+        try:
+            if os.readlink('/proc/self/fd/' + fd) != path:
+                continue
+            with open('/proc/self/fdinfo/' + fd) as f:
+                for line in f:
+                    if line.startswith('pos:'):
+                        return int(line.split()[1])
+        except (IOError, OSError):
+            continue
+    return None
+
+
+def format_time(seconds):
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60,
+                             seconds % 60)
@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+import argparse
+import sqlite3
+import time
+import xml.etree.cElementTree as ET
+
+import address
+import geometry
+import osmfile
+import stats
+import to_csv
+import to_sql
+
+ACTIONS = ('create', 'modify', 'delete')
+
+REPLICATION_STATE = '''
+    CREATE TABLE IF NOT EXISTS replication_state (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        sequence INTEGER,
+        timestamp TEXT,
+        applied_at TEXT
+        );
+        '''
+
+# Rows that belong to an element, besides its own row
+CHILD_TABLES = {
+    'node': ['node_tags'],
+    'way': ['way_nodes', 'way_tags'],
+    'relation': ['relation_members', 'relation_tags']
+}
+
+WAY_POINTS = '''
+    SELECT node.lat, node.lon
+    FROM way_nodes LEFT JOIN node ON node.id = way_nodes.node_id
+    WHERE way_nodes.id = ?
+    ORDER BY way_nodes.position;
+    '''
+
+
+# apply_change() applies an osmChange file (.osc) to an existing database:
+# created and modified elements go through the same shape_element() and
+# fix.py normalization as a full load and replace their rows, deleted ones
+# are removed. Way geometries, the R*Tree and the address index are kept up
+# to date. Everything happens in one transaction, together with the
+# replication sequence marker; a sequence that is not newer than the stored
+# one is refused.
+def apply_change(osc_file, sequence, timestamp=None, validate=False,
+                 sqlite_file=to_sql.SQLITE_FILE):
+    conn = sqlite3.connect(sqlite_file)
+    conn.text_factory = str
+    conn.execute(REPLICATION_STATE)
+    conn.commit()
+
+    current = get_sequence(conn)
+    if current is not None and int(sequence) <= current:
+        conn.close()
+        raise ValueError("Sequence {} is already applied, database is at {}"
+                         .format(sequence, current))
+
+    start = time.time()
+    counts = dict(((action, tag), 0) for action in ACTIONS
+                  for tag in to_csv.ELEMENTS)
+    try:
+        changed_nodes, changed_ways = set(), set()
+        for action, element in iter_changes(osc_file):
+            element_id = int(element.attrib['id'])
+            # The summary tables lose the old version of the element and
+            # get the new one
+            update_stats(conn, element.tag, element_id, -1)
+            if action == 'delete':
+                delete_element(conn, element.tag, element_id)
+            else:
+                el = to_csv.shape_element(element)
+                if validate is True:
+                    to_csv.check_element(el)
+                upsert_element(conn, element.tag, el)
+                update_stats(conn, element.tag, element_id, 1)
+            counts[(action, element.tag)] += 1
+
+            if element.tag == 'node':
+                changed_nodes.add(element_id)
+            elif element.tag == 'way':
+                changed_ways.add(element_id)
+
+        update_geometry(conn, changed_nodes, changed_ways)
+        address.update_index(conn, changed_nodes, changed_ways)
+        prune_stats(conn)
+        set_sequence(conn, sequence, timestamp)
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    for (action, tag), count in sorted(counts.items()):
+        print "%s %s: %d" % (action, tag, count)
+    print "sequence %s applied in %.1fs" % (sequence, time.time() - start)
+    return counts
+
+
+# iter_changes() streams the (action, element) pairs of an osmChange file
+# (.osc, or .osc.gz as published). Like to_csv.get_element() clears the root,
+# the action block is cleared once each element has been handled, so that a
+# large <create> block is never held in memory as a whole.
+def iter_changes(osc_file):
+    with osmfile.open_osm(osc_file) as source:
+        context = ET.iterparse(source, events=('start', 'end'))
+        _, root = next(context)
+        block = None
+        for event, elem in context:
+            if event == 'start' and elem.tag in ACTIONS:
+                block = elem
+            elif event == 'end' and elem.tag in to_csv.ELEMENTS:
+                if block is not None:
+                    yield block.tag, elem
+                    block.clear()
+                else:
+                    root.clear()
+            elif event == 'end' and elem.tag in ACTIONS:
+                block = None
+                root.clear()
+
+
+def delete_rows(conn, tag, element_id):
+    for table in CHILD_TABLES[tag]:
+        conn.execute('DELETE FROM {} WHERE id = ?;'.format(table),
+                     (element_id,))
+
+
+def delete_element(conn, tag, element_id):
+    delete_rows(conn, tag, element_id)
+    conn.execute('DELETE FROM {} WHERE id = ?;'.format(tag), (element_id,))
+    if tag == 'way':
+        conn.execute('DELETE FROM way_geometry WHERE id = ?;', (element_id,))
+
+
+def upsert_element(conn, tag, el):
+    element_id = int(el[tag].id)
+    delete_rows(conn, tag, element_id)
+    conn.execute(to_sql.insert_statement(tag, 'INSERT OR REPLACE'),
+                 to_sql.to_row(el[tag]))
+
+    for table in CHILD_TABLES[tag]:
+        conn.executemany(to_sql.insert_statement(table),
+                         [to_sql.to_row(row) for row in el[table]])
+
+
+# update_geometry() recomputes the way_geometry rows and the R*Tree entries of
+# the changed ways and of the ways that use a changed node
+def update_geometry(conn, changed_nodes, changed_ways):
+    for node_id in changed_nodes:
+        conn.execute('DELETE FROM node_rtree WHERE id = ?;', (node_id,))
+        conn.execute('''
+            INSERT INTO node_rtree
+            SELECT id, lat, lat, lon, lon FROM node WHERE id = ?;
+            ''', (node_id,))
+        changed_ways.update(way_id for way_id, in conn.execute(
+            'SELECT DISTINCT id FROM way_nodes WHERE node_id = ?;',
+            (node_id,)))
+
+    statement = to_sql.insert_statement('way_geometry', 'INSERT OR REPLACE')
+    for way_id in changed_ways:
+        conn.execute('DELETE FROM way_geometry WHERE id = ?;', (way_id,))
+        conn.execute('DELETE FROM way_rtree WHERE id = ?;', (way_id,))
+
+        points = conn.execute(WAY_POINTS, (way_id,)).fetchall()
+        found = [p for p in points if p[0] is not None]
+        row = geometry.geometry_row(way_id, found, len(points) - len(found))
+        if row is None:
+            continue
+
+        conn.execute(statement, to_sql.to_row(row))
+        conn.execute('''
+            INSERT INTO way_rtree
+            SELECT id, min_lat, max_lat, min_lon, max_lon
+            FROM way_geometry WHERE id = ?;
+            ''', (way_id,))
+
+
+# update_stats() adds sign to the tag_stats and user_stats counts of the
+# element as it is stored in the database
+def update_stats(conn, tag, element_id, sign):
+    column = stats.COUNT_FIELDS[to_csv.ELEMENTS.index(tag)]
+
+    users = conn.execute('SELECT uid, user FROM {} WHERE id = ?;'.format(tag),
+                         (element_id,)).fetchall()
+    for uid, user in users:
+        update_count(conn, 'user_stats', ('uid', 'user'), (uid, user),
+                     column, sign)
+
+    tags = conn.execute(
+        'SELECT key, type, value FROM {}_tags WHERE id = ?;'.format(tag),
+        (element_id,)).fetchall()
+    for key in tags:
+        update_count(conn, 'tag_stats', ('key', 'type', 'value'), key,
+                     column, sign)
+
+
+def update_count(conn, table, names, key, column, sign):
+    cur = conn.execute(
+        'UPDATE {0} SET {1} = {1} + ? WHERE {2};'.format(
+            table, column, ' AND '.join(n + ' = ?' for n in names)),
+        (sign,) + tuple(key))
+    if cur.rowcount == 0 and sign > 0:
+        row = dict((field, 0) for field in stats.COUNT_FIELDS)
+        row.update(zip(names, key))
+        row[column] = sign
+        conn.execute(to_sql.insert_statement(table),
+                     tuple(row[field] for field in to_sql.FIELDS[table]))
+
+
+# prune_stats() drops the summary rows no element uses any more
+def prune_stats(conn):
+    condition = ' AND '.join(f + ' = 0' for f in stats.COUNT_FIELDS)
+    for table in to_sql.STATS_TABLES:
+        conn.execute('DELETE FROM {} WHERE {};'.format(table, condition))
+
+
+def get_sequence(conn):
+    row = conn.execute(
+        'SELECT sequence FROM replication_state WHERE id = 0;').fetchone()
+    return row[0] if row else None
+
+
+def set_sequence(conn, sequence, timestamp):
+    conn.execute('''
+        INSERT OR REPLACE INTO replication_state
+        (id, sequence, timestamp, applied_at)
+        VALUES (0, ?, ?, ?);
+        ''', (int(sequence), timestamp,
+              time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())))
+
+
+# read_state() reads the sequenceNumber and timestamp of a replication
+# state.txt file, as published next to the .osc.gz diffs
+def read_state(path):
+    state = {}
+    with open(path) as f:
+        for line in f:
+            if '=' in line and not line.startswith('#'):
+                k, v = line.strip().split('=', 1)
+                state[k] = v.replace('\\:', ':')
+    return int(state['sequenceNumber']), state.get('timestamp')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Apply an osmChange file to {}".format(
+            to_sql.SQLITE_FILE))
+    parser.add_argument('osc_file', help=".osc or .osc.gz file")
+    parser.add_argument('sequence', nargs='?', type=int,
+                        help="replication sequence number of the file")
+    parser.add_argument('--state', metavar='STATE_TXT',
+                        help="replication state.txt to read the sequence "
+                             "and timestamp from")
+    parser.add_argument('--timestamp', help="timestamp of the file")
+    parser.add_argument('--validate', action='store_true',
+                        help="validate the changed elements")
+    parser.add_argument('--db', default=to_sql.SQLITE_FILE,
+                        help="database to update (default {})".format(
+                            to_sql.SQLITE_FILE))
+    args = parser.parse_args()
+    if args.state:
+        sequence, timestamp = read_state(args.state)
+        if args.sequence is None:
+            args.sequence = sequence
+        if args.timestamp is None:
+            args.timestamp = timestamp
+    if args.sequence is None:
+        parser.error("a sequence or --state is required")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    apply_change(args.osc_file, args.sequence, args.timestamp, args.validate,
+                 args.db)
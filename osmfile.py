@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+import bz2
+import collections
+import contextlib
+import gzip
+import itertools
+import multiprocessing
+import re
+import sys
+
+# Compressed bytes read at a time
+READ_SIZE = 1024 * 1024
+
+# Largest size in compressed bytes of the ranges decompressed by each
+# worker. Every range is decompressed in memory, which is about 10 to 15
+# times more; a range that decompresses to more than BZ2_MAX_OUTPUT is
+# decompressed by the parent as it is parsed instead.
+BZ2_CHUNK_SIZE = 2 * 1024 * 1024
+BZ2_MAX_OUTPUT = 32 * BZ2_CHUNK_SIZE
+
+# Every stream of a multistream .bz2 file (pbzip2, lbzip2, the planet dumps)
+# starts at a byte boundary with the "BZh" header, the block size digit and
+# the magic number of its first block
+BZ2_STREAM = re.compile(r'BZh[1-9]1AY&SY')
+BZ2_STREAM_SIZE = 10
+
+
+def is_compressed(osm_file):
+    return isinstance(osm_file, basestring) and \
+        osm_file.endswith(('.bz2', '.gz'))
+
+
+def is_pbf(osm_file):
+    return isinstance(osm_file, basestring) and osm_file.endswith('.pbf')
+
+
+# Streams are read once from start to end: "-" (stdin) or an open file, such
+# as the output of a download or a decompressor
+def is_stream(osm_file):
+    return osm_file == '-' or not isinstance(osm_file, basestring)
+
+
+# Only plain .osm files can be split in byte ranges by parallel.py
+def is_splittable(osm_file):
+    return not is_stream(osm_file) and not is_compressed(osm_file) and \
+        not is_pbf(osm_file)
+
+
+# open_osm() yields something ET.iterparse() can read: .gz and .bz2 paths are
+# opened and decompressed as they are read, "-" is stdin and anything else
+# (an .osm path or an open file) is passed through. With workers > 1 the
+# streams of a multistream .bz2 file are decompressed in a process pool.
+@contextlib.contextmanager
+def open_osm(osm_file, workers=1):
+    if osm_file == '-':
+        yield sys.stdin
+    elif not is_compressed(osm_file):
+        yield osm_file
+    elif osm_file.endswith('.gz'):
+        with contextlib.closing(gzip.open(osm_file, 'rb')) as f:
+            yield f
+    else:
+        blocks = map_bz2(osm_file, workers) if workers > 1 \
+            else iter_bz2(read_blocks(osm_file))
+        with contextlib.closing(IterFile(blocks)) as f:
+            yield f
+
+
+def read_blocks(path, start=0, end=None):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        left = end - start if end is not None else None
+        while left is None or left > 0:
+            block = f.read(READ_SIZE if left is None else min(READ_SIZE,
+                                                                left))
+            if not block:
+                break
+            if left is not None:
+                left -= len(block)
+            yield block
+
+
+# iter_bz2() decompresses the concatenated .bz2 streams of blocks. Unlike
+# bz2.BZ2File, it does not stop at the end of the first stream.
+def iter_bz2(blocks):
+    decompressor = bz2.BZ2Decompressor()
+    for data in blocks:
+        while data:
+            try:
+                out = decompressor.decompress(data)
+            except EOFError:
+                # The previous stream ended right at the end of a block
+                decompressor = bz2.BZ2Decompressor()
+                continue
+            if out:
+                yield out
+            data = decompressor.unused_data
+            if data:
+                decompressor = bz2.BZ2Decompressor()
+
+    if not stream_ended(decompressor):
+        raise IOError("Compressed file ended before the end of the last "
+                      "bzip2 stream")
+
+
+def stream_ended(decompressor):
+    try:
+        decompressor.decompress('')
+    except EOFError:
+        return True
+    return False
+
+
+# find_bz2_chunks() yields the byte ranges of the file, made of whole
+# streams, that are decompressed by each worker. A range is only larger than
+# chunk_size when it is a single stream larger than it, such as the one
+# stream of a file compressed with bzip2.
+def find_bz2_chunks(path, chunk_size):
+    start = 0
+    last = 0
+    offset = 0
+    tail = ''
+    for block in read_blocks(path):
+        data = tail + block
+        for match in BZ2_STREAM.finditer(data):
+            stream = offset - len(tail) + match.start()
+            if stream - start > chunk_size and last > start:
+                yield start, last
+                start = last
+            last = stream
+        tail = data[-(BZ2_STREAM_SIZE - 1):]
+        offset += len(block)
+    if offset - start > chunk_size and last > start:
+        yield start, last
+        start = last
+    yield start, offset
+
+
+# map_bz2() decompresses the chunks of a multistream .bz2 file in a process
+# pool and yields them in file order. At most 2 chunks per worker are in
+# flight, so decompression never runs far ahead of the parser.
+# The rest of the file is decompressed serially, streaming, from the start
+# of the first range that is larger than BZ2_CHUNK_SIZE (a single large
+# stream), decompresses to more than BZ2_MAX_OUTPUT or fails to decompress:
+# the stream header can also appear by chance inside compressed data, and a
+# range split at such a false boundary does not hold whole streams.
+def map_bz2(path, workers):
+    chunks = find_bz2_chunks(path, BZ2_CHUNK_SIZE)
+    pool = multiprocessing.Pool(workers)
+    pending = collections.deque()
+
+    # Nothing after a range left to the parent is sent to the pool
+    def submit():
+        if pending and pending[-1][1] is None:
+            return
+        for start, end in itertools.islice(chunks, 1):
+            result = None
+            if end - start <= BZ2_CHUNK_SIZE:
+                result = pool.apply_async(decompress_chunk,
+                                          ((path, start, end),))
+            pending.append((start, result))
+
+    try:
+        for _ in range(2 * workers):
+            submit()
+        while pending:
+            start, result = pending.popleft()
+            data = result.get() if result is not None else None
+            if data is None:
+                pool.terminate()
+                for data in iter_bz2(read_blocks(path, start)):
+                    yield data
+                return
+            yield data
+            submit()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# decompress_chunk() runs in a worker process, it returns the decompressed
+# range, or None if it does not hold whole streams or decompresses to more
+# than BZ2_MAX_OUTPUT
+def decompress_chunk(task):
+    path, start, end = task
+    parts = []
+    size = 0
+    try:
+        for data in iter_bz2(read_blocks(path, start, end)):
+            size += len(data)
+            if size > BZ2_MAX_OUTPUT:
+                return None
+            parts.append(data)
+    except IOError:
+        return None
+    return ''.join(parts)
+
+
+class IterFile(object):
+    """Read-only file over an iterator of strings, used to feed the
+    decompressed blocks to ET.iterparse()"""
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.data = ''
+        self.pos = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self.pos == len(self.data):
+                self.data = next(self.blocks, '')
+                self.pos = 0
+                if not self.data:
+                    break
+            end = len(self.data) if size < 0 else self.pos + size
+            part = self.data[self.pos:end]
+            self.pos += len(part)
+            if size > 0:
+                size -= len(part)
+            parts.append(part)
+        return ''.join(parts)
+
+    def close(self):
+        if hasattr(self.blocks, 'close'):
+            self.blocks.close()
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+import Queue
+import cStringIO
+import collections
+import contextlib
+import itertools
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import checkpoint
+import fix
+import geometry
+import osmfile
+import to_csv
+import validation
+
+# Target size of each byte range. There are always at least as many chunks
+# as workers, so small files still use the whole pool.
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# Bytes read at a time while looking for an element boundary
+SCAN_SIZE = 64 * 1024
+
+# Target size of the batches a stream is split in, see map_stream()
+BATCH_SIZE = 8 * 1024 * 1024
+
+# Bytes read at a time from a stream
+READ_SIZE = 1024 * 1024
+
+# Top level elements a chunk can start with. Attribute values escape "<", so
+# these can only match the opening tag of a node, way or relation.
+ELEMENT_START = re.compile(r'<(?:node|way|relation)[\s/>]')
+OSM_END = '</osm>'
+
+CHUNK_PREFIX = '<?xml version="1.0" encoding="UTF-8"?>\n<osm>\n'
+CHUNK_SUFFIX = '\n</osm>\n'
+
+
+# Plain .osm files are split in byte ranges, streams in batches as they are
+# read (see map_input()); the other files are parsed by a single process,
+# with their decompression or decoding in a pool (see osmfile.py)
+def is_parallel(file_in):
+    return osmfile.is_splittable(file_in) or osmfile.is_stream(file_in)
+
+
+# process_map() saves a checkpoint after every chunk, see checkpoint.py;
+# saved is the checkpoint.Checkpoint of the run
+def process_map(file_in, validate, workers, quarantine=False,
+                parser='etree', saved=None):
+    if saved is None:
+        saved = checkpoint.Checkpoint(file_in, enabled=False)
+
+    start = time.time()
+    position = saved.get('position') or {'offset': 0}
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(to_csv.NODES_PATH))
+    chunks = 0
+
+    rejected = validation.open_quarantine(to_csv.QUARANTINE_PATH, quarantine,
+                                          count=saved.quarantined())
+
+    try:
+        with to_csv.open_writers(append=saved.resumed) as writers, \
+             rejected as rejected, \
+             contextlib.closing(saved.node_index()) as index:
+            saved.track(writers, rejected, index)
+
+            for end, paths, rejected_path in map_input(
+                    file_in, validate, workers, tmp_dir, quarantine, parser,
+                    position['offset']):
+                chunks += 1
+                for table, path in paths.iteritems():
+                    append_file(writers[table], path)
+                if rejected is not None:
+                    rejected.append_file(rejected_path)
+
+                # The workers cannot resolve way geometries, since the nodes
+                # of a way can be in any earlier chunk
+                writers['way_geometry'].writerows(
+                    geometry.chunk_geometry(index, paths))
+                saved.save({'offset': end, 'last': None})
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    saved.finish()
+
+    print "parsed %d chunks with %d workers in %.1fs" % (
+        chunks, workers, time.time() - start)
+    fix.STREETS.print_stats()
+
+
+# map_input() yields the end offset, csv paths and quarantine path of each
+# chunk of file_in in order: the byte ranges of a file (see map_chunks()), or
+# the batches of a stream (see map_stream()), whose end offset is None.
+# start skips the beginning of a file. The files of a chunk are removed once
+# the consumer is done with them. The street normalizer counters of each
+# chunk are added to fix.STREETS.
+def map_input(file_in, validate, workers, tmp_dir, quarantine=False,
+              parser='etree', start=0):
+    if osmfile.is_stream(file_in):
+        ends = itertools.repeat(None)
+        results = map_stream(file_in, validate, workers, tmp_dir, quarantine,
+                             parser)
+    else:
+        chunks = find_chunks(file_in, workers, start)
+        ends = (end for _, end in chunks)
+        results = map_chunks(file_in, chunks, validate, workers, tmp_dir,
+                             quarantine, parser)
+
+    for end, (paths, rejected_path, streets) in itertools.izip(ends,
+                                                                results):
+        fix.STREETS.add_stats(streets)
+        yield end, paths, rejected_path
+        shutil.rmtree(os.path.dirname(rejected_path))
+
+
+# map_chunks() runs process_chunk() over the chunks in a process pool and
+# yields the csv paths, the quarantine path and the fix.STREETS counters of
+# each chunk in file order,
+# so that concatenating them gives the same output as a serial run. At most
+# 2 chunks per worker are in the pool, like in map_stream(), so the chunk
+# files waiting for a slow consumer stay bounded.
+def map_chunks(file_in, chunks, validate, workers, tmp_dir, quarantine=False,
+               parser='etree'):
+    tasks = ((file_in, s, e, validate, quarantine,
+              os.path.join(tmp_dir, str(i)), parser)
+             for i, (s, e) in enumerate(chunks))
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = collections.deque(
+            pool.apply_async(process_chunk, (task,))
+            for task in itertools.islice(tasks, 2 * workers))
+        while pending:
+            paths = pending.popleft().get()
+            for task in itertools.islice(tasks, 1):
+                pending.append(pool.apply_async(process_chunk, (task,)))
+            yield paths
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+# map_stream() does the same as map_chunks() for a stream, which cannot be
+# split in byte ranges, as a pipeline: a reader thread splits the stream in
+# batches of whole elements (see read_batches()), the pool parses and shapes
+# them (see process_batch()) and their results are yielded in input order,
+# so the output is the same as a serial run. Reading, shaping and whatever
+# the consumer does with the results overlap. The reader queue holds one
+# batch per worker and at most 2 per worker are in the pool, so the reader
+# waits when the workers or the consumer fall behind and memory stays
+# bounded.
+def map_stream(file_in, validate, workers, tmp_dir, quarantine=False,
+               parser='etree'):
+    batches = Queue.Queue(workers)
+    stop = threading.Event()
+    reader = threading.Thread(target=read_batches,
+                              args=(file_in, batches, stop))
+    reader.daemon = True
+    reader.start()
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = collections.deque()
+        done = False
+        for i in itertools.count():
+            # The next result is yielded as soon as it is ready, new batches
+            # are sent while waiting for it
+            while not done and len(pending) < 2 * workers and \
+                    not (pending and pending[0].ready()):
+                batch = batches.get()
+                if batch is None:
+                    done = True
+                elif isinstance(batch, tuple):
+                    raise batch[0], batch[1], batch[2]
+                else:
+                    task = (batch, validate, quarantine,
+                            os.path.join(tmp_dir, str(i + len(pending))),
+                            parser)
+                    pending.append(pool.apply_async(process_batch, (task,)))
+            if not pending:
+                break
+            yield pending.popleft().get()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        stop.set()
+        pool.join()
+
+
+# read_batches() is the reader of map_stream(): it puts the batches of the
+# stream in the queue, then None at the end, or the exc_info() of the error
+# that stopped it. It gives up when stop is set.
+def read_batches(file_in, batches, stop):
+    try:
+        with osmfile.open_osm(file_in) as stream:
+            for batch in iter_batches(stream):
+                if not put(batches, batch, stop):
+                    return
+        put(batches, None, stop)
+    except Exception:
+        put(batches, sys.exc_info(), stop)
+
+
+def put(queue, item, stop):
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+# iter_batches() splits a stream in batches of whole top level elements:
+# each one ends at the first element that starts after batch_size bytes.
+# What comes before the first element and </osm> are left out, like in
+# find_chunks().
+def iter_batches(stream, batch_size=BATCH_SIZE):
+    data = ''
+    started = False
+    # Where to look for the end of the batch, past what was already scanned
+    scan = batch_size
+    while True:
+        block = stream.read(READ_SIZE)
+        data += block
+        if not started:
+            m = ELEMENT_START.search(data)
+            if m is None:
+                if not block:
+                    return
+                continue
+            data = data[m.start():]
+            started = True
+
+        while len(data) > batch_size:
+            m = ELEMENT_START.search(data, scan)
+            if m is None:
+                # Keep the end in case a tag is split between reads
+                scan = max(batch_size, len(data) - 16)
+                break
+            yield data[:m.start()]
+            data = data[m.start():]
+            scan = batch_size
+
+        if not block:
+            end = data.rfind(OSM_END)
+            if end == -1:
+                raise ValueError("Could not find {} at the end of the "
+                                 "input".format(OSM_END))
+            if data[:end].strip():
+                yield data[:end]
+            return
+
+
+def process_chunk(task):
+    file_in, start, end, validate, quarantine, chunk_dir, parser = task
+    return shape_chunk(RangeFile(file_in, start, end), validate, quarantine,
+                       chunk_dir, parser)
+
+
+def process_batch(task):
+    data, validate, quarantine, chunk_dir, parser = task
+    chunk = cStringIO.StringIO(CHUNK_PREFIX + data + CHUNK_SUFFIX)
+    return shape_chunk(chunk, validate, quarantine, chunk_dir, parser)
+
+
+# shape_chunk() writes the shaped elements of a chunk to headerless csv
+# files in chunk_dir, and the invalid ones to its quarantine file. The
+# fix.STREETS counters it returns are those of the chunk; the cache is kept
+# for the next chunks of the worker.
+def shape_chunk(chunk, validate, quarantine, chunk_dir, parser):
+    fix.STREETS.clear_stats()
+    os.mkdir(chunk_dir)
+    paths = dict((table, os.path.join(chunk_dir, os.path.basename(path)))
+                 for table, path in to_csv.CSV_PATHS.iteritems())
+    rejected_path = os.path.join(chunk_dir,
+                                 os.path.basename(to_csv.QUARANTINE_PATH))
+
+    with to_csv.open_writers(paths, header=False) as writers, \
+         validation.open_quarantine(rejected_path, quarantine,
+                                    report=False) as rejected:
+        for el in to_csv.iter_shaped(chunk, parser=parser):
+            if validate is True and not to_csv.check_element(el, rejected):
+                continue
+
+            to_csv.write_element(writers, el)
+
+    return paths, rejected_path, fix.STREETS.stats()
+
+
+# append_file() copies a headerless chunk csv at the end of a writer's file
+def append_file(writer, path):
+    with open(path, 'rb') as f:
+        shutil.copyfileobj(f, writer.stream)
+
+
+# find_chunks() splits the file in byte ranges that start at the opening tag
+# of a top level element. The last range stops right before </osm>. start
+# skips the beginning of the file, it is the end of the last range already
+# processed when resuming a run (see checkpoint.py).
+def find_chunks(file_in, workers, start=0, chunk_size=CHUNK_SIZE):
+    size = os.path.getsize(file_in)
+    n_chunks = max(workers, (size - start) // chunk_size)
+
+    with open(file_in, 'rb') as f:
+        end = find_end(f, size)
+        first = find_boundary(f, start, end)
+        step = max(1, (end - first) // n_chunks)
+
+        offsets = [first]
+        for i in range(1, n_chunks):
+            offset = find_boundary(f, max(first + i * step, offsets[-1] + 1),
+                                   end)
+            if offset >= end:
+                break
+            if offset > offsets[-1]:
+                offsets.append(offset)
+
+    offsets.append(end)
+    return [(s, e) for s, e in zip(offsets, offsets[1:]) if s < e]
+
+
+def find_boundary(f, offset, end):
+    f.seek(offset)
+    pos = offset
+    tail = ''
+    while pos < end:
+        buf = f.read(SCAN_SIZE)
+        if not buf:
+            break
+        data = tail + buf
+        m = ELEMENT_START.search(data)
+        if m:
+            return pos - len(tail) + m.start()
+        # Keep the end of the buffer in case a tag is split between reads
+        tail = data[-16:]
+        pos += len(buf)
+    return end
+
+
+def find_end(f, size):
+    f.seek(max(0, size - SCAN_SIZE))
+    data = f.read()
+    p = data.rfind(OSM_END)
+    if p == -1:
+        raise ValueError("Could not find {} in {}".format(OSM_END, f.name))
+    return size - len(data) + p
+
+
+class RangeFile(object):
+    """Read-only file object over the bytes [start, end) of a .osm file,
+    wrapped in an <osm> root so that it can be fed to iterparse"""
+
+    def __init__(self, path, start, end):
+        self.f = open(path, 'rb')
+        self.f.seek(start)
+        self.remaining = end - start
+        self.prefix = CHUNK_PREFIX
+        self.suffix = CHUNK_SUFFIX
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.prefix) + self.remaining + len(self.suffix)
+
+        out = []
+        if self.prefix:
+            out.append(self.prefix[:size])
+            self.prefix = self.prefix[size:]
+            size -= len(out[-1])
+
+        if size > 0 and self.remaining > 0:
+            data = self.f.read(min(size, self.remaining))
+            self.remaining -= len(data)
+            size -= len(data)
+            out.append(data)
+            if not data:
+                self.remaining = 0
+
+        if size > 0 and self.remaining == 0 and self.suffix:
+            out.append(self.suffix[:size])
+            self.suffix = self.suffix[size:]
+
+        if not self.suffix and self.remaining == 0:
+            self.f.close()
+
+        return ''.join(out)
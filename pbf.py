@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+import collections
+import itertools
+import multiprocessing
+import re
+import struct
+import sys
+import time
+import xml.etree.cElementTree as ET
+import zlib
+
+import to_csv
+
+# Features of the OSMHeader block this reader understands. A file that
+# requires anything else (history, locations on ways...) is refused.
+SUPPORTED_FEATURES = ('OsmSchema-V0.6', 'DenseNodes')
+
+# Default PrimitiveBlock units: coordinates in 100 nanodegrees, timestamps in
+# milliseconds
+GRANULARITY = 100
+DATE_GRANULARITY = 1000
+
+MEMBER_TYPES = ('node', 'way', 'relation')
+
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Any byte of a varint but the last has its high bit set
+MULTIBYTE = re.compile(r'[\x80-\xff]')
+
+
+# iter_records() yields the elements of a .osm.pbf file in file order, as
+# (tag, attrib, children) records where children is a list of
+# (tag, attrib) pairs: the same tags and attribute strings as the .osm XML
+# (see to_element()). With workers > 1 the blocks are decoded in a process
+# pool, at most 2 blocks per worker ahead of the consumer.
+def iter_records(pbf_file, workers=1):
+    blocks = iter_blocks(pbf_file)
+    if workers <= 1:
+        for block in blocks:
+            for record in decode_block(block):
+                yield record
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = collections.deque(
+            pool.apply_async(decode_block, (block,))
+            for block in itertools.islice(blocks, 2 * workers))
+        while pending:
+            records = pending.popleft().get()
+            for block in itertools.islice(blocks, 1):
+                pending.append(pool.apply_async(decode_block, (block,)))
+            for record in records:
+                yield record
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# get_element() is the .osm.pbf counterpart of to_csv.get_element()
+def get_element(pbf_file, tags=('node', 'way', 'relation'), workers=1):
+    for record in iter_records(pbf_file, workers):
+        if record[0] in tags:
+            yield to_element(record)
+
+
+def to_element(record):
+    tag, attrib, children = record
+    element = ET.Element(tag, attrib)
+    for child_tag, child_attrib in children:
+        ET.SubElement(element, child_tag, child_attrib)
+    return element
+
+
+# iter_blocks() reads the blob headers of the file and yields the
+# (path, offset, size) of each OSMData blob, checking the OSMHeader on the
+# way. Blobs are only read by decode_block(), in the workers.
+def iter_blocks(pbf_file):
+    with open(pbf_file, 'rb') as f:
+        while True:
+            head = f.read(4)
+            if not head:
+                break
+            length, = struct.unpack('>I', head)
+            header = dict(iter_fields(f.read(length)))
+            blob_type, size = header[1], header[3]
+            offset = f.tell()
+
+            if blob_type == 'OSMHeader':
+                check_header(read_blob(f.read(size)))
+            elif blob_type == 'OSMData':
+                yield pbf_file, offset, size
+            f.seek(offset + size)
+
+
+def check_header(data):
+    features = [value for number, value in iter_fields(data) if number == 4]
+    unsupported = [f for f in features if f not in SUPPORTED_FEATURES]
+    if unsupported:
+        raise ValueError("Unsupported .osm.pbf features: {}".format(
+            ', '.join(unsupported)))
+
+
+def read_blob(data):
+    blob = dict(iter_fields(data))
+    if 1 in blob:
+        return blob[1]
+    if 3 in blob:
+        return zlib.decompress(blob[3])
+    raise ValueError("Unsupported .osm.pbf blob compression, only raw and "
+                     "zlib are supported")
+
+
+# decode_block() decodes an OSMData blob (a PrimitiveBlock) into records
+def decode_block(block):
+    path, offset, size = block
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = read_blob(f.read(size))
+
+    strings = []
+    groups = []
+    granularity = GRANULARITY
+    date_granularity = DATE_GRANULARITY
+    lat_offset = lon_offset = 0
+    for number, value in iter_fields(data):
+        if number == 1:
+            strings = [to_text(s) for n, s in iter_fields(value) if n == 1]
+        elif number == 2:
+            groups.append(value)
+        elif number == 17:
+            granularity = value
+        elif number == 18:
+            date_granularity = value
+        elif number == 19:
+            lat_offset = signed(value)
+        elif number == 20:
+            lon_offset = signed(value)
+
+    block = Block(strings, granularity, date_granularity, lat_offset,
+                  lon_offset)
+    records = []
+    for group in groups:
+        for number, value in iter_fields(group):
+            if number == 1:
+                records.append(block.node(value))
+            elif number == 2:
+                records.extend(block.dense_nodes(value))
+            elif number == 3:
+                records.append(block.way(value))
+            elif number == 4:
+                records.append(block.relation(value))
+    return records
+
+
+class Block(object):
+    """Decoding context of a PrimitiveBlock: its string table and the units
+    of its coordinates and timestamps"""
+
+    def __init__(self, strings, granularity, date_granularity, lat_offset,
+                 lon_offset):
+        self.strings = strings
+        self.granularity = granularity
+        self.date_granularity = date_granularity
+        self.lat_offset = lat_offset
+        self.lon_offset = lon_offset
+        # Formatted timestamps, most elements of a block share a few
+        self.timestamps = {}
+
+    def coordinate(self, offset, value):
+        return '%.7f' % ((offset + self.granularity * value) / 1e9)
+
+    def coordinates(self, offset, values):
+        granularity = self.granularity
+        return ['%.7f' % ((offset + granularity * v) / 1e9) for v in values]
+
+    def timestamp(self, value):
+        formatted = self.timestamps.get(value)
+        if formatted is None:
+            formatted = self.timestamps[value] = time.strftime(
+                TIMESTAMP_FORMAT,
+                time.gmtime(value * self.date_granularity // 1000))
+        return formatted
+
+    # Every field of an Info is optional. The attributes of the missing ones
+    # are left out, as in an XML file without them. Without a uid, or for
+    # anonymous edits (uid -1), uid and user are left out.
+    def read_info(self, attrib, data):
+        info = dict((n, v) for n, v in iter_fields(data) if n <= 5)
+        if 1 in info:
+            attrib['version'] = str(info[1])
+        if 2 in info:
+            attrib['timestamp'] = self.timestamp(info[2])
+        if 3 in info:
+            attrib['changeset'] = str(info[3])
+        if 4 in info and signed(info[4]) >= 0:
+            attrib['uid'] = str(signed(info[4]))
+            attrib['user'] = self.strings[info.get(5, 0)]
+
+    def tags(self, keys, values):
+        return [('tag', {'k': self.strings[k], 'v': self.strings[v]})
+                for k, v in zip(keys, values)]
+
+    # Node, Way and Relation share their first fields: id, keys, vals, info.
+    # The id is left in fields, it is a sint64 for nodes and an int64 for
+    # ways and relations.
+    def read_element(self, data):
+        attrib = {}
+        keys, values = [], []
+        fields = {}
+        for number, value in iter_fields(data):
+            if number == 2:
+                keys = packed(value)
+            elif number == 3:
+                values = packed(value)
+            elif number == 4:
+                self.read_info(attrib, value)
+            else:
+                fields[number] = value
+        return attrib, self.tags(keys, values), fields
+
+    def node(self, data):
+        attrib, tags, fields = self.read_element(data)
+        attrib['id'] = str(zigzag(fields[1]))
+        attrib['lat'] = self.coordinate(self.lat_offset,
+                                        zigzag(fields.get(8, 0)))
+        attrib['lon'] = self.coordinate(self.lon_offset,
+                                        zigzag(fields.get(9, 0)))
+        return 'node', attrib, tags
+
+    def way(self, data):
+        attrib, tags, fields = self.read_element(data)
+        attrib['id'] = str(signed(fields[1]))
+        refs = delta(packed(fields.get(8, '')))
+        children = [('nd', {'ref': str(ref)}) for ref in refs]
+        return 'way', attrib, children + tags
+
+    def relation(self, data):
+        attrib, tags, fields = self.read_element(data)
+        attrib['id'] = str(signed(fields[1]))
+        roles = packed(fields.get(8, ''))
+        ids = delta(packed(fields.get(9, '')))
+        types = packed(fields.get(10, ''))
+        children = [('member', {'type': MEMBER_TYPES[t], 'ref': str(ref),
+                                'role': self.strings[role]})
+                    for role, ref, t in zip(roles, ids, types)]
+        return 'relation', attrib, children + tags
+
+    # DenseNodes stores each field as a packed array, delta coded except
+    # for the versions; the tags of all the nodes are in one keys_vals array
+    # where each node's (key, value) pairs end with a 0. The attributes are
+    # built column by column, which is much faster than node by node. As in
+    # read_info(), every DenseInfo array is optional: a missing one leaves
+    # its attribute out (a missing user_sid array gives the empty user,
+    # string 0).
+    def dense_nodes(self, data):
+        fields = dict(iter_fields(data))
+        strings = self.strings
+        ids = delta(packed(fields.get(1, '')))
+        names = ['id', 'lat', 'lon']
+        columns = [map(str, ids),
+                   self.coordinates(self.lat_offset,
+                                    delta(packed(fields.get(8, '')))),
+                   self.coordinates(self.lon_offset,
+                                    delta(packed(fields.get(9, ''))))]
+
+        anonymous = set()
+        info = dict(iter_fields(fields.get(5, '')))
+        if 1 in info:
+            names.append('version')
+            columns.append(map(str, packed(info[1])))
+        if 2 in info:
+            names.append('timestamp')
+            columns.append(map(self.timestamp, delta(packed(info[2]))))
+        if 3 in info:
+            names.append('changeset')
+            columns.append(map(str, delta(packed(info[3]))))
+        if 4 in info:
+            uids = delta(packed(info[4]))
+            user_sids = delta(packed(info[5])) if 5 in info \
+                else [0] * len(uids)
+            names += ['uid', 'user']
+            columns += [map(str, uids), [strings[i] for i in user_sids]]
+            anonymous = set(i for i, uid in enumerate(uids) if uid < 0)
+
+        for name, column in zip(names, columns):
+            if len(column) != len(ids):
+                raise ValueError("DenseNodes has {} ids but {} {} values"
+                                 .format(len(ids), len(column), name))
+
+        records = [('node', dict(zip(names, values)), [])
+                   for values in zip(*columns)]
+
+        for i in anonymous:
+            # Anonymous edits have no user, uid and user are left out in XML
+            del records[i][1]['uid']
+            del records[i][1]['user']
+
+        keys_vals = packed(fields.get(10, ''))
+        if keys_vals:
+            kv = 0
+            for _, _, tags in records:
+                while keys_vals[kv]:
+                    tags.append(('tag', {'k': strings[keys_vals[kv]],
+                                         'v': strings[keys_vals[kv + 1]]}))
+                    kv += 2
+                kv += 1
+        return records
+
+
+# Protocol Buffers wire format, only what the OSM messages need
+
+# iter_fields() yields the (field number, value) pairs of a message: an int
+# for varints, a string for length delimited fields (strings, bytes, nested
+# messages and packed arrays)
+def iter_fields(data):
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key, pos = varint(data, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = varint(data, pos)
+        elif wire_type == 2:
+            size, pos = varint(data, pos)
+            value = data[pos:pos + size]
+            pos += size
+        elif wire_type == 1:
+            value = data[pos:pos + 8]
+            pos += 8
+        elif wire_type == 5:
+            value = data[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {}".format(
+                wire_type))
+        yield key >> 3, value
+
+
+def varint(data, pos):
+    byte = ord(data[pos])
+    if byte < 0x80:
+        return byte, pos + 1
+
+    result = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+# packed() decodes a packed array of varints, as unsigned values. Arrays of
+# small values (string ids, versions...) only have single byte varints.
+def packed(data):
+    if not MULTIBYTE.search(data):
+        return list(bytearray(data))
+
+    values = []
+    append = values.append
+    result = 0
+    shift = 0
+    for byte in bytearray(data):
+        if byte < 0x80:
+            append(result | (byte << shift))
+            result = 0
+            shift = 0
+        else:
+            result |= (byte & 0x7f) << shift
+            shift += 7
+    return values
+
+
+# int32/int64 varints are two's complement on 64 bits
+def signed(value):
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+# sint32/sint64 varints are zigzag encoded
+def zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+# delta() decodes a delta coded array of zigzag encoded values
+def delta(values):
+    total = 0
+    result = []
+    append = result.append
+    for value in values:
+        total += (value >> 1) ^ -(value & 1)
+        append(total)
+    return result
+
+
+# Strings are utf-8, kept as str when they are ascii like cElementTree does
+def to_text(s):
+    try:
+        s.decode('ascii')
+        return s
+    except UnicodeDecodeError:
+        return s.decode('utf-8')
+
+
+# benchmark() times reading the same data from the .osm and the .osm.pbf
+# file, up to the elements shape_element() consumes, and the whole
+# to_csv.process_map() run from each of them
+def benchmark(osm_file, pbf_file, workers=1):
+    runs = [('xml', osm_file, 1), ('pbf', pbf_file, 1)]
+    if workers > 1:
+        runs.append(('pbf x%d' % workers, pbf_file, workers))
+
+    results = {}
+    for name, path, w in runs:
+        start = time.time()
+        total = sum(1 for _ in to_csv.get_element(path, workers=w))
+        parsed = time.time() - start
+
+        start = time.time()
+        to_csv.process_map(path, validate=False, workers=w)
+        processed = time.time() - start
+
+        results[name] = {'elements': total, 'parse_seconds': parsed,
+                         'process_seconds': processed}
+        print "%s: %d elements parsed in %.1fs (%d/s), process_map %.1fs" % (
+            name, total, parsed, total / parsed if parsed else 0, processed)
+    return results
+
+
+if __name__ == "__main__":
+    benchmark(sys.argv[1], sys.argv[2],
+              int(sys.argv[3]) if len(sys.argv) > 3 else 1)
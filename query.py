@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import time
+
+import to_sql
+
+# The queries of OpenStreetMap.md, answered from the summary tables built at
+# load time (see stats.py) instead of scanning node_tags and way_tags. Like
+# in the document, only nodes and ways are counted, and a key matches both
+# plain and prefixed tags ("city" and "addr:city").
+TAG_VALUES = '''
+    SELECT value, SUM(nodes + ways) AS count
+    FROM tag_stats
+    WHERE key = ?
+    GROUP BY value
+    HAVING count > 0
+    ORDER BY count DESC, value
+    '''
+
+CONTRIBUTORS = '''
+    SELECT user, SUM(nodes + ways) AS count
+    FROM user_stats
+    GROUP BY user
+    HAVING count > 0
+    ORDER BY count DESC, user
+    '''
+
+
+def connect(sqlite_file=to_sql.SQLITE_FILE):
+    conn = sqlite3.connect(sqlite_file)
+    conn.text_factory = str
+    return conn
+
+
+# tag_values() returns the (value, count) pairs of a tag key, most used
+# first, limited to the first limit values if limit is given
+def tag_values(conn, key, limit=None):
+    query = TAG_VALUES + (' LIMIT ?;' if limit else ';')
+    args = (key, limit) if limit else (key,)
+    return conn.execute(query, args).fetchall()
+
+
+def top_cities(conn, limit=10):
+    return tag_values(conn, 'city', limit)
+
+
+# count_cities() is the number of cities with more than min_count entries
+def count_cities(conn, min_count=5):
+    return conn.execute(
+        'SELECT COUNT(*) FROM ({}) WHERE count > ?;'.format(TAG_VALUES),
+        ('city', min_count)).fetchone()[0]
+
+
+def maxspeed(conn):
+    return tag_values(conn, 'maxspeed')
+
+
+def unique_users(conn):
+    return conn.execute('''
+        SELECT COUNT(DISTINCT uid) FROM user_stats WHERE nodes + ways > 0;
+        ''').fetchone()[0]
+
+
+def top_contributors(conn, limit=10):
+    return conn.execute(CONTRIBUTORS + ' LIMIT ?;', (limit,)).fetchall()
+
+
+# count_contributors() is the number of users with at most max_count entries
+def count_contributors(conn, max_count=5):
+    return conn.execute(
+        'SELECT COUNT(*) FROM ({}) WHERE count <= ?;'.format(CONTRIBUTORS),
+        (max_count,)).fetchone()[0]
+
+
+def count_elements(conn):
+    return conn.execute('''
+        SELECT SUM(nodes), SUM(ways) FROM user_stats;
+        ''').fetchone()
+
+
+def report(conn):
+    start = time.time()
+    nodes, ways = count_elements(conn)
+    print "nodes: %d, ways: %d" % (nodes or 0, ways or 0)
+    print "cities with more than 5 entries: %d" % count_cities(conn)
+    print "unique users: %d" % unique_users(conn)
+    print "users with 5 entries or less: %d" % count_contributors(conn)
+    for title, rows in (("top cities", top_cities(conn)),
+                        ("top contributors", top_contributors(conn)),
+                        ("maxspeed", maxspeed(conn))):
+        print "\n" + title
+        for value, count in rows:
+            print "%-30s %d" % (value, count)
+    print "\nanswered in %.1f ms" % (1000 * (time.time() - start))
+
+
+if __name__ == "__main__":
+    conn = connect()
+    report(conn)
+    conn.close()
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import collections
+import itertools
+
+
+# record() is a namedtuple class for the rows of a table. Its fields are in
+# the order of the csv columns and the table columns, so a record can be
+# written or inserted as is. Fields left out of the .osm file are None.
+# nullable lists the fields that are there even when they are None (a tag
+# value dropped by fix.py), see as_dict().
+def record(name, fields, nullable=()):
+    cls = collections.namedtuple(name, fields)
+    cls.nullable = nullable
+    return cls
+
+
+Node = record('Node', ['id', 'lat', 'lon', 'user', 'uid', 'version',
+                       'changeset', 'timestamp'])
+Way = record('Way', ['id', 'user', 'uid', 'version', 'changeset',
+                     'timestamp'])
+Relation = record('Relation', ['id', 'user', 'uid', 'version', 'changeset',
+                               'timestamp'])
+Tag = record('Tag', ['id', 'key', 'value', 'type'], nullable=('value',))
+WayNode = record('WayNode', ['id', 'node_id', 'position'])
+Member = record('Member', ['id', 'member_id', 'member_type', 'role',
+                           'position'])
+WayGeometry = record('WayGeometry', ['id', 'min_lat', 'min_lon', 'max_lat',
+                                     'max_lon', 'centroid_lat',
+                                     'centroid_lon', 'length', 'missing'])
+TagStat = record('TagStat', ['key', 'type', 'value', 'nodes', 'ways',
+                             'relations'])
+UserStat = record('UserStat', ['uid', 'user', 'nodes', 'ways', 'relations'])
+
+
+# as_dict() is the dict a record used to be before records replaced them:
+# fields that are None are left out, unless they are nullable
+def as_dict(row):
+    return dict((field, value)
+                for field, value in itertools.izip(row._fields, row)
+                if value is not None or field in row.nullable)
+
+
+# document() turns a shaped element into the nested dicts schema.py
+# describes, for the validator and the quarantine file
+def document(el):
+    return dict((table, as_dict(rows) if hasattr(rows, '_fields')
+                 else [as_dict(row) for row in rows])
+                for table, rows in el.iteritems())
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+import argparse
+import collections
+import itertools
+import re
+import time
+from xml.parsers import expat
+
+import fix
+import osmfile
+import records
+import to_csv
+
+# Bytes fed to the parser at a time
+BLOCK_SIZE = 64 * 1024
+
+PARSERS = ('etree', 'expat')
+
+NON_ASCII = re.compile(r'[\x80-\xff]')
+
+
+class Element(object):
+    """Stand-in for an ElementTree element, without the tree.
+
+    Top level elements keep their direct children (<tag>, <nd>, <member>)
+    in children; fix.py and the audit checks only use tag, attrib, iter()
+    and the attribute methods.
+    """
+    __slots__ = ('tag', 'attrib', 'children')
+
+    def __init__(self, tag, attrib, children=()):
+        self.tag = tag
+        self.attrib = attrib
+        self.children = children
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def keys(self):
+        return self.attrib.keys()
+
+    def items(self):
+        return self.attrib.items()
+
+    def iter(self, tag=None):
+        if tag is None or tag == self.tag:
+            yield self
+        for child in self.children:
+            if tag is None or child.tag == tag:
+                yield child
+
+
+class Reader(object):
+    """Feeds an .osm file to an expat parser, BLOCK_SIZE bytes at a time.
+
+    The start() and end() callbacks of the subclasses append what they
+    build to ready, which iterating the reader empties between blocks.
+    depth is the level of the element being read: 0 for <osm>, 1 for the
+    top level elements and 2 for their children.
+
+    Values are read as UTF-8 byte strings, which is much faster than having
+    expat return unicode; see decode(). ascii is True when the current and
+    the previous block (a tag can start in it) are plain ASCII, so that
+    nothing needs decoding.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.parser = expat.ParserCreate()
+        self.parser.returns_unicode = False
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler = self.end
+        self.ready = collections.deque()
+        self.depth = 0
+        self.done = False
+        self.ascii = True
+        self.block_ascii = True
+
+    def feed(self):
+        data = self.source.read(BLOCK_SIZE)
+        self.done = not data
+        block_ascii = NON_ASCII.search(data) is None
+        self.ascii = self.block_ascii and block_ascii
+        self.block_ascii = block_ascii
+        self.parser.Parse(data, self.done)
+
+    def __iter__(self):
+        ready = self.ready
+        while True:
+            while ready:
+                item = ready.popleft()
+                yield item
+                self.skip(item)
+            if self.done:
+                return
+            self.feed()
+
+    def skip(self, item):
+        pass
+
+
+class ElementReader(Reader):
+    """Yields the top level elements in tags as Element objects"""
+
+    def __init__(self, source, tags):
+        super(ElementReader, self).__init__(source)
+        self.tags = tags
+        self.element = None
+
+    def start(self, name, attrs):
+        depth = self.depth
+        self.depth = depth + 1
+        if not self.ascii:
+            for k, v in attrs.iteritems():
+                attrs[k] = decode(v)
+        if depth == 1:
+            if name in self.tags:
+                self.element = Element(name, attrs, [])
+        elif depth == 2 and self.element is not None:
+            self.element.children.append(Element(name, attrs))
+
+    def end(self, name):
+        self.depth -= 1
+        if self.depth == 1 and self.element is not None:
+            self.ready.append(self.element)
+            self.element = None
+
+
+class ShapeReader(Reader):
+    """Yields shaped elements, the same as to_csv.shape_element() would.
+
+    Nodes and ways are yielded once their end tag is read. Like in
+    to_csv.get_element(), relations are yielded as soon as their start tag
+    is read, their members and tags are generators that read the file as
+    they go, see rows(); whatever the consumer did not read is skipped.
+
+    Only the values fix.py changes or the summary tables count by (tag keys
+    and values, user names) are decoded. The others (roles, and the numbers
+    and dates that are ASCII anyway) stay UTF-8 byte strings, which are
+    written and inserted as the same bytes as their unicode counterparts.
+    """
+
+    def __init__(self, source):
+        super(ShapeReader, self).__init__(source)
+        self.el = None
+        self.element_id = None
+        self.tags = None
+        self.way_nodes = None
+        # Relation being read, and the relations yielded or about to be
+        # whose rows are streamed, in file order
+        self.relation = None
+        self.streamed = collections.deque()
+        # fix.py only reads the attributes of the element it is given, so a
+        # single Element is reused for all of them
+        self.element = Element(None, None)
+
+    def start(self, name, attrs):
+        depth = self.depth
+        self.depth = depth + 1
+
+        element = self.element
+        element.tag = name
+        element.attrib = attrs
+
+        if depth == 2:
+            if self.el is None or (self.relation is not None and
+                                   self.relation.skipped):
+                return
+            if name == 'tag':
+                if not self.ascii:
+                    attrs['k'] = decode(attrs['k'])
+                    attrs['v'] = decode(attrs['v'])
+                self.tags.append(fix.get_tag(
+                    element, self.element_id,
+                    to_csv.PROBLEMCHARS, 'regular'))
+            elif name == 'nd':
+                self.way_nodes.append(records.WayNode(
+                    self.element_id, attrs['ref'], len(self.way_nodes)))
+            elif name == 'member' and self.relation is not None:
+                self.relation.members.append(fix.get_member(
+                    element, self.element_id,
+                    next(self.relation.positions)))
+            return
+
+        if depth != 1:
+            return
+
+        if not self.ascii and 'user' in attrs:
+            attrs['user'] = decode(attrs['user'])
+        if name == 'node':
+            node = fix.map_node(element, to_csv.NODE_FIELDS)
+            self.element_id = node.id
+            self.tags = []
+            self.el = {'node': node, 'node_tags': self.tags}
+        elif name == 'way':
+            way = fix.map_way(element, to_csv.WAY_FIELDS)
+            self.element_id = way.id
+            self.tags = []
+            self.way_nodes = []
+            self.el = {'way': way, 'way_nodes': self.way_nodes,
+                       'way_tags': self.tags}
+        elif name == 'relation':
+            relation = fix.map_relation(element, to_csv.RELATION_FIELDS)
+            self.element_id = relation.id
+            self.relation = StreamedRelation()
+            self.streamed.append(self.relation)
+            self.tags = self.relation.tags
+            self.el = {'relation': relation,
+                       'relation_members': self.rows(self.relation,
+                                                     self.relation.members),
+                       'relation_tags': self.rows(self.relation,
+                                                  self.relation.tags)}
+            self.ready.append(self.el)
+
+    def end(self, name):
+        self.depth -= 1
+        if self.depth != 1 or self.el is None:
+            return
+        if self.relation is not None:
+            self.relation.ended = True
+            self.relation = None
+        else:
+            self.ready.append(self.el)
+        self.el = None
+
+    def rows(self, relation, rows):
+        while True:
+            if rows:
+                yield rows.popleft()
+            elif relation.ended or self.done:
+                return
+            else:
+                self.feed()
+
+    def skip(self, el):
+        if 'relation' not in el:
+            return
+        relation = self.streamed.popleft()
+        relation.skipped = True
+        while not relation.ended and not self.done:
+            relation.members.clear()
+            relation.tags.clear()
+            self.feed()
+        relation.members.clear()
+        relation.tags.clear()
+
+
+class StreamedRelation(object):
+    """Member and tag rows of the relation being read, not yet consumed"""
+
+    def __init__(self):
+        self.members = collections.deque()
+        self.tags = collections.deque()
+        self.positions = itertools.count()
+        self.ended = False
+        self.skipped = False
+
+
+# decode() gives the value ElementTree would: a byte string when it is plain
+# ASCII, unicode otherwise
+def decode(value):
+    if NON_ASCII.search(value) is None:
+        return value
+    return value.decode('utf-8')
+
+
+# shape_elements() yields the shaped elements of an .osm, .osm.bz2 or
+# .osm.gz file (see osmfile.open_osm()), without building an ElementTree
+def shape_elements(osm_file, workers=1):
+    with open_source(osm_file, workers) as source:
+        for el in ShapeReader(source):
+            yield el
+
+
+# iter_elements() yields the top level elements in tags as Element objects,
+# for the audit checks
+def iter_elements(osm_file, tags=('node', 'way', 'relation'), workers=1):
+    with open_source(osm_file, workers) as source:
+        for element in ElementReader(source, tags):
+            yield element
+
+
+class open_source(object):
+    """osmfile.open_osm(), opening the plain .osm paths it passes through"""
+
+    def __init__(self, osm_file, workers=1):
+        self.context = osmfile.open_osm(osm_file, workers)
+        self.f = None
+
+    def __enter__(self):
+        source = self.context.__enter__()
+        if isinstance(source, basestring):
+            source = self.f = open(source, 'rb')
+        return source
+
+    def __exit__(self, *exc):
+        if self.f is not None:
+            self.f.close()
+        return self.context.__exit__(*exc)
+
+
+# compare() shapes osm_file with both backends and checks that every element
+# is the same, relations included. Returns the number of elements compared.
+def compare(osm_file):
+    expected = (to_csv.shape_element(element)
+                for element in to_csv.get_element(osm_file))
+    shaped = shape_elements(osm_file)
+
+    count = 0
+    for a, b in itertools.izip_longest(expected, shaped):
+        if a is None or b is None:
+            raise AssertionError("element %d is missing from %s" % (
+                count, 'expat' if b is None else 'etree'))
+        a, b = written(a), written(b)
+        if a != b:
+            raise AssertionError("element %d differs:\n%r\n%r" % (count, a, b))
+        count += 1
+    return count
+
+
+# written() is the element as the csv writers and the database get it, with
+# the unicode values encoded to UTF-8
+def written(el):
+    return dict((table, [encode(row) for row in
+                         ([rows] if hasattr(rows, '_fields') else rows)])
+                for table, rows in el.iteritems())
+
+
+def encode(row):
+    return tuple(v.encode('utf-8') if isinstance(v, unicode) else v
+                 for v in row)
+
+
+def benchmark(osm_file):
+    start = time.time()
+    for element in to_csv.get_element(osm_file):
+        el = to_csv.shape_element(element)
+        for table in el:
+            if not hasattr(el[table], '_fields'):
+                for _ in el[table]:
+                    pass
+    print "etree: %.1fs" % (time.time() - start)
+
+    start = time.time()
+    for el in shape_elements(osm_file):
+        for table in el:
+            if not hasattr(el[table], '_fields'):
+                for _ in el[table]:
+                    pass
+    print "expat: %.1fs" % (time.time() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that the expat backend shapes an .osm file the "
+                    "same as the ElementTree one, and time both")
+    parser.add_argument('osm_file')
+    args = parser.parse_args()
+    print "%d elements identical" % compare(args.osm_file)
+    benchmark(args.osm_file)
@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+import argparse
+import glob
+import json
+import multiprocessing.dummy
+import os
+import random
+import sqlite3
+import time
+
+import spatial
+import to_sql
+
+SHARDS_PATH = 'data/shards'
+MANIFEST_FILE = 'manifest.json'
+
+# Area covered by the grid, as (min_lat, min_lon, max_lat, max_lon).
+# Elements outside of it go to the nearest edge tile. None is the extent of
+# the nodes of the database: a fixed box such as the one of audit.inBCN()
+# (41.0, 1.6, 41.8, 2.5) is mostly countryside and sea, and put the whole
+# city in 2 of 16 tiles.
+BBOX = None
+
+# Rows and columns of the grid
+GRID = (4, 4)
+
+# Maximum number of shards queried at the same time
+WORKERS = 4
+
+# Tables copied to the shards. Nodes go to the tile they are in and ways to
+# the tile of their centroid, with their tags, node refs and geometry.
+# Relations stay in the main database only.
+TABLES = ['node', 'node_tags', 'way', 'way_nodes', 'way_tags', 'way_geometry']
+
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS node_tags_id ON node_tags (id);',
+    'CREATE INDEX IF NOT EXISTS way_nodes_id ON way_nodes (id);',
+    'CREATE INDEX IF NOT EXISTS way_tags_id ON way_tags (id);',
+    'CREATE INDEX IF NOT EXISTS node_tags_key_value '
+    'ON node_tags (key, value);',
+    'CREATE INDEX IF NOT EXISTS way_tags_key_value ON way_tags (key, value);'
+]
+
+# Tile number (row * cols + col) of a point, clamped to the grid. Casting to
+# INTEGER truncates towards 0, which the clamp makes right for the points
+# below or left of the grid too.
+TILE = '''
+    MIN(MAX(CAST(({lat} - :min_lat) / :dlat AS INTEGER), 0), :rows - 1)
+    * :cols +
+    MIN(MAX(CAST(({lon} - :min_lon) / :dlon AS INTEGER), 0), :cols - 1)
+    '''
+
+# Ways without a geometry (all their nodes missing) go to the first tile
+TILES = [
+    'DROP TABLE IF EXISTS temp.node_tile;',
+    'DROP TABLE IF EXISTS temp.way_tile;',
+    '''
+    CREATE TEMP TABLE node_tile AS
+    SELECT id, COALESCE({}, 0) AS tile FROM node;
+    '''.format(TILE.format(lat='lat', lon='lon')),
+    '''
+    CREATE TEMP TABLE way_tile AS
+    SELECT way.id, COALESCE({}, 0) AS tile
+    FROM way LEFT JOIN way_geometry AS g ON g.id = way.id;
+    '''.format(TILE.format(lat='g.centroid_lat', lon='g.centroid_lon')),
+    'CREATE INDEX temp.node_tile_tile ON node_tile (tile, id);',
+    'CREATE INDEX temp.way_tile_tile ON way_tile (tile, id);'
+]
+
+# Extent of the elements of a shard, which the queries use to pick shards:
+# ways can reach out of their tile
+EXTENT = '''
+    SELECT MIN(min_lat), MIN(min_lon), MAX(max_lat), MAX(max_lon) FROM (
+        SELECT MIN(lat) AS min_lat, MIN(lon) AS min_lon,
+               MAX(lat) AS max_lat, MAX(lon) AS max_lon
+        FROM node
+        UNION ALL
+        SELECT MIN(min_lat), MIN(min_lon), MAX(max_lat), MAX(max_lon)
+        FROM way_geometry
+        );
+    '''
+
+# Elements with a tag; like in query.py, the key matches both plain and
+# prefixed tags ("city" and "addr:city"). Ways are returned with their
+# geometry, so the ones with all their nodes missing are left out, like in
+# spatial.bbox().
+TAGGED_NODES = '''
+    SELECT id, lat, lon FROM node
+    WHERE id IN (SELECT id FROM node_tags
+                 WHERE key = ? AND (? IS NULL OR value = ?));
+    '''
+
+TAGGED_WAYS = '''
+    SELECT id, min_lat, min_lon, max_lat, max_lon,
+           centroid_lat, centroid_lon, length
+    FROM way_geometry
+    WHERE id IN (SELECT id FROM way_tags
+                 WHERE key = ? AND (? IS NULL OR value = ?));
+    '''
+
+
+# build() splits the nodes and ways of sqlite_file in one SQLite database
+# per tile of a rows x cols grid over bbox, each with its own indexes and
+# R*Tree, and writes a manifest with the file, tile and extent of every
+# shard to path. Empty tiles get no shard. Queries over different areas
+# then read different files, see bbox() and tagged().
+# The shards are split from the loaded database rather than written by the
+# loaders: the tile of a way is the one of its centroid, which is only known
+# once all its nodes are in, and the loaders (serial, parallel, resumed)
+# stay as they are. It costs one more pass over the nodes and ways.
+def build(sqlite_file=to_sql.SQLITE_FILE, path=SHARDS_PATH, grid=GRID,
+          bbox=BBOX):
+    start = time.time()
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name in glob.glob(os.path.join(path, '*.db*')) + \
+            glob.glob(os.path.join(path, MANIFEST_FILE)):
+        os.remove(name)
+
+    conn = sqlite3.connect(sqlite_file)
+    conn.text_factory = str
+    if bbox is None:
+        bbox = conn.execute('SELECT MIN(lat), MIN(lon), MAX(lat), MAX(lon) '
+                            'FROM node;').fetchone()
+        if bbox[0] is None:
+            bbox = (0.0, 0.0, 0.0, 0.0)
+
+    # A box with no height or width (a single node) is a single row or
+    # column of tiles
+    rows, cols = grid
+    min_lat, min_lon, max_lat, max_lon = bbox
+    params = {'min_lat': min_lat, 'min_lon': min_lon, 'rows': rows,
+              'cols': cols, 'dlat': (max_lat - min_lat) / float(rows) or 1.0,
+              'dlon': (max_lon - min_lon) / float(cols) or 1.0}
+
+    for statement in TILES:
+        conn.execute(statement, params)
+
+    shards = []
+    tiles = [tile for tile, in conn.execute(
+        'SELECT tile FROM node_tile UNION SELECT tile FROM way_tile;')]
+    for tile in sorted(tiles):
+        name = 'bcn_{}_{}.db'.format(tile // cols, tile % cols)
+        shards.append(build_shard(conn, os.path.join(path, name), tile))
+        shards[-1].update({
+            'file': name, 'tile': [tile // cols, tile % cols],
+            'bbox': [min_lat + tile // cols * params['dlat'],
+                     min_lon + tile % cols * params['dlon'],
+                     min_lat + (tile // cols + 1) * params['dlat'],
+                     min_lon + (tile % cols + 1) * params['dlon']]})
+    conn.close()
+
+    manifest = {'source': sqlite_file, 'grid': [rows, cols],
+                'bbox': list(bbox), 'shards': shards}
+    with open(os.path.join(path, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    print "%d shards with %d nodes and %d ways in %.1fs" % (
+        len(shards), sum(s['nodes'] for s in shards),
+        sum(s['ways'] for s in shards), time.time() - start)
+    return manifest
+
+
+# build_shard() copies the elements of a tile from conn, which has the
+# node_tile and way_tile tables of build(), to a new database
+def build_shard(conn, shard_file, tile):
+    shard = sqlite3.connect(shard_file)
+    for pragma in to_sql.BULK_PRAGMAS:
+        shard.execute(pragma)
+    for table in TABLES:
+        shard.execute(to_sql.CREATE[table])
+    shard.commit()
+    shard.close()
+
+    conn.execute('ATTACH DATABASE ? AS shard;', (shard_file,))
+    for table in TABLES:
+        tiles = 'node_tile' if table.startswith('node') else 'way_tile'
+        conn.execute('''
+            INSERT INTO shard.{0} SELECT * FROM main.{0}
+            WHERE id IN (SELECT id FROM {1} WHERE tile = ?);
+            '''.format(table, tiles), (tile,))
+    conn.commit()
+    conn.execute('DETACH DATABASE shard;')
+
+    shard = sqlite3.connect(shard_file)
+    for index in INDEXES:
+        shard.execute(index)
+    spatial.build_rtree(shard)
+    extent = shard.execute(EXTENT).fetchone()
+    nodes, = shard.execute('SELECT COUNT(*) FROM node;').fetchone()
+    ways, = shard.execute('SELECT COUNT(*) FROM way;').fetchone()
+    shard.close()
+
+    return {'nodes': nodes, 'ways': ways,
+            'extent': None if extent[0] is None else list(extent)}
+
+
+def load_manifest(path=SHARDS_PATH):
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    for shard in manifest['shards']:
+        shard['path'] = os.path.join(path, shard['file'])
+    return manifest
+
+
+# bbox() is spatial.bbox() over the shards whose extent intersects the
+# bounding box, queried in parallel. Every element is in a single shard, so
+# the results are just put together: nodes, then ways, each sorted by id.
+def bbox(min_lat, min_lon, max_lat, max_lon, types=('node', 'way'),
+         path=SHARDS_PATH, workers=WORKERS):
+    box = (min_lat, min_lon, max_lat, max_lon)
+    shards = [shard for shard in load_manifest(path)['shards']
+              if intersects(shard['extent'], box)]
+    return merge(fan_out(query_bbox, [(shard['path'], box, types)
+                                      for shard in shards], workers))
+
+
+# tagged() returns the elements with a tag key, and value if given, from all
+# the shards or from those that intersect box, with the elements of the box
+def tagged(key, value=None, box=None, types=('node', 'way'),
+           path=SHARDS_PATH, workers=WORKERS):
+    shards = [shard for shard in load_manifest(path)['shards']
+              if box is None or intersects(shard['extent'], box)]
+    return merge(fan_out(query_tagged, [(shard['path'], key, value, box, types)
+                                        for shard in shards], workers))
+
+
+# fan_out() runs func over the tasks in a thread pool, one connection per
+# shard. sqlite3 releases the GIL while a query runs, so the shards are read
+# at the same time without the cost of sending the rows between processes.
+def fan_out(func, tasks, workers=WORKERS):
+    if len(tasks) <= 1 or workers <= 1:
+        return map(func, tasks)
+
+    pool = multiprocessing.dummy.Pool(min(workers, len(tasks)))
+    try:
+        return pool.map(func, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def query_bbox(task):
+    shard_file, box, types = task
+    conn = connect(shard_file)
+    try:
+        return spatial.bbox(conn, *box, types=types)
+    finally:
+        conn.close()
+
+
+def query_tagged(task):
+    shard_file, key, value, box, types = task
+    conn = connect(shard_file)
+    try:
+        args = (key, value, value)
+        elements = []
+        if 'node' in types:
+            nodes = [{'type': 'node', 'id': i, 'lat': lat, 'lon': lon}
+                     for i, lat, lon in conn.execute(TAGGED_NODES, args)
+                     if box is None or intersects((lat, lon, lat, lon), box)]
+            spatial.add_tags(conn, 'node_tags', nodes)
+            elements.extend(nodes)
+        if 'way' in types:
+            ways = [spatial.way_dict(row)
+                    for row in conn.execute(TAGGED_WAYS, args)
+                    if box is None or intersects(row[1:5], box)]
+            spatial.add_tags(conn, 'way_tags', ways)
+            elements.extend(ways)
+        return elements
+    finally:
+        conn.close()
+
+
+def connect(shard_file):
+    conn = sqlite3.connect(shard_file)
+    conn.text_factory = str
+    return conn
+
+
+def merge(results):
+    elements = [el for elements in results for el in elements]
+    elements.sort(key=lambda el: (el['type'] != 'node', el['id']))
+    return elements
+
+
+# intersects() tells if two (min_lat, min_lon, max_lat, max_lon) boxes
+# overlap; an empty shard has no extent
+def intersects(a, b):
+    if a is None:
+        return False
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+# benchmark() times n random bounding box queries of size degrees against
+# the main database and against the shards
+def benchmark(sqlite_file=to_sql.SQLITE_FILE, path=SHARDS_PATH, n=100,
+              size=0.01, seed=0):
+    conn = connect(sqlite_file)
+    min_lat, max_lat, min_lon, max_lon = conn.execute(
+        'SELECT MIN(lat), MAX(lat), MIN(lon), MAX(lon) FROM node;').fetchone()
+
+    rnd = random.Random(seed)
+    boxes = []
+    for _ in range(n):
+        lat = rnd.uniform(min_lat, max(min_lat, max_lat - size))
+        lon = rnd.uniform(min_lon, max(min_lon, max_lon - size))
+        boxes.append((lat, lon, lat + size, lon + size))
+
+    results = {}
+    for name, query in (('single', lambda box: spatial.bbox(conn, *box)),
+                        ('shards', lambda box: bbox(*box, path=path))):
+        start = time.time()
+        rows = sum(len(query(box)) for box in boxes)
+        elapsed = time.time() - start
+        results[name] = {'queries': n, 'rows': rows, 'seconds': elapsed,
+                         'ms_per_query': 1000 * elapsed / n}
+        print "%s: %d queries, %d rows, %.2f ms/query" % (
+            name, n, rows, 1000 * elapsed / n)
+    conn.close()
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Split {} in one database per tile".format(
+            to_sql.SQLITE_FILE))
+    parser.add_argument('--grid', default='{}x{}'.format(*GRID),
+                        type=lambda s: [int(n) for n in s.split('x')],
+                        help="rows x columns (default {}x{})".format(*GRID))
+    parser.add_argument('--bbox', default=BBOX,
+                        type=lambda s: [float(c) for c in s.split(',')],
+                        help="min_lat,min_lon,max_lat,max_lon of the grid "
+                             "(default: the extent of the nodes)")
+    parser.add_argument('--benchmark', action='store_true',
+                        help="time bounding box queries against the "
+                             "database and the shards")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    build(grid=args.grid, bbox=args.bbox)
+    if args.benchmark:
+        benchmark()
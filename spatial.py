@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import math
+import random
+import sqlite3
+import time
+
+import geometry
+import to_sql
+
+# Maximum number of ids per "IN (...)" query when fetching tags
+IN_SIZE = 500
+
+# Meters per degree of latitude
+METERS_PER_DEGREE = math.pi * geometry.EARTH_RADIUS / 180
+
+# Both trees are built from scratch, also when a resumed load builds them
+# again
+RTREE = [
+    'DROP TABLE IF EXISTS node_rtree;',
+    'DROP TABLE IF EXISTS way_rtree;',
+    '''
+    CREATE VIRTUAL TABLE node_rtree USING rtree (
+        id,
+        min_lat, max_lat,
+        min_lon, max_lon
+        );
+    ''',
+    '''
+    INSERT INTO node_rtree
+    SELECT id, lat, lat, lon, lon FROM node;
+    ''',
+    '''
+    CREATE VIRTUAL TABLE way_rtree USING rtree (
+        id,
+        min_lat, max_lat,
+        min_lon, max_lon
+        );
+    ''',
+    '''
+    INSERT INTO way_rtree
+    SELECT id, min_lat, max_lat, min_lon, max_lon FROM way_geometry;
+    '''
+]
+
+# The R*Tree stores 32 bit floats rounded outwards, so its candidates are
+# filtered again against the exact coordinates
+NODES_IN_BBOX = '''
+    SELECT node.id, node.lat, node.lon
+    FROM node_rtree JOIN node ON node.id = node_rtree.id
+    WHERE node_rtree.max_lat >= ? AND node_rtree.min_lat <= ?
+      AND node_rtree.max_lon >= ? AND node_rtree.min_lon <= ?
+      AND node.lat BETWEEN ? AND ? AND node.lon BETWEEN ? AND ?;
+    '''
+
+WAYS_IN_BBOX = '''
+    SELECT g.id, g.min_lat, g.min_lon, g.max_lat, g.max_lon,
+           g.centroid_lat, g.centroid_lon, g.length
+    FROM way_rtree JOIN way_geometry AS g ON g.id = way_rtree.id
+    WHERE way_rtree.max_lat >= ? AND way_rtree.min_lat <= ?
+      AND way_rtree.max_lon >= ? AND way_rtree.min_lon <= ?
+      AND g.max_lat >= ? AND g.min_lat <= ?
+      AND g.max_lon >= ? AND g.min_lon <= ?;
+    '''
+
+# Same queries without the spatial index, used by benchmark()
+NODES_IN_BBOX_SCAN = '''
+    SELECT id, lat, lon FROM node
+    WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?;
+    '''
+
+WAYS_IN_BBOX_SCAN = '''
+    SELECT id, min_lat, min_lon, max_lat, max_lon,
+           centroid_lat, centroid_lon, length
+    FROM way_geometry
+    WHERE max_lat >= ? AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?;
+    '''
+
+
+def build_rtree(conn):
+    cur = conn.cursor()
+    for statement in RTREE:
+        cur.execute(statement)
+    conn.commit()
+
+
+# bbox() returns the nodes inside and the ways intersecting the bounding box,
+# each as a dict with its coordinates and a dict of its tags
+def bbox(conn, min_lat, min_lon, max_lat, max_lon, types=('node', 'way')):
+    args = (min_lat, max_lat, min_lon, max_lon) * 2
+    elements = []
+
+    if 'node' in types:
+        nodes = [{'type': 'node', 'id': i, 'lat': lat, 'lon': lon}
+                 for i, lat, lon in conn.execute(NODES_IN_BBOX, args)]
+        add_tags(conn, 'node_tags', nodes)
+        elements.extend(nodes)
+
+    if 'way' in types:
+        ways = [way_dict(row) for row in conn.execute(WAYS_IN_BBOX, args)]
+        add_tags(conn, 'way_tags', ways)
+        elements.extend(ways)
+
+    return elements
+
+
+# radius() returns the nodes within meters of (lat, lon) and the ways whose
+# bounding box comes within meters of it, sorted by distance
+def radius(conn, lat, lon, meters, types=('node', 'way')):
+    dlat = meters / METERS_PER_DEGREE
+    dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+    candidates = bbox(conn, lat - dlat, lon - dlon, lat + dlat, lon + dlon,
+                      types)
+
+    elements = []
+    for el in candidates:
+        if el['type'] == 'node':
+            nearest = (el['lat'], el['lon'])
+        else:
+            # Closest point of the bounding box
+            nearest = (min(max(lat, el['min_lat']), el['max_lat']),
+                       min(max(lon, el['min_lon']), el['max_lon']))
+        el['distance'] = geometry.distance((lat, lon), nearest)
+        if el['distance'] <= meters:
+            elements.append(el)
+
+    elements.sort(key=lambda el: el['distance'])
+    return elements
+
+
+def way_dict(row):
+    keys = ['id', 'min_lat', 'min_lon', 'max_lat', 'max_lon',
+            'centroid_lat', 'centroid_lon', 'length']
+    way = dict(zip(keys, row))
+    way['type'] = 'way'
+    return way
+
+
+# add_tags() fetches the tags of the elements and stores them in el['tags'],
+# rebuilding the original "type:key" keys split by fix.get_tags()
+def add_tags(conn, table, elements):
+    by_id = {}
+    for el in elements:
+        el['tags'] = {}
+        by_id[el['id']] = el
+
+    ids = by_id.keys()
+    for start in range(0, len(ids), IN_SIZE):
+        chunk = ids[start:start + IN_SIZE]
+        query = 'SELECT id, key, value, type FROM {} WHERE id IN ({});'.format(
+            table, ', '.join(['?'] * len(chunk)))
+        for i, key, value, tag_type in conn.execute(query, chunk):
+            if tag_type != 'regular':
+                key = tag_type + ':' + key
+            by_id[i]['tags'][key] = value
+
+
+# benchmark() times n random bounding box queries of size degrees through
+# the R*Tree and through a full scan of the node and way_geometry tables
+def benchmark(conn, n=100, size=0.01, seed=0):
+    rnd = random.Random(seed)
+    min_lat, max_lat, min_lon, max_lon = conn.execute(
+        'SELECT MIN(lat), MAX(lat), MIN(lon), MAX(lon) FROM node;').fetchone()
+
+    boxes = []
+    for _ in range(n):
+        lat = rnd.uniform(min_lat, max(min_lat, max_lat - size))
+        lon = rnd.uniform(min_lon, max(min_lon, max_lon - size))
+        boxes.append((lat, lat + size, lon, lon + size))
+
+    results = {}
+    for name, queries in (('rtree', (NODES_IN_BBOX, WAYS_IN_BBOX)),
+                          ('scan', (NODES_IN_BBOX_SCAN, WAYS_IN_BBOX_SCAN))):
+        start = time.time()
+        rows = 0
+        for box in boxes:
+            args = box * 2 if name == 'rtree' else box
+            for query in queries:
+                rows += len(conn.execute(query, args).fetchall())
+        elapsed = time.time() - start
+        results[name] = {'queries': n, 'rows': rows, 'seconds': elapsed,
+                         'ms_per_query': 1000 * elapsed / n}
+        print "%s: %d queries, %d rows, %.2f ms/query" % (
+            name, n, rows, 1000 * elapsed / n)
+    return results
+
+
+if __name__ == "__main__":
+    conn = sqlite3.connect(to_sql.SQLITE_FILE)
+    conn.text_factory = str
+    benchmark(conn)
+    conn.close()
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+# Elements are counted separately per type, in the order of to_csv.ELEMENTS
+COUNT_FIELDS = ['nodes', 'ways', 'relations']
+
+# The summary tables are computed from the element tables once they are
+# loaded, with one GROUP BY each. SQLite sorts what does not fit in its cache
+# on disk, so memory does not grow with the number of distinct values (names,
+# house numbers...) as it would counting them in the loader, and the
+# parallel and resumed loads have nothing to merge. Missing values are '' in
+# the tables, so they are counted as ''.
+TAG_STATS = '''
+    INSERT INTO tag_stats (key, type, value, nodes, ways, relations)
+    SELECT key, type, value, SUM(element = 'node'), SUM(element = 'way'),
+           SUM(element = 'relation')
+    FROM tags
+    GROUP BY key, type, value;
+    '''
+
+USER_STATS = '''
+    INSERT INTO user_stats (uid, user, nodes, ways, relations)
+    SELECT uid, user, SUM(element = 'node'), SUM(element = 'way'),
+           SUM(element = 'relation')
+    FROM (SELECT 'node' AS element, uid, user FROM node
+          UNION ALL
+          SELECT 'way' AS element, uid, user FROM way
+          UNION ALL
+          SELECT 'relation' AS element, uid, user FROM relation)
+    GROUP BY uid, user;
+    '''
+
+SUMMARY = [('tag_stats', TAG_STATS), ('user_stats', USER_STATS)]
+
+
+# build_tables() fills the summary tables from scratch and returns their
+# number of rows by table
+def build_tables(conn):
+    rows = {}
+    for table, statement in SUMMARY:
+        conn.execute('DELETE FROM {};'.format(table))
+        rows[table] = conn.execute(statement).rowcount
+    conn.commit()
+    return rows
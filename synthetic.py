@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+import argparse
+import random
+import time
+from xml.sax.saxutils import quoteattr
+
+SYNTHETIC_FILE = "data/synthetic.osm"
+
+# Bounding box of the generated coordinates, around Barcelona
+BBOX = (41.30, 2.05, 41.50, 2.25)
+
+FIRST_NODE_ID = 100000000
+FIRST_WAY_ID = 300000000
+FIRST_RELATION_ID = 500000000
+
+# Approximate size in bytes of a generated node with the default settings,
+# its share of ways included, used to turn a file size into a node count
+BYTES_PER_NODE = 230
+
+# Street names by the fix.py rule they exercise: already fine, abbreviated
+# (MAPPING), Spanish (LANG_MAPPING), wrong case (EXPECTED) and street types
+# no rule catches
+STREETS = {
+    'expected': ["Carrer de la Marina", "Avinguda Diagonal", "Passeig de "
+                 "Gràcia", "Rambla de Catalunya", "Gran Via de les Corts "
+                 "Catalanes", "Ronda del Mig"],
+    'mapping': ["c/ Aragó", "av. Meridiana", "Pg. Sant Joan", "ctra. de "
+                "Collblanc", "pl. del Sol", "Avda. Paral·lel"],
+    'lang': ["Calle Mayor", "Avenida de Madrid", "Paseo de la Zona Franca",
+             "Plaza de España", "Camino Antic"],
+    'case': ["carrer de sants", "CARRER DEL CONSELL DE CENT", "passeig de "
+             "sant gervasi", "rambla del raval"],
+    'uncaught': ["Foo 12", "Sant Antoni Maria Claret", "Bloc 4"]
+}
+
+# Default share of each kind of street name
+STREET_MIX = {'expected': 0.6, 'mapping': 0.15, 'lang': 0.1, 'case': 0.1,
+              'uncaught': 0.05}
+
+POSTCODES = ['08001', '08012', '08025', '08940', '8001', '17001']
+CITIES = ['Barcelona', "L'Hospitalet de Llobregat", 'Badalona',
+          'Santa Coloma de Gramenet', 'Cornellà de Llobregat']
+AMENITIES = ['cafe', 'restaurant', 'bank', 'pharmacy', 'school', 'bench']
+HIGHWAYS = ['residential', 'primary', 'secondary', 'tertiary', 'footway']
+MAXSPEEDS = ['30', '50', '50', '80', '20']
+USERS = 200
+
+
+# generate() writes a synthetic .osm file with the structure of an OSM
+# extract: nodes, then ways over runs of consecutive nodes, then relations.
+# The same arguments and seed always give the same file.
+#   nodes: number of nodes, or None to derive it from size (bytes)
+#   ways: number of ways, nodes / 10 by default
+#   relations: number of relations, ways / 100 by default
+#   address_share: share of nodes with addr:* tags
+#   poi_share: share of nodes with amenity and name tags
+#   street_mix: share of each kind of street name, see STREET_MIX
+def generate(path=SYNTHETIC_FILE, nodes=None, ways=None, relations=None,
+             size=None, address_share=0.2, poi_share=0.05,
+             street_mix=STREET_MIX, seed=0):
+    if nodes is None:
+        nodes = int((size or 50e6) / BYTES_PER_NODE)
+    if ways is None:
+        ways = nodes // 10
+    if relations is None:
+        relations = ways // 100
+
+    rnd = random.Random(seed)
+    kinds = sorted(street_mix)
+    weights = [street_mix[kind] for kind in kinds]
+
+    def street():
+        kind = weighted_choice(rnd, kinds, weights)
+        return rnd.choice(STREETS[kind])
+
+    start = time.time()
+    with open(path, 'wb') as out:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        out.write('<osm version="0.6" generator="synthetic.py">\n')
+        out.write(' <bounds minlat="%s" minlon="%s" maxlat="%s" '
+                  'maxlon="%s"/>\n' % BBOX)
+
+        for i in xrange(nodes):
+            attrib = element_attrib(rnd, FIRST_NODE_ID + i)
+            attrib.append(('lat', '%.7f' % rnd.uniform(BBOX[0], BBOX[2])))
+            attrib.append(('lon', '%.7f' % rnd.uniform(BBOX[1], BBOX[3])))
+            tags = []
+            if rnd.random() < address_share:
+                tags += [('addr:street', street()),
+                         ('addr:housenumber', str(rnd.randint(1, 300))),
+                         ('addr:postcode', rnd.choice(POSTCODES)),
+                         ('addr:city', rnd.choice(CITIES))]
+            if rnd.random() < poi_share:
+                tags += [('amenity', rnd.choice(AMENITIES)),
+                         ('name', 'Lloc %d' % i)]
+            write_element(out, 'node', attrib, tags)
+
+        for i in xrange(ways):
+            first = rnd.randint(0, max(0, nodes - 10))
+            length = rnd.randint(2, 10)
+            children = [('nd', [('ref', str(FIRST_NODE_ID + n))])
+                        for n in xrange(first, min(first + length, nodes))]
+            tags = [('highway', rnd.choice(HIGHWAYS)), ('name', street())]
+            if rnd.random() < 0.3:
+                tags.append(('maxspeed', rnd.choice(MAXSPEEDS)))
+            write_element(out, 'way', element_attrib(rnd, FIRST_WAY_ID + i),
+                          tags, children)
+
+        # Without ways the relations are written with no members
+        for i in xrange(relations):
+            members = rnd.randint(2, 20) if ways else 0
+            children = [('member', [('type', 'way'),
+                                    ('ref', str(FIRST_WAY_ID +
+                                                rnd.randint(0, ways - 1))),
+                                    ('role', rnd.choice(['outer', 'inner',
+                                                         '']))])
+                        for _ in xrange(members)]
+            write_element(out, 'relation',
+                          element_attrib(rnd, FIRST_RELATION_ID + i),
+                          [('type', 'multipolygon')], children)
+
+        out.write('</osm>\n')
+
+    print "%s: %d nodes, %d ways, %d relations in %.1fs" % (
+        path, nodes, ways, relations, time.time() - start)
+
+
+def element_attrib(rnd, element_id):
+    uid = rnd.randint(1, USERS)
+    return [('id', str(element_id)),
+            ('version', str(rnd.randint(1, 9))),
+            ('timestamp', '20%02d-%02d-%02dT%02d:%02d:%02dZ' % (
+                rnd.randint(8, 17), rnd.randint(1, 12), rnd.randint(1, 28),
+                rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59))),
+            ('changeset', str(rnd.randint(1000000, 50000000))),
+            ('uid', str(uid)),
+            ('user', 'usuari_%d' % uid)]
+
+
+def write_element(out, tag, attrib, tags, children=()):
+    head = '  <%s %s' % (tag, format_attrib(attrib))
+    if not tags and not children:
+        out.write(head + '/>\n')
+        return
+
+    out.write(head + '>\n')
+    for child, child_attrib in children:
+        out.write('    <%s %s/>\n' % (child, format_attrib(child_attrib)))
+    for k, v in tags:
+        out.write('    <tag %s/>\n' % format_attrib([('k', k), ('v', v)]))
+    out.write('  </%s>\n' % tag)
+
+
+def format_attrib(attrib):
+    return ' '.join('%s=%s' % (k, quoteattr(v)) for k, v in attrib)
+
+
+def weighted_choice(rnd, items, weights):
+    x = rnd.random() * sum(weights)
+    for item, weight in zip(items, weights):
+        x -= weight
+        if x < 0:
+            return item
+    return items[-1]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Write a synthetic .osm "
+                                     "file")
+    parser.add_argument('path', nargs='?', default=SYNTHETIC_FILE)
+    parser.add_argument('--nodes', type=int)
+    parser.add_argument('--ways', type=int)
+    parser.add_argument('--relations', type=int)
+    parser.add_argument('--size', type=float, metavar='MB',
+                        help="approximate file size, instead of --nodes")
+    parser.add_argument('--address-share', type=float, default=0.2)
+    parser.add_argument('--poi-share', type=float, default=0.05)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    generate(args.path, args.nodes, args.ways, args.relations,
+             args.size * 1e6 if args.size else None, args.address_share,
+             args.poi_share, seed=args.seed)
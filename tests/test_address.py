@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+
+import address
+import to_sql
+from tests.test_stats import STREETS, quiet
+from tests.util import RunTestCase
+
+
+class AddressTest(RunTestCase):
+
+    def setUp(self):
+        super(AddressTest, self).setUp()
+        with quiet():
+            to_sql.load_map(STREETS, validate=False)
+        self.conn = sqlite3.connect(to_sql.SQLITE_FILE)
+        self.conn.text_factory = str
+
+    def tearDown(self):
+        self.conn.close()
+        super(AddressTest, self).tearDown()
+
+    def test_search(self):
+        results = address.search(self.conn, u'pl sant jaume')
+        self.assertEqual([(r['element'], r['id']) for r in results],
+                         [('node', 3)])
+        results = address.search(self.conn, 'cami font 5')
+        self.assertEqual([(r['element'], r['id']) for r in results][0],
+                         ('node', 6))
+
+    def test_benchmark(self):
+        with quiet():
+            results = address.benchmark(self.conn, n=10)
+        self.assertEqual(results['fts']['queries'], 10)
+        self.assertEqual(results['fts']['found'], 10)
+        self.assertEqual(results['like']['queries'], 10)
+
+    # An index whose addresses have no street gives no samples instead of
+    # looking for one forever
+    def test_benchmark_no_streets(self):
+        self.conn.execute("DELETE FROM address WHERE street IS NOT NULL;")
+        self.conn.execute("INSERT INTO address (rowid, element, id, "
+                          "housenumber) VALUES (99, 'node', 49, '1');")
+        with quiet():
+            results = address.benchmark(self.conn, n=10)
+        self.assertEqual(results['fts']['queries'], 0)
+        self.assertEqual(results['like']['queries'], 0)
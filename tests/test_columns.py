@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import xml.etree.cElementTree as ET
+
+import numpy
+
+import columns
+import geometry
+from tests.test_stats import STREETS, quiet
+from tests.util import RunTestCase
+
+
+class NpyWriterTest(RunTestCase):
+
+    def setUp(self):
+        super(NpyWriterTest, self).setUp()
+        self.buffer_size = columns.BUFFER_SIZE
+
+    def tearDown(self):
+        columns.BUFFER_SIZE = self.buffer_size
+        super(NpyWriterTest, self).tearDown()
+
+    def write(self, dtype, values):
+        writer = columns.NpyWriter('data/column.npy', dtype)
+        for value in values[:3]:
+            writer.append(value)
+        writer.extend(values[3:])
+        writer.close()
+        return writer
+
+    # The values go through several flushes, and numpy reads the length of
+    # the header rewritten by close()
+    def test_round_trip(self):
+        columns.BUFFER_SIZE = 4
+        for dtype, values in (('<i8', [1, -1, 2 ** 40, 0, 7, 8, 9, 10, 11]),
+                              ('<i4', range(-5, 5)),
+                              ('<f8', [0.5, -1.25, 1e300])):
+            writer = self.write(dtype, values)
+            self.assertEqual(writer.count, len(values))
+            array = numpy.load('data/column.npy', mmap_mode='r')
+            self.assertIsInstance(array, numpy.memmap)
+            self.assertEqual(array.dtype, numpy.dtype(dtype))
+            self.assertEqual(array.shape, (len(values),))
+            self.assertEqual(array.tolist(), values)
+
+    def test_empty(self):
+        self.write('<i8', [])
+        array = numpy.load('data/column.npy', mmap_mode='r')
+        self.assertEqual(array.dtype, numpy.dtype('<i8'))
+        self.assertEqual(array.shape, (0,))
+
+    # The header has the same size whatever the length, and the data
+    # starts right after it
+    def test_header(self):
+        for length in (0, 1, 2 ** 62):
+            header = columns.npy_header(numpy.dtype('<i4'), length)
+            self.assertEqual(len(header), columns.HEADER_SIZE)
+            self.assertTrue(header.endswith('\n'))
+        self.write('<i4', [1, 2, 3])
+        with open('data/column.npy', 'rb') as f:
+            data = f.read()
+        self.assertEqual(len(data), columns.HEADER_SIZE + 3 * 4)
+        self.assertEqual(numpy.frombuffer(data[columns.HEADER_SIZE:], '<i4')
+                         .tolist(), [1, 2, 3])
+
+
+class ProcessMapTest(RunTestCase):
+
+    def test_columns(self):
+        with quiet():
+            columns.process_map(STREETS)
+        loaded = columns.load_columns()
+
+        elements = ET.parse(STREETS).getroot()
+        nodes = elements.findall('node')
+        ways = elements.findall('way')
+        self.assertEqual(loaded['node_id'].tolist(),
+                         [int(node.get('id')) for node in nodes])
+        self.assertEqual(loaded['node_lat'].tolist(),
+                         [int(round(float(node.get('lat')) * geometry.SCALE))
+                          for node in nodes])
+        self.assertEqual(loaded['node_timestamp'][0],
+                         columns.epoch('2017-02-12T10:11:12Z'))
+        self.assertEqual(loaded['way_id'].tolist(),
+                         [int(way.get('id')) for way in ways])
+        for i, way in enumerate(ways):
+            self.assertEqual(columns.way_refs(loaded, i).tolist(),
+                             [int(nd.get('ref')) for nd in way.iter('nd')])
+        self.assertEqual(loaded['way_node_offsets'].shape, (len(ways) + 1,))
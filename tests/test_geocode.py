@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import math
+import os
+import random
+import sys
+
+import numpy
+
+import geocode
+import to_sql
+from tests.test_stats import quiet
+from tests.util import RunTestCase, fixture
+
+# Five named highways over about 2 km, with LANG_MAPPING names in ASCII
+# ("Camino Antic") and not ("camino de Gràcia"), a way with a node missing
+# from the extract, a highway without a name and a name without a highway
+GEOCODE = fixture('geocode.osm')
+
+NAMES = {101: 'Camí Antic', 102: 'Camí de Gràcia',
+         103: 'Carrer de la Marina', 104: 'Accés Nord',
+         105: 'Passeig de Gràcia'}
+
+
+@contextlib.contextmanager
+def quiet_stderr():
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+
+
+class GeocoderTest(RunTestCase):
+
+    def setUp(self):
+        super(GeocoderTest, self).setUp()
+        with quiet():
+            to_sql.load_map(GEOCODE, validate=False)
+            geocode.build()
+        self.geocoder = geocode.Geocoder()
+
+    def test_names(self):
+        geocoder = self.geocoder
+        offsets = geocoder.name_offsets
+        self.assertEqual(
+            dict((int(way_id), geocoder.names[offsets[i]:offsets[i + 1]]
+                  .tostring())
+                 for i, way_id in enumerate(geocoder.way_ids)), NAMES)
+
+    # nearest() is the nearest street of (lat, lon) over all the segments
+    def nearest(self, lat, lon):
+        geocoder = self.geocoder
+        x, y = geocode.project(geocoder.grid, lat, lon)
+        distances, _ = geocoder.distances(
+            numpy.arange(len(geocoder.segments)), x, y)
+        i = distances.argmin()
+        return geocoder.way_ids[geocoder.segment_ways[i]], distances[i]
+
+    def points(self, n=300):
+        rnd = random.Random(0)
+        # Over and a bit around the streets, some of them farther than
+        # MAX_DISTANCE
+        return [(rnd.uniform(41.365, 41.405), rnd.uniform(2.155, 2.195))
+                for _ in range(n)]
+
+    def check(self, point, result):
+        way_id, distance = self.nearest(*point)
+        if distance > geocode.MAX_DISTANCE:
+            self.assertIsNone(result)
+            return
+        self.assertAlmostEqual(result['distance'], distance, places=6)
+        self.assertEqual(result['id'], way_id)
+        self.assertEqual(result['name'], NAMES[way_id])
+        x, y = geocode.project(self.geocoder.grid, *point)
+        rx, ry = geocode.project(self.geocoder.grid, result['lat'],
+                                 result['lon'])
+        self.assertAlmostEqual(math.hypot(rx - x, ry - y), distance,
+                               places=6)
+
+    def test_lookup(self):
+        points = self.points()
+        for point in points:
+            self.check(point, self.geocoder.lookup(*point))
+        self.assertIsNone(self.geocoder.lookup(41.3801, 2.175,
+                                               max_distance=10))
+        self.assertIsNone(self.geocoder.lookup(42.0, 3.0))
+
+    def test_lookup_many(self):
+        points = self.points()
+        batch_size, geocode.BATCH_SIZE = geocode.BATCH_SIZE, 7
+        try:
+            results = self.geocoder.lookup_many(points)
+        finally:
+            geocode.BATCH_SIZE = batch_size
+        self.assertEqual(len(results), len(points))
+        for point, result in zip(points, results):
+            self.check(point, result)
+        self.assertTrue(any(result is None for result in results))
+        self.assertEqual(self.geocoder.lookup_many([]), [])
+
+    def test_parse_args(self):
+        argv = sys.argv
+        try:
+            sys.argv = ['geocode.py', '41.38', '2.17']
+            self.assertEqual(geocode.parse_args().point, [41.38, 2.17])
+            for point in (['41.38'], ['41.38', '2.17', '3']):
+                sys.argv = ['geocode.py'] + point
+                with quiet_stderr(), self.assertRaises(SystemExit):
+                    geocode.parse_args()
+        finally:
+            sys.argv = argv
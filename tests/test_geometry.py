@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import os
+
+import geometry
+import to_csv
+import to_sql
+from tests.test_stats import quiet
+from tests.util import RunTestCase
+
+NODE = '<node id="{}" lat="{}" lon="{}" version="1" ' \
+    'timestamp="2017-02-12T10:11:12Z" changeset="1" uid="1" user="a"/>\n'
+WAY = '<way id="{}" version="1" timestamp="2017-02-12T10:11:12Z" ' \
+    'changeset="1" uid="1" user="a">{}</way>\n'
+
+
+def osm(*elements):
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6">\n' + \
+        ''.join(elements) + '</osm>\n'
+
+
+def way(way_id, refs):
+    return WAY.format(way_id, ''.join('<nd ref="{}"/>'.format(ref)
+                                      for ref in refs))
+
+
+class NodeIndexTest(RunTestCase):
+
+    def test_unsorted_ids(self):
+        index = geometry.NodeIndex()
+        nodes = [(5, 41.5, 2.5), (1, 41.1, 2.1), (3, 41.3, 2.3),
+                 (2, 41.2, 2.2)]
+        for node in nodes:
+            index.add(*node)
+        index.freeze()
+        self.assertEqual(list(index.ids), [1, 2, 3, 5])
+        for node_id, lat, lon in nodes:
+            self.assertEqual(index.get(node_id), (lat, lon))
+        self.assertIsNone(index.get(4))
+        index.remove()
+        self.assertEqual(os.listdir('data'), [])
+
+    def test_sort_blocks(self):
+        index = geometry.NodeIndex()
+        ids = range(1000, 0, -1)
+        for node_id in ids:
+            index.add(node_id, node_id / 1e4, -node_id / 1e4)
+        sort_block, geometry.SORT_BLOCK = geometry.SORT_BLOCK, 7
+        try:
+            index.freeze()
+        finally:
+            geometry.SORT_BLOCK = sort_block
+        self.assertEqual(list(index.ids), sorted(ids))
+        self.assertEqual(index.get(123), (0.0123, -0.0123))
+        index.remove()
+
+    def test_node_after_way(self):
+        with open('data/late.osm', 'w') as f:
+            f.write(osm(NODE.format(1, 41.1, 2.1), NODE.format(2, 41.2, 2.2),
+                        way(10, [1, 2]), NODE.format(3, 41.3, 2.3),
+                        way(11, [2, 3])))
+        with quiet():
+            to_sql.load_map('data/late.osm', validate=False)
+        self.assertEqual(self.query('SELECT id FROM node ORDER BY id;'),
+                         [(1,), (2,), (3,)])
+        self.assertEqual(self.query(
+            'SELECT id, missing FROM way_geometry ORDER BY id;'),
+            [(10, 0), (11, 1)])
+        self.assertFalse(os.path.exists(geometry.NODE_INDEX_PATH + '.ids'))
+        self.assertFalse(os.path.exists(geometry.NODE_INDEX_PATH +
+                                        '.coords'))
+
+    def test_index_removed(self):
+        with open('data/small.osm', 'w') as f:
+            f.write(osm(NODE.format(2, 41.2, 2.2), NODE.format(1, 41.1, 2.1),
+                        way(10, [1, 2])))
+        with quiet():
+            to_csv.process_map('data/small.osm', validate=False)
+        self.assertEqual(sorted(os.listdir('data')),
+                         sorted(os.path.basename(path) for path in
+                                to_csv.CSV_PATHS.values() + ['small.osm']))
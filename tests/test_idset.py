@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import random
+import unittest
+
+import idset
+
+
+class IdSetTest(unittest.TestCase):
+
+    def test_same_as_set(self):
+        rnd = random.Random(0)
+        ids, expected = idset.IdSet(), set()
+        for _ in range(20000):
+            i = rnd.randint(0, 3 * idset.CHUNK_BITS)
+            self.assertEqual(ids.add(i), i not in expected)
+            expected.add(i)
+        self.assertEqual(len(ids), len(expected))
+        self.assertEqual(ids.duplicates, 20000 - len(expected))
+        for i in range(3 * idset.CHUNK_BITS + 1):
+            self.assertEqual(i in ids, i in expected)
+
+    # A chunk turns into a bitmap once it has more than SPARSE_MAX ids
+    def test_dense_chunk(self):
+        ids = idset.IdSet()
+        for i in range(idset.SPARSE_MAX, 0, -1):
+            ids.add(2 * i)
+        self.assertEqual(ids.nbytes(), 2 * idset.SPARSE_MAX)
+        self.assertEqual(ids.out_of_order, idset.SPARSE_MAX - 1)
+        self.assertTrue(ids.add(1))
+        self.assertFalse(ids.add(2))
+        self.assertEqual(ids.nbytes(), idset.CHUNK_BITS >> 3)
+        self.assertEqual(len(ids), idset.SPARSE_MAX + 1)
+        self.assertEqual([i for i in range(10) if i in ids], [1, 2, 4, 6, 8])
+
+    # Scattered ids take 2 bytes each instead of a bitmap per id
+    def test_scattered(self):
+        ids = idset.IdSet()
+        for i in range(1000):
+            ids.add(i * 100 * idset.CHUNK_BITS + 7)
+        self.assertEqual(len(ids.chunks), 1000)
+        self.assertEqual(ids.nbytes(), 2000)
+        self.assertIn(7, ids)
+        self.assertNotIn(8, ids)
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import json
+
+import metrics
+import to_sql
+from tests.test_stats import quiet
+from tests.util import RunTestCase, fixture
+
+STREETS = fixture('streets.osm')
+
+
+class InstrumentTest(RunTestCase):
+
+    def stages(self, parser):
+        with quiet():
+            with metrics.instrument(STREETS):
+                to_sql.load_map(STREETS, validate=False, csv_out=True,
+                                parser=parser)
+        with open(metrics.METRICS_PATH) as f:
+            report = json.load(f)
+        self.assertEqual(report['elements'], 8)
+        return report['stages']
+
+    def test_load_map(self):
+        stages = self.stages('etree')
+        for stage in ('get_element', 'shape_element', 'fix.get_tags',
+                      'write_batch:node_tags', 'insert_batch:node_tags',
+                      'insert_batch:way_nodes'):
+            self.assertIn(stage, stages)
+
+    def test_load_map_expat(self):
+        stages = self.stages('expat')
+        for stage in ('sax.shape_elements', 'write_batch:node',
+                      'insert_batch:relation_members'):
+            self.assertIn(stage, stages)
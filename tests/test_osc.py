@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import shutil
+import sqlite3
+
+import address
+import osc
+import stats
+import to_sql
+from tests.test_stats import STREETS, quiet
+from tests.util import RunTestCase, fixture
+
+CHANGE = fixture('change.osc')
+
+
+class ApplyChangeTest(RunTestCase):
+
+    def setUp(self):
+        super(ApplyChangeTest, self).setUp()
+        with quiet():
+            to_sql.load_map(STREETS, validate=False)
+
+    def apply(self, sequence=1, **kwargs):
+        with quiet():
+            return osc.apply_change(CHANGE, sequence, **kwargs)
+
+    def test_iter_changes(self):
+        self.assertEqual(
+            [(action, el.tag, el.get('id'), len(el))
+             for action, el in osc.iter_changes(CHANGE)],
+            [('modify', 'node', '5', 2), ('create', 'node', '7', 0),
+             ('create', 'way', '11', 3), ('delete', 'relation', '20', 0),
+             ('delete', 'node', '4', 0)])
+
+    def test_apply(self):
+        counts = self.apply(timestamp='2017-09-12T10:00:00Z')
+        self.assertEqual(counts[('create', 'way')], 1)
+        self.assertEqual(counts[('delete', 'node')], 1)
+        self.assertEqual(self.query('SELECT id FROM node;'),
+                         [(1,), (2,), (3,), (5,), (6,), (7,)])
+        self.assertEqual(self.query('SELECT version FROM node WHERE id = 5;'),
+                         [(u'2',)])
+        self.assertEqual(self.query(
+            "SELECT value FROM node_tags WHERE id = 5 AND key = 'street';"),
+            [('Carrer Nueva',)])
+        self.assertEqual(self.query('SELECT id FROM relation;'), [])
+        self.assertEqual(self.query('SELECT * FROM relation_members;'), [])
+        self.assertEqual(self.query(
+            'SELECT id, missing, min_lat, max_lat FROM way_geometry '
+            'ORDER BY id;'),
+            [(10, 0, 41.3851, 41.3853), (11, 0, 41.3857, 41.386)])
+        self.assertEqual(self.query(
+            'SELECT id FROM way_rtree WHERE min_lat > 41.3855;'), [(11,)])
+        self.assertEqual(self.query(
+            'SELECT sequence, timestamp FROM replication_state;'),
+            [(1, '2017-09-12T10:00:00Z')])
+
+        conn = sqlite3.connect(to_sql.SQLITE_FILE)
+        try:
+            self.assertEqual([r['id'] for r in address.search(
+                conn, 'carrer nueva 12')], [5])
+            self.assertEqual(address.search(conn, 'aragó'), [])
+        finally:
+            conn.close()
+
+    # The summary tables osc.py updates are the ones a full build gives
+    def test_stats(self):
+        self.apply()
+        shutil.copy(to_sql.SQLITE_FILE, 'data/rebuilt.db')
+        conn = sqlite3.connect('data/rebuilt.db')
+        try:
+            stats.build_tables(conn)
+        finally:
+            conn.close()
+        for table in to_sql.STATS_TABLES:
+            statement = 'SELECT * FROM {} ORDER BY 1, 2, 3;'.format(table)
+            conn = sqlite3.connect('data/rebuilt.db')
+            try:
+                expected = conn.execute(statement).fetchall()
+            finally:
+                conn.close()
+            self.assertEqual(self.query(statement), expected)
+
+    def test_old_sequence(self):
+        self.apply(sequence=5)
+        with self.assertRaises(ValueError):
+            self.apply(sequence=5)
+        self.assertEqual(self.query(
+            'SELECT sequence FROM replication_state;'), [(5,)])
+
+    def test_rollback(self):
+        self.apply(sequence=1)
+        with open('data/broken.osc', 'w') as f:
+            f.write(open(CHANGE).read().replace('<nd ref="7"/>', '<nd/>'))
+        with self.assertRaises(KeyError):
+            with quiet():
+                osc.apply_change('data/broken.osc', 2)
+        self.assertEqual(self.query(
+            'SELECT sequence FROM replication_state;'), [(1,)])
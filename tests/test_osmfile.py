@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import bz2
+import random
+
+import osmfile
+from tests.util import RunTestCase
+
+
+def osm_text(n, seed=0):
+    rnd = random.Random(seed)
+    return ''.join('<node id="%d" lat="%.7f" lon="%.7f"/>\n' % (
+        i, rnd.uniform(41, 42), rnd.uniform(2, 3)) for i in range(n))
+
+
+class Bz2Test(RunTestCase):
+
+    def setUp(self):
+        super(Bz2Test, self).setUp()
+        self.settings = (osmfile.READ_SIZE, osmfile.BZ2_CHUNK_SIZE,
+                         osmfile.BZ2_MAX_OUTPUT)
+        osmfile.READ_SIZE = 4096
+        osmfile.BZ2_CHUNK_SIZE = 16 * 1024
+        osmfile.BZ2_MAX_OUTPUT = 256 * 1024
+
+    def tearDown(self):
+        (osmfile.READ_SIZE, osmfile.BZ2_CHUNK_SIZE,
+         osmfile.BZ2_MAX_OUTPUT) = self.settings
+        super(Bz2Test, self).tearDown()
+
+    # write() compresses each of texts as a bzip2 stream of path, in blocks
+    # of 100k so that a stream is decompressed in several pieces
+    def write(self, path, texts):
+        with open(path, 'wb') as f:
+            for text in texts:
+                f.write(bz2.compress(text, 1))
+
+    def read(self, path, workers):
+        with osmfile.open_osm(path, workers) as f:
+            return f.read()
+
+    def test_multistream(self):
+        texts = [osm_text(300, seed) for seed in range(20)]
+        self.write('data/multi.osm.bz2', texts)
+        chunks = list(osmfile.find_bz2_chunks('data/multi.osm.bz2',
+                                              osmfile.BZ2_CHUNK_SIZE))
+        self.assertGreater(len(chunks), 2)
+        for start, end in chunks:
+            self.assertLessEqual(end - start, osmfile.BZ2_CHUNK_SIZE)
+        self.assertEqual(self.read('data/multi.osm.bz2', 1), ''.join(texts))
+        self.assertEqual(self.read('data/multi.osm.bz2', 2), ''.join(texts))
+
+    # A single stream larger than BZ2_CHUNK_SIZE is decompressed by the
+    # parent as it is read, not in one piece by a worker
+    def test_single_stream(self):
+        text = osm_text(10000)
+        self.write('data/single.osm.bz2', [text])
+        self.assertEqual(list(osmfile.find_bz2_chunks(
+            'data/single.osm.bz2', osmfile.BZ2_CHUNK_SIZE)),
+            [(0, len(bz2.compress(text, 1)))])
+        blocks = list(osmfile.map_bz2('data/single.osm.bz2', 2))
+        self.assertEqual(''.join(blocks), text)
+        self.assertGreater(len(blocks), 1)
+        self.assertLess(max(len(block) for block in blocks), len(text) / 4)
+
+    # A range that decompresses to more than BZ2_MAX_OUTPUT, and the ranges
+    # after it, are decompressed by the parent too
+    def test_max_output(self):
+        texts = [osm_text(100, seed) for seed in range(10)] + \
+            ['\n' * 1000000] + [osm_text(100, seed) for seed in range(3)]
+        self.write('data/large.osm.bz2', texts)
+        start, end = list(osmfile.find_bz2_chunks(
+            'data/large.osm.bz2', osmfile.BZ2_CHUNK_SIZE))[-1]
+        self.assertIsNone(osmfile.decompress_chunk(('data/large.osm.bz2',
+                                                    start, end)))
+        self.assertEqual(self.read('data/large.osm.bz2', 2), ''.join(texts))
+
+    # A stream header inside the compressed data splits a range in the
+    # middle of a stream
+    def test_false_boundary(self):
+        texts = [osm_text(300, seed) for seed in range(8)]
+        self.write('data/false.osm.bz2', texts)
+        with open('data/false.osm.bz2', 'rb') as f:
+            data = f.read()
+        chunks = osmfile.find_bz2_chunks
+        osmfile.find_bz2_chunks = lambda path, size: iter(
+            [(0, 100), (100, len(data) // 2), (len(data) // 2, len(data))])
+        try:
+            self.assertEqual(self.read('data/false.osm.bz2', 2),
+                             ''.join(texts))
+        finally:
+            osmfile.find_bz2_chunks = chunks
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import tempfile
+
+import parallel
+import to_csv
+from tests.test_stats import quiet
+from tests.util import RunTestCase, fixture
+
+STREETS = fixture('streets.osm')
+
+
+class MapChunksTest(RunTestCase):
+
+    def test_same_rows_as_serial(self):
+        with quiet():
+            to_csv.process_map(STREETS, validate=False)
+        serial = {}
+        for table, path in to_csv.CSV_PATHS.iteritems():
+            with open(path, 'rb') as f:
+                serial[table] = f.read().split('\r\n', 1)[1]
+
+        # Many more chunks than the 2 per worker sent ahead
+        chunks = parallel.find_chunks(STREETS, 2, chunk_size=200)
+        self.assertGreater(len(chunks), 4)
+        tmp_dir = tempfile.mkdtemp(dir='data')
+        chunked = dict((table, '') for table in to_csv.CSV_PATHS)
+        for paths, _, _ in parallel.map_chunks(STREETS, chunks, False, 2,
+                                               tmp_dir):
+            for table, path in paths.iteritems():
+                with open(path, 'rb') as f:
+                    chunked[table] += f.read()
+
+        # The way geometries are resolved by the consumer, see
+        # geometry.chunk_geometry()
+        del serial['way_geometry'], chunked['way_geometry']
+        self.assertEqual(chunked, serial)
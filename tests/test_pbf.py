@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+import calendar
+import struct
+import time
+import xml.etree.cElementTree as ET
+import zlib
+
+import pbf
+import to_csv
+from tests.util import RunTestCase, fixture
+
+STREETS = fixture('streets.osm')
+
+
+# A small .osm.pbf encoder, for the fields pbf.py reads
+
+def varint(n):
+    if n < 0:
+        n += 1 << 64
+    out = bytearray()
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return str(out)
+
+
+def zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def number(field, value):
+    return varint(field << 3) + varint(value)
+
+
+def message(field, data):
+    return varint(field << 3 | 2) + varint(len(data)) + data
+
+
+def packed(values):
+    return ''.join(varint(v) for v in values)
+
+
+def deltas(values):
+    previous = 0
+    result = []
+    for value in values:
+        result.append(zigzag(value - previous))
+        previous = value
+    return result
+
+
+def timestamp(text):
+    return calendar.timegm(time.strptime(text, pbf.TIMESTAMP_FORMAT))
+
+
+class Strings(object):
+
+    def __init__(self):
+        self.strings = ['']
+        self.ids = {'': 0}
+
+    def __call__(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        if text not in self.ids:
+            self.ids[text] = len(self.strings)
+            self.strings.append(text)
+        return self.ids[text]
+
+    def table(self):
+        return message(1, ''.join(message(1, s) for s in self.strings))
+
+
+# dense_info() takes the info arrays to write, a subset of INFO_FIELDS
+INFO_FIELDS = ['version', 'timestamp', 'changeset', 'uid', 'user']
+
+
+def dense_nodes(nodes, strings, info_fields=INFO_FIELDS):
+    ids = [int(n.get('id')) for n in nodes]
+    lats = [int(round(float(n.get('lat')) * 1e7)) for n in nodes]
+    lons = [int(round(float(n.get('lon')) * 1e7)) for n in nodes]
+    keys_vals = []
+    for n in nodes:
+        for tag in n.findall('tag'):
+            keys_vals += [strings(tag.get('k')), strings(tag.get('v'))]
+        keys_vals.append(0)
+
+    arrays = {
+        'version': [int(n.get('version')) for n in nodes],
+        'timestamp': deltas([timestamp(n.get('timestamp')) for n in nodes]),
+        'changeset': deltas([int(n.get('changeset')) for n in nodes]),
+        'uid': deltas([int(n.get('uid')) for n in nodes]),
+        'user': deltas([strings(n.get('user')) for n in nodes]),
+    }
+    info = ''.join(message(INFO_FIELDS.index(name) + 1, packed(arrays[name]))
+                   for name in INFO_FIELDS if name in info_fields)
+    dense = (message(1, packed(deltas(ids))) + message(5, info) +
+             message(8, packed(deltas(lats))) +
+             message(9, packed(deltas(lons))) + message(10, packed(keys_vals)))
+    return message(2, dense)
+
+
+def info(el, strings):
+    return message(4, number(1, int(el.get('version'))) +
+                   number(2, timestamp(el.get('timestamp'))) +
+                   number(3, int(el.get('changeset'))) +
+                   number(4, int(el.get('uid'))) +
+                   number(5, strings(el.get('user'))))
+
+
+def tags(el, strings):
+    tags = el.findall('tag')
+    return (message(2, packed(strings(t.get('k')) for t in tags)) +
+            message(3, packed(strings(t.get('v')) for t in tags)))
+
+
+def way(el, strings):
+    refs = [int(nd.get('ref')) for nd in el.findall('nd')]
+    return message(3, number(1, int(el.get('id'))) + tags(el, strings) +
+                   info(el, strings) + message(8, packed(deltas(refs))))
+
+
+def relation(el, strings):
+    members = el.findall('member')
+    return message(4, number(1, int(el.get('id'))) + tags(el, strings) +
+                   info(el, strings) +
+                   message(8, packed(strings(m.get('role'))
+                                     for m in members)) +
+                   message(9, packed(deltas([int(m.get('ref'))
+                                             for m in members]))) +
+                   message(10, packed(pbf.MEMBER_TYPES.index(m.get('type'))
+                                      for m in members)))
+
+
+def blob(blob_type, data):
+    body = number(2, len(data)) + message(3, zlib.compress(data))
+    header = message(1, blob_type) + number(3, len(body))
+    return struct.pack('>I', len(header)) + header + body
+
+
+def write_pbf(path, groups, strings):
+    header = message(4, 'OsmSchema-V0.6') + message(4, 'DenseNodes')
+    block = strings.table() + ''.join(message(2, group) for group in groups)
+    with open(path, 'wb') as f:
+        f.write(blob('OSMHeader', header))
+        f.write(blob('OSMData', block))
+
+
+# elements() reads a file as (tag, attrib, children) tuples. The children of
+# a relation of an XML file are streamed, see to_csv.StreamedElement.
+def elements(path):
+    return [(el.tag, el.attrib, [(child.tag, child.attrib)
+                                 for child in el.iter() if child is not el])
+            for el in to_csv.get_element(path)]
+
+
+class PbfTest(RunTestCase):
+
+    def setUp(self):
+        super(PbfTest, self).setUp()
+        self.xml = list(ET.parse(STREETS).getroot())
+        self.nodes = [el for el in self.xml if el.tag == 'node']
+
+    def write(self, groups, strings):
+        write_pbf('data/streets.osm.pbf', groups, strings)
+        return elements('data/streets.osm.pbf')
+
+    def test_same_elements_as_xml(self):
+        strings = Strings()
+        groups = [dense_nodes(self.nodes, strings)]
+        groups.append(''.join(way(el, strings) for el in self.xml
+                              if el.tag == 'way'))
+        groups.append(''.join(relation(el, strings) for el in self.xml
+                              if el.tag == 'relation'))
+        self.assertEqual(self.write(groups, strings), elements(STREETS))
+
+    def test_dense_nodes_without_user_info(self):
+        strings = Strings()
+        result = self.write([dense_nodes(self.nodes, strings,
+                                         ['version', 'timestamp'])], strings)
+        self.assertEqual(len(result), len(self.nodes))
+        for (tag, attrib, children), el in zip(result, self.nodes):
+            self.assertEqual(attrib, dict((k, el.get(k)) for k in (
+                'id', 'lat', 'lon', 'version', 'timestamp')))
+            self.assertEqual(children, [(t.tag, t.attrib) for t in el])
+
+    def test_dense_nodes_without_user_sids(self):
+        strings = Strings()
+        result = self.write([dense_nodes(self.nodes, strings,
+                                         INFO_FIELDS[:4])], strings)
+        self.assertEqual([(a['uid'], a['user']) for _, a, _ in result],
+                         [(el.get('uid'), '') for el in self.nodes])
+
+    def test_dense_nodes_with_short_column(self):
+        strings = Strings()
+        group = dense_nodes(self.nodes, strings, [])
+        # An extra id, without coordinates
+        group = group.replace(
+            message(1, packed(deltas([int(n.get('id'))
+                                      for n in self.nodes]))),
+            message(1, packed(deltas([int(n.get('id'))
+                                      for n in self.nodes] + [99]))))
+        write_pbf('data/short.osm.pbf', [group], strings)
+        self.assertRaises(ValueError, elements, 'data/short.osm.pbf')
+
+    def test_info_without_uid(self):
+        strings = Strings()
+        el = self.xml[-1]
+        data = (number(1, int(el.get('id'))) +
+                message(4, number(1, 3) + number(2, timestamp(
+                    el.get('timestamp')))))
+        (_, attrib, _), = self.write([message(4, data)], strings)
+        self.assertEqual(attrib, {'id': el.get('id'), 'version': '3',
+                                  'timestamp': el.get('timestamp')})
+
+    def test_anonymous_info(self):
+        strings = Strings()
+        data = number(1, 7) + message(4, number(1, 1) + number(4, -1))
+        (_, attrib, _), = self.write([message(4, data)], strings)
+        self.assertEqual(attrib, {'id': '7', 'version': '1'})
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import itertools
+
+import sax
+import to_csv
+from tests.util import RunTestCase, fixture
+
+# Entities in attributes and tag values, non-ASCII text and relations with
+# members of every type
+SAX = fixture('sax.osm')
+
+NODE_TAGS = [
+    [],
+    [('2', 'name', 'Bar "La Plaça" <&> és', 'regular'),
+     ('2', 'ca', "L'Eixample", 'name'),
+     ('2', 'amenity', 'bar', 'regular')],
+    [('3', 'street', 'Passeig de Gràcia', 'addr'),
+     ('3', 'housenumber', '92', 'addr'),
+     ('3', 'note', '日本語 & català', 'regular')],
+]
+
+RELATION_MEMBERS = [
+    [('20', '10', 'way', 'outer', 0),
+     ('20', '3', 'node', 'entrada & sortida', 1),
+     ('20', '2', 'node', 'façana', 2)],
+    [('21', '20', 'relation', '', 0)],
+]
+
+CHILDREN = ('tag', 'nd', 'member')
+
+
+def etree_elements(osm_file):
+    return [sax.written(to_csv.shape_element(element))
+            for element in to_csv.get_element(osm_file)]
+
+
+def expat_elements(osm_file):
+    return [sax.written(el) for el in sax.shape_elements(osm_file)]
+
+
+class ShapeElementsTest(RunTestCase):
+
+    def setUp(self):
+        super(ShapeElementsTest, self).setUp()
+        self.block_size = sax.BLOCK_SIZE
+
+    def tearDown(self):
+        sax.BLOCK_SIZE = self.block_size
+        super(ShapeElementsTest, self).tearDown()
+
+    def test_values(self):
+        elements = expat_elements(SAX)
+        self.assertEqual([el['node_tags'] for el in elements[:3]], NODE_TAGS)
+        self.assertEqual([el['node'][0][3] for el in elements[:3]],
+                         ['josé', 'Tom & Jerry', 'núria'])
+        self.assertEqual(elements[3]['way_nodes'],
+                         [('10', '1', 0), ('10', '2', 1), ('10', '3', 2)])
+        self.assertEqual([el['relation_members'] for el in elements[4:]],
+                         RELATION_MEMBERS)
+        self.assertEqual(elements[4]['relation_tags'],
+                         [('20', 'type', 'multipolygon', 'regular'),
+                          ('20', 'name', 'Illa Güell', 'regular')])
+
+    def test_same_as_etree(self):
+        self.assertEqual(expat_elements(SAX), etree_elements(SAX))
+        self.assertEqual(sax.compare(SAX), 6)
+
+    # Small blocks split the tags, entities and multi-byte characters over
+    # blocks, and the relations are streamed over several of them
+    def test_small_blocks(self):
+        expected = etree_elements(SAX)
+        for block_size in (1, 7, 64):
+            sax.BLOCK_SIZE = block_size
+            self.assertEqual(expat_elements(SAX), expected)
+
+    # The rows of a relation the consumer did not read are skipped, and do
+    # not end up in the next element
+    def test_skip_relation_rows(self):
+        sax.BLOCK_SIZE = 16
+        elements = list(sax.shape_elements(SAX))
+        self.assertEqual([list(el.get('relation_members', ()))
+                          for el in elements[4:]], [[], []])
+
+        elements = sax.shape_elements(SAX)
+        list(itertools.islice(elements, 4))
+        first = next(elements)
+        self.assertEqual(sax.encode(next(first['relation_members'])),
+                         RELATION_MEMBERS[0][0])
+        second = next(elements)
+        self.assertEqual(sax.written(second)['relation_members'],
+                         RELATION_MEMBERS[1])
+
+    # The audit checks get the same elements as from to_csv.get_element()
+    def test_iter_elements(self):
+        self.assertEqual(
+            [(el.tag, el.attrib, [(child.tag, child.attrib)
+                                  for child in el.children])
+             for el in sax.iter_elements(SAX)],
+            [(el.tag, dict(el.attrib), [(child.tag, dict(child.attrib))
+                                        for child in el.iter()
+                                        if child.tag in CHILDREN])
+             for el in to_csv.get_element(SAX)])
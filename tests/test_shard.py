@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+
+import shard
+import spatial
+import to_sql
+from tests.test_stats import STREETS, quiet
+from tests.util import RunTestCase
+
+# The nodes of streets.osm, on a line across the grid
+EXTENT = (41.3851, 2.1734, 41.3856, 2.1744)
+
+
+class ShardTest(RunTestCase):
+
+    def setUp(self):
+        super(ShardTest, self).setUp()
+        with quiet():
+            to_sql.load_map(STREETS, validate=False)
+
+    def build(self, **kwargs):
+        with quiet():
+            shard.build(grid=(3, 3), **kwargs)
+        return shard.load_manifest()['shards']
+
+    def test_data_extent(self):
+        shards = self.build()
+        self.assertEqual([s['tile'] for s in shards],
+                         [[0, 0], [1, 1], [2, 2]])
+        self.assertEqual(sum(s['nodes'] for s in shards), 6)
+        self.assertEqual(sum(s['ways'] for s in shards), 1)
+
+    def test_fixed_bbox(self):
+        shards = self.build(bbox=(41.0, 1.6, 41.8, 2.5))
+        self.assertEqual(len(shards), 1)
+        self.assertEqual(shards[0]['nodes'], 6)
+
+    def spatial_bbox(self, box):
+        conn = sqlite3.connect(to_sql.SQLITE_FILE)
+        conn.text_factory = str
+        try:
+            return spatial.bbox(conn, *box)
+        finally:
+            conn.close()
+
+    def test_bbox(self):
+        self.build()
+        expected = self.spatial_bbox(EXTENT)
+        self.assertEqual(len(expected), 7)
+        self.assertEqual(shard.bbox(*EXTENT), expected)
+
+    # tagged() gives the elements of spatial.bbox() with the tag, plain or
+    # prefixed ("addr:street" for "street")
+    def test_tagged(self):
+        self.build()
+
+        def expected(key, value=None, box=EXTENT):
+            return [el for el in self.spatial_bbox(box)
+                    if any(k.split(':')[-1] == key and
+                           value in (None, v) for k, v in
+                           el['tags'].iteritems())]
+
+        elements = shard.tagged('street')
+        self.assertEqual([(el['type'], el['id']) for el in elements],
+                         [('node', i) for i in range(1, 7)] + [('way', 10)])
+        self.assertEqual(elements, expected('street'))
+        self.assertEqual(shard.tagged('street', 'Carrer Mayor'),
+                         expected('street', 'Carrer Mayor'))
+        self.assertEqual(len(shard.tagged('street', 'Carrer Mayor')), 1)
+        self.assertEqual(shard.tagged('highway', types=('way',)),
+                         expected('highway'))
+        self.assertEqual(shard.tagged('street', 'Nowhere'), [])
+
+    def test_tagged_box(self):
+        self.build()
+        for box, ids in (((41.385, 2.173, 41.3853, 2.1738),
+                          [('node', 1), ('node', 2), ('node', 3),
+                           ('way', 10)]),
+                         ((41.3855, 2.1741, 41.3857, 2.175),
+                          [('node', 5), ('node', 6)]),
+                         ((41.0, 2.0, 41.1, 2.1), [])):
+            elements = shard.tagged('street', box=box)
+            self.assertEqual([(el['type'], el['id']) for el in elements], ids)
+            self.assertEqual(elements, [
+                el for el in self.spatial_bbox(box)
+                if 'addr:street' in el['tags']])
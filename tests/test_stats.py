@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+import contextlib
+import os
+import sys
+from StringIO import StringIO
+
+import fix
+import to_csv
+import to_sql
+from tests.util import RunTestCase, fixture
+
+STREETS = fixture('streets.osm')
+
+# addr:street counts of streets.osm: "camino de la Font" is fixed to the
+# utf-8 str "Camí de la Font" of fix.LANG_MAPPING and counted with the
+# unicode "Camí de la Font" of node 6
+STREET_STATS = [
+    (u'Accés Nord', 1, 0, 0),
+    (u'Avinguda Diagonal', 0, 0, 1),
+    (u'Camí de la Font', 2, 1, 0),
+    (u'Carrer Mayor', 1, 0, 0),
+    (u"Carrer d'Aragó", 1, 0, 0),
+    (u'Plaça de Sant Jaume', 1, 0, 0),
+]
+
+# fix.STREETS counters of the 8 addr:street values of streets.osm
+STREET_FIXES = {'lang': 6, 'case': 1, 'uncaught': 1}
+
+STREET_SUMMARY = [
+    "streets: 8 addr:street values, %s cache hits, case 1, lang 6, "
+    "uncaught 1",
+    "streets: uncaught types Cam\xc3\xad 1",
+]
+
+USER_STATS = [(101, u'josé', 2, 0, 1), (102, u'núria', 1, 1, 0),
+              (103, u'anna', 3, 0, 0)]
+
+
+@contextlib.contextmanager
+def quiet():
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+class TagStatsTest(RunTestCase):
+
+    def check_stats(self):
+        self.assertEqual(self.query(
+            "SELECT value, nodes, ways, relations FROM tag_stats "
+            "WHERE key = 'street' AND type = 'addr' ORDER BY value;"),
+            STREET_STATS)
+        self.assertEqual(self.query("SELECT * FROM user_stats ORDER BY uid;"),
+                         USER_STATS)
+
+    def test_load_map(self):
+        with quiet():
+            to_sql.load_map(STREETS, validate=False, csv_out=True)
+        self.check_stats()
+
+    def test_load_map_parallel(self):
+        with quiet():
+            to_sql.load_map(STREETS, validate=False, workers=2)
+        self.check_stats()
+
+    def test_csv(self):
+        with quiet():
+            to_csv.process_map(STREETS, validate=False)
+            to_sql.main()
+        self.check_stats()
+
+
+class StreetStatsTest(RunTestCase):
+
+    def summary(self, load):
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            load()
+            lines = sys.stdout.getvalue().splitlines()
+        finally:
+            sys.stdout = stdout
+        return [line for line in lines if line.startswith('streets:')]
+
+    # Starting from an empty cache the serial run has one hit, "camino de la
+    # Font" is there twice
+    def test_serial(self):
+        fix.STREETS.cache.clear()
+        summary = self.summary(
+            lambda: to_sql.load_map(STREETS, validate=False))
+        stats = fix.STREETS.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 7))
+        self.assertEqual(stats['fixes'], STREET_FIXES)
+        self.assertEqual(stats['uncaught'], {u'Cam\xed': 1})
+        self.assertEqual(summary, [STREET_SUMMARY[0] % '12.5%',
+                                   STREET_SUMMARY[1]])
+
+    # The counters of the workers add up to those of the serial run, and a
+    # second run starts from zero
+    def test_parallel(self):
+        for _ in range(2):
+            summary = self.summary(
+                lambda: to_csv.process_map(STREETS, validate=False,
+                                           workers=2))
+            stats = fix.STREETS.stats()
+            self.assertEqual(stats['hits'] + stats['misses'], 8)
+            self.assertEqual(stats['fixes'], STREET_FIXES)
+            self.assertEqual(stats['uncaught'], {u'Cam\xed': 1})
+            self.assertEqual(len(summary), 2)
+            self.assertEqual(summary[1], STREET_SUMMARY[1])
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+import collections
+
+import synthetic
+import to_csv
+from tests.test_stats import quiet
+from tests.util import RunTestCase
+
+
+class GenerateTest(RunTestCase):
+
+    def generate(self, **kwargs):
+        with quiet():
+            synthetic.generate(**kwargs)
+        counts = collections.Counter()
+        members = 0
+        for element in to_csv.get_element(synthetic.SYNTHETIC_FILE):
+            counts[element.tag] += 1
+            members += sum(1 for child in element.iter()
+                           if child.tag == 'member')
+        return counts, members
+
+    def test_counts(self):
+        counts, members = self.generate(nodes=50, ways=5, relations=2)
+        self.assertEqual(counts, {'node': 50, 'way': 5, 'relation': 2})
+        self.assertGreaterEqual(members, 4)
+
+    def test_no_ways(self):
+        counts, members = self.generate(nodes=50, ways=0, relations=2)
+        self.assertEqual(counts, {'node': 50, 'relation': 2})
+        self.assertEqual(members, 0)
+
+    def test_same_seed(self):
+        contents = []
+        for _ in range(2):
+            self.generate(nodes=30, seed=3)
+            with open(synthetic.SYNTHETIC_FILE) as f:
+                contents.append(f.read())
+        self.assertEqual(contents[0], contents[1])
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+# Small .osm fixtures of the tests
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+def fixture(name):
+    return os.path.join(DATA, name)
+
+
+class RunTestCase(unittest.TestCase):
+    """Runs each test in an empty directory with a data/ subdirectory, where
+    the modules write their csv files and database."""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp, 'data'))
+        os.chdir(self.tmp)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def query(self, statement, params=()):
+        conn = sqlite3.connect('data/bcn.db')
+        try:
+            return conn.execute(statement, params).fetchall()
+        finally:
+            conn.close()
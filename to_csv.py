@@ -1,144 +1,366 @@
 # -*- coding: utf-8 -*-
+import collections
 import csv
 import codecs
+import contextlib
+import itertools
 import pprint
 import re
 import xml.etree.cElementTree as ET
-import cerberus
 
+import checkpoint
 import fix
+import geometry
+import osmfile
+import parallel
+import pbf
+import records
+import sax
 import schema
+import validation
 
 NODES_PATH = "data/node.csv"
 NODE_TAGS_PATH = "data/node_tags.csv"
 WAYS_PATH = "data/way.csv"
 WAY_NODES_PATH = "data/way_nodes.csv"
 WAY_TAGS_PATH = "data/way_tags.csv"
+WAY_GEOMETRY_PATH = "data/way_geometry.csv"
+RELATIONS_PATH = "data/relation.csv"
+RELATION_MEMBERS_PATH = "data/relation_members.csv"
+RELATION_TAGS_PATH = "data/relation_tags.csv"
+QUARANTINE_PATH = "data/quarantine.jsonl"
 
 LOWER_COLON = re.compile(r'^([a-z]|_)+:([a-z]|_)+')
 PROBLEMCHARS = re.compile(r'[=\+/&<>;\'"\?%#$@\,\. \t\r\n]')
 
 SCHEMA = schema.schema
+VALIDATOR = validation.compile_schema(SCHEMA)
 
-NODE_FIELDS = ['id', 'lat', 'lon', 'user', 'uid', 'version', 'changeset',
-               'timestamp']
-NODE_TAGS_FIELDS = ['id', 'key', 'value', 'type']
-WAY_FIELDS = ['id', 'user', 'uid', 'version', 'changeset', 'timestamp']
-WAY_TAGS_FIELDS = ['id', 'key', 'value', 'type']
-WAY_NODES_FIELDS = ['id', 'node_id', 'position']
-
-
-def process_map(file_in, validate):
-    with codecs.open(NODES_PATH, 'w') as nodes_file, \
-         codecs.open(NODE_TAGS_PATH, 'w') as nodes_tags_file, \
-         codecs.open(WAYS_PATH, 'w') as ways_file, \
-         codecs.open(WAY_NODES_PATH, 'w') as way_nodes_file, \
-         codecs.open(WAY_TAGS_PATH, 'w') as way_tags_file:
-
-        nodes_writer = UnicodeDictWriter(nodes_file, NODE_FIELDS)
-        node_tags_writer = UnicodeDictWriter(nodes_tags_file, NODE_TAGS_FIELDS)
-        ways_writer = UnicodeDictWriter(ways_file, WAY_FIELDS)
-        way_nodes_writer = UnicodeDictWriter(way_nodes_file, WAY_NODES_FIELDS)
-        way_tags_writer = UnicodeDictWriter(way_tags_file, WAY_TAGS_FIELDS)
-
-        nodes_writer.writeheader()
-        node_tags_writer.writeheader()
-        ways_writer.writeheader()
-        way_nodes_writer.writeheader()
-        way_tags_writer.writeheader()
-
-        validator = cerberus.Validator()
-
-        for element in get_element(file_in, tags=('node', 'way')):
-            el = shape_element(element)
-            if el:
-                if validate is True:
-                    validate_element(el, validator)
-
-                if element.tag == 'node':
-                    nodes_writer.writerow(el['node'])
-                    node_tags_writer.writerows(el['node_tags'])
-                elif element.tag == 'way':
-                    ways_writer.writerow(el['way'])
-                    way_nodes_writer.writerows(el['way_nodes'])
-                    way_tags_writer.writerows(el['way_tags'])
+# Columns of each table, in the order of the fields of its record (see
+# records.py)
+NODE_FIELDS = list(records.Node._fields)
+NODE_TAGS_FIELDS = list(records.Tag._fields)
+WAY_FIELDS = list(records.Way._fields)
+WAY_TAGS_FIELDS = list(records.Tag._fields)
+WAY_NODES_FIELDS = list(records.WayNode._fields)
+RELATION_FIELDS = list(records.Relation._fields)
+RELATION_MEMBERS_FIELDS = list(records.Member._fields)
+RELATION_TAGS_FIELDS = list(records.Tag._fields)
+
+# Elements read from the .osm file
+ELEMENTS = ('node', 'way', 'relation')
+
+# Output tables, in the order the parts of an element are written
+TABLES = ['node', 'node_tags', 'way', 'way_nodes', 'way_tags', 'way_geometry',
+          'relation', 'relation_members', 'relation_tags']
+
+CSV_PATHS = {
+    'node': NODES_PATH,
+    'node_tags': NODE_TAGS_PATH,
+    'way': WAYS_PATH,
+    'way_nodes': WAY_NODES_PATH,
+    'way_tags': WAY_TAGS_PATH,
+    'way_geometry': WAY_GEOMETRY_PATH,
+    'relation': RELATIONS_PATH,
+    'relation_members': RELATION_MEMBERS_PATH,
+    'relation_tags': RELATION_TAGS_PATH
+}
+
+CSV_FIELDS = {
+    'node': NODE_FIELDS,
+    'node_tags': NODE_TAGS_FIELDS,
+    'way': WAY_FIELDS,
+    'way_nodes': WAY_NODES_FIELDS,
+    'way_tags': WAY_TAGS_FIELDS,
+    'way_geometry': geometry.WAY_GEOMETRY_FIELDS,
+    'relation': RELATION_FIELDS,
+    'relation_members': RELATION_MEMBERS_FIELDS,
+    'relation_tags': RELATION_TAGS_FIELDS
+}
+
+
+# With workers > 1 the file is split in byte ranges that are parsed in
+# parallel, see parallel.py. The output is the same as the serial run.
+# Compressed files cannot be split, so for them the workers decompress the
+# streams of a multistream .bz2 file instead, see osmfile.py, or decode the
+# blocks of a .osm.pbf file, see pbf.py. file_in can also be "-" (stdin) or
+# an open file, which are split in batches as they are read, see
+# parallel.map_stream().
+# With quarantine=True the elements that fail validation are written to
+# QUARANTINE_PATH instead of aborting the run.
+# parser picks the XML backend, see iter_shaped().
+# With checkpoints=True the progress is saved every few hundred MB of input,
+# and resume=True continues an interrupted run from its last checkpoint
+# instead of starting over, see checkpoint.py.
+def process_map(file_in, validate, workers=1, quarantine=False,
+                parser='etree', checkpoints=False, resume=False):
+    saved = checkpoint.Checkpoint(file_in, checkpoints, resume)
+    if saved.complete:
+        print "%s is already processed" % file_in
+        return
+
+    fix.STREETS.clear_stats()
+    if workers > 1 and parallel.is_parallel(file_in):
+        return parallel.process_map(file_in, validate, workers, quarantine,
+                                    parser, saved)
+
+    with open_writers(append=saved.resumed) as writers, \
+         validation.open_quarantine(QUARANTINE_PATH, quarantine,
+                                    count=saved.quarantined()) as rejected, \
+         contextlib.closing(saved.node_index()) as index:
+        saved.track(writers, rejected, index)
+
+        for el in saved.shaped(workers, parser):
+            if validate is True and not check_element(el, rejected):
+                continue
+
+            geometry.add_geometry(el, index)
+            write_element(writers, el)
+
+    saved.finish()
+    fix.STREETS.print_stats()
+
+
+# open_writers() opens one csv writer per table. paths maps each table to
+# its csv file, header=False leaves out the header row (used for the
+# partial files written by the parallel workers). append=True writes after
+# the rows already in the files, when resuming a run (see checkpoint.py).
+@contextlib.contextmanager
+def open_writers(paths=CSV_PATHS, header=True, append=False):
+    files = dict((table, codecs.open(path, 'a' if append else 'w'))
+                 for table, path in paths.iteritems())
+    try:
+        writers = dict((table, UnicodeWriter(f, CSV_FIELDS[table]))
+                       for table, f in files.iteritems())
+
+        if header and not append:
+            for writer in writers.values():
+                writer.writeheader()
+
+        yield writers
+    finally:
+        for f in files.values():
+            f.close()
+
+
+# write_element() sends each part of a shaped element to its csv writer;
+# node, way and relation are single rows, the rest are lists of rows (or
+# generators, for the members and tags of a relation, see stream_children())
+def write_element(writers, el):
+    for table in TABLES:
+        if table not in el:
+            continue
+        if table in ELEMENTS:
+            writers[table].writerow(el[table])
+        else:
+            writers[table].writerows(el[table])
 
 
 def shape_element(element,
                   node_attr_fields=NODE_FIELDS,
                   way_attr_fields=WAY_FIELDS,
+                  relation_attr_fields=RELATION_FIELDS,
                   problem_chars=PROBLEMCHARS,
                   default_tag_type='regular'):
 
-    nodes = {}
-    ways = {}
-    way_nodes = []
-    tags = []
-
     if element.tag == "node":
         # Map node attributes according to schema
-        nodes = fix.map_node(element, node_attr_fields)
+        node = fix.map_node(element, node_attr_fields)
         # Map node tags according to schema
-        tags = fix.get_tags(element, nodes["id"], PROBLEMCHARS, 'regular')
+        tags = fix.get_tags(element, node.id, PROBLEMCHARS, 'regular')
+        return {'node': node, 'node_tags': tags}
 
-    if element.tag == "way":
+    elif element.tag == "way":
         # Map way attributes according to schema
-        ways = fix.map_way(element, way_attr_fields)
+        way = fix.map_way(element, way_attr_fields)
         # Map way tags according to schema
-        tags = fix.get_tags(element, ways["id"], PROBLEMCHARS, 'regular')
+        tags = fix.get_tags(element, way.id, PROBLEMCHARS, 'regular')
 
         # WAY_NODES_FIELDS
-        i = 0
-        for nd in element.iter("nd"):
-            w = {}
+        # id maps to the top level way id attribute value, node_id to the
+        # ref attribute value of the nd tag and position to the index
+        # starting at 0 of the nd tag
+        way_nodes = [records.WayNode(way.id, nd.attrib["ref"], i)
+                     for i, nd in enumerate(element.iter("nd"))]
+        return {'way': way, 'way_nodes': way_nodes, 'way_tags': tags}
+
+    elif element.tag == "relation":
+        # Map relation attributes according to schema
+        relation = fix.map_relation(element, relation_attr_fields)
+        # Members and tags are streamed, a relation can have 100k members
+        members, tags = stream_children(element, relation.id,
+                                        problem_chars, default_tag_type)
+        return {'relation': relation, 'relation_members': members,
+                'relation_tags': tags}
+
 
-            # WAY_NODES_FIELDS[0]:id
-            # id maps to the top level way id attribute value
-            w["id"] = ways["id"]
+# stream_children() turns the children of a relation into two generators, of
+# its member rows and of its tag rows, reading the children only once and as
+# they are needed. Rows read ahead for the other generator are buffered, so
+# consuming the members first (see TABLES) keeps memory constant.
+def stream_children(element, unique_id, problem_chars, default_tag_type):
+    children = element.iter()
+    positions = itertools.count()
+    shape = {
+        'member': lambda m: fix.get_member(m, unique_id, next(positions)),
+        'tag': lambda t: fix.get_tag(t, unique_id, problem_chars,
+                                     default_tag_type)
+    }
+    pending = {'member': collections.deque(), 'tag': collections.deque()}
 
-            # WAY_NODES_FIELDS[1]:node_id
-            # node_id maps to the ref attribute value of the nd tag
-            w["node_id"] = nd.attrib["ref"]
+    def stream(tag):
+        while True:
+            if pending[tag]:
+                yield pending[tag].popleft()
+                continue
+            child = next(children, None)
+            if child is None:
+                return
+            if child.tag in shape:
+                pending[child.tag].append(shape[child.tag](child))
 
-            # WAY_NODES_FIELDS[2]:position
-            # position maps to the index starting at 0 of the nd tag
-            w["position"] = i
-            i += 1
-            way_nodes.append(w)
+    return stream('member'), stream('tag')
 
-    if element.tag == 'node':
-        return {'node': nodes, 'node_tags': tags}
-    elif element.tag == 'way':
-        return {'way': ways, 'way_nodes': way_nodes, 'way_tags': tags}
+
+# iter_shaped() yields the shaped elements of file_in. With parser='etree'
+# they are parsed by get_element() and shaped by shape_element(); with
+# parser='expat' they are shaped straight from the parser callbacks, without
+# building any ElementTree (see sax.py). Both give the same rows. .osm.pbf
+# files are always read by pbf.py.
+def iter_shaped(file_in, workers=1, parser='etree'):
+    if parser not in sax.PARSERS:
+        raise ValueError("unknown parser: {}".format(parser))
+
+    if parser == 'expat' and not osmfile.is_pbf(file_in):
+        for el in sax.shape_elements(file_in, workers):
+            yield el
+        return
+
+    for element in get_element(file_in, tags=ELEMENTS, workers=workers):
+        el = shape_element(element)
+        if el:
+            yield el
 
 
 # Helper Functions provided by Udacity
-def get_element(osm_file, tags=('node', 'way', 'relation')):
-    context = ET.iterparse(osm_file, events=('start', 'end'))
-    _, root = next(context)
-    for event, elem in context:
-        if event == 'end' and elem.tag in tags:
+# Relations are yielded as a StreamedElement as soon as their start tag is
+# read, nodes and ways once they have been fully parsed.
+# osm_file can also be a .bz2 or .gz file, see osmfile.open_osm(), or a
+# .osm.pbf file, see pbf.py.
+def get_element(osm_file, tags=('node', 'way', 'relation'), workers=1):
+    if osmfile.is_pbf(osm_file):
+        for elem in pbf.get_element(osm_file, tags, workers):
             yield elem
-            root.clear()
+        return
+
+    with osmfile.open_osm(osm_file, workers) as source:
+        context = ET.iterparse(source, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event == 'start' and elem.tag == 'relation' and \
+                    elem.tag in tags:
+                relation = StreamedElement(elem, context)
+                yield relation
+                # Skip whatever the consumer did not read
+                for _ in relation.iter():
+                    pass
+                root.clear()
+            elif event == 'end' and elem.tag in tags:
+                yield elem
+                root.clear()
+            elif event == 'end' and elem.tag in ELEMENTS:
+                root.clear()
+
+
+class StreamedElement(object):
+    """Element whose children are read from the parser as iter() goes.
+
+    Only the tag and attributes are kept; every child is dropped as soon as
+    the next one is read, so a relation with 100k members is never held in
+    memory as a whole. iter() can only go through the children once.
+    """
+
+    def __init__(self, elem, context):
+        self.tag = elem.tag
+        self.attrib = dict(elem.attrib)
+        self.elem = elem
+        self.context = context
+        self.done = False
+
+    def iter(self, tag=None):
+        while not self.done:
+            event, child = next(self.context)
+            if event != 'end':
+                continue
+            if child is self.elem:
+                self.done = True
+            elif tag is None or child.tag == tag:
+                yield child
+            del self.elem[:]
+
 
+# check_element() validates a shaped element. Without a quarantine the first
+# invalid element aborts the run, otherwise it is set aside in the quarantine
+# file and check_element() returns False so that it is not written.
+def check_element(el, quarantine=None):
+    if 'relation' in el and 'relation_members' in el:
+        return check_relation(el, quarantine)
 
-def validate_element(element, validator, schema=SCHEMA):
+    if quarantine is None:
+        validate_element(el)
+        return True
+
+    document = records.document(el)
+    errors = VALIDATOR(document)
+    if errors:
+        quarantine.add(document, errors)
+        return False
+    return True
+
+
+# The members and tags of a relation are streamed, so they are checked row by
+# row as they are written. Only the relation row is checked up front.
+def check_relation(el, quarantine):
+    if not check_element({'relation': el['relation']}, quarantine):
+        return False
+
+    for table in ('relation_members', 'relation_tags'):
+        el[table] = check_rows(table, el[table], quarantine)
+    return True
+
+
+def check_rows(table, rows, quarantine):
+    for row in rows:
+        if check_element({table: [row]}, quarantine):
+            yield row
+
+
+def validate_element(element, validator=VALIDATOR):
     """Raise ValidationError if element does not match schema"""
-    if validator.validate(element, schema) is not True:
-        field, errors = next(validator.errors.iteritems())
+    errors = validator(records.document(element))
+    if errors:
+        field, errors = next(errors.iteritems())
         message_string = "\nElement of type '{0}' has the following errors:\n{1}"
         error_string = pprint.pformat(errors)
 
         raise Exception(message_string.format(field, error_string))
 
 
-class UnicodeDictWriter(csv.DictWriter, object):
-    """Extend csv.DictWriter to handle Unicode input"""
+class UnicodeWriter(object):
+    """csv.writer for records (see records.py), encoding unicode values"""
+
+    def __init__(self, f, fieldnames, *args, **kwds):
+        self.writer = csv.writer(f, *args, **kwds)
+        self.fieldnames = fieldnames
+        # Kept to append already written csv data, see parallel.py
+        self.stream = f
+
+    def writeheader(self):
+        self.writer.writerow(self.fieldnames)
 
     def writerow(self, row):
-        super(UnicodeDictWriter, self).writerow({
-            k: (v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in row.iteritems()
-        })
+        self.writer.writerow([v.encode('utf-8') if isinstance(v, unicode)
+                              else v for v in row])
 
     def writerows(self, rows):
         for row in rows:
@@ -1,17 +1,69 @@
 # -*- coding: utf-8 -*-
+import itertools
+import os
+import shutil
 import sqlite3
 import csv
+import tempfile
+import time
 
+import address
+import checkpoint
+import fix
+import geometry
+import osmfile
+import parallel
+import records
+import spatial
+import stats
+import to_csv
+import validation
 
-def main():
-    sqlite_file = 'data/bcn.db'
-    conn = sqlite3.connect(sqlite_file)
-    conn.text_factory = str
+SQLITE_FILE = 'data/bcn.db'
 
-    cur = conn.cursor()
+# Number of rows buffered per table before they are sent to executemany()
+BATCH_SIZE = 10000
+
+# Pragmas used while bulk loading: no rollback journal, no fsync after every
+# transaction and a larger page cache (negative values are in KiB)
+BULK_PRAGMAS = ['PRAGMA journal_mode = OFF;',
+                'PRAGMA synchronous = OFF;',
+                'PRAGMA cache_size = -200000;',
+                'PRAGMA foreign_keys = OFF;']
+
+# Checkpointed loads (see checkpoint.py) need the rows of an interrupted
+# transaction to be rolled back, which a rollback journal does; the write
+# ahead log does it without slowing the load down
+CHECKPOINT_PRAGMAS = ['PRAGMA journal_mode = WAL;']
+
+TABLES = to_csv.TABLES
+
+# Summary tables, computed from the element tables once they are loaded,
+# see stats.py
+STATS_TABLES = ['tag_stats', 'user_stats']
+
+CSV_PATHS = to_csv.CSV_PATHS
+
+FIELDS = dict(to_csv.CSV_FIELDS,
+              tag_stats=list(records.TagStat._fields),
+              user_stats=list(records.UserStat._fields))
 
-    cur.execute('''
-        CREATE TABLE node (
+# Text columns that are read back from the csv files as utf-8 encoded bytes
+UTF8_FIELDS = {
+    'node': ['user'],
+    'node_tags': ['value'],
+    'way': ['user'],
+    'way_nodes': [],
+    'way_tags': ['value'],
+    'way_geometry': [],
+    'relation': ['user'],
+    'relation_members': ['role'],
+    'relation_tags': ['value']
+}
+
+CREATE = {
+    'node': '''
+        CREATE TABLE IF NOT EXISTS node (
             id INTEGER PRIMARY KEY,
             lat REAL,
             lon REAL,
@@ -21,39 +73,55 @@ def main():
             changeset INTEGER,
             timestamp TEXT
             );
-            ''')
-
-    conn.commit()
-
-    with open('data/node.csv', 'rb') as f:
-        dr = csv.DictReader(f)
-        to_db = [(i['id'], i['lat'], i['lon'], i['user'].decode('utf-8'), i['uid'], i['version'], i['changeset'], i['timestamp']) for i in dr]
-
-    cur.executemany('INSERT INTO node(id, lat, lon, user, uid, version, changeset, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?, ?);', to_db)
-
-    conn.commit()
-
-    cur.execute('''
-        CREATE TABLE node_tags (
+            ''',
+    'node_tags': '''
+        CREATE TABLE IF NOT EXISTS node_tags (
             id INTEGER REFERENCES node (id),
             key TEXT,
             value TEXT,
             type TEXT
             );
-            ''')
-
-    conn.commit()
-
-    with open('data/node_tags.csv', 'rb') as f:
-        dr = csv.DictReader(f)
-        to_db = [(i['id'], i['key'], i['value'].decode('utf-8'), i['type']) for i in dr]
-
-    cur.executemany('INSERT INTO node_tags(id, key, value, type) VALUES (?, ?, ?, ?);', to_db)
-
-    conn.commit()
-
-    cur.execute('''
-        CREATE TABLE way (
+            ''',
+    'way': '''
+        CREATE TABLE IF NOT EXISTS way (
+            id INTEGER PRIMARY KEY,
+            user TEXT,
+            uid INTEGER,
+            version TEXT,
+            changeset INTEGER,
+            timestamp TEXT
+            );
+            ''',
+    'way_nodes': '''
+        CREATE TABLE IF NOT EXISTS way_nodes (
+            id INTEGER REFERENCES way (id),
+            node_id INTEGER,
+            position INTEGER
+            );
+            ''',
+    'way_tags': '''
+        CREATE TABLE IF NOT EXISTS way_tags (
+            id INTEGER REFERENCES way (id),
+            key TEXT,
+            value TEXT,
+            type TEXT
+            );
+            ''',
+    'way_geometry': '''
+        CREATE TABLE IF NOT EXISTS way_geometry (
+            id INTEGER PRIMARY KEY REFERENCES way (id),
+            min_lat REAL,
+            min_lon REAL,
+            max_lat REAL,
+            max_lon REAL,
+            centroid_lat REAL,
+            centroid_lon REAL,
+            length REAL,
+            missing INTEGER
+            );
+            ''',
+    'relation': '''
+        CREATE TABLE IF NOT EXISTS relation (
             id INTEGER PRIMARY KEY,
             user TEXT,
             uid INTEGER,
@@ -61,53 +129,421 @@ def main():
             changeset INTEGER,
             timestamp TEXT
             );
-            ''')
+            ''',
+    'relation_members': '''
+        CREATE TABLE IF NOT EXISTS relation_members (
+            id INTEGER REFERENCES relation (id),
+            member_id INTEGER,
+            member_type TEXT,
+            role TEXT,
+            position INTEGER
+            );
+            ''',
+    'relation_tags': '''
+        CREATE TABLE IF NOT EXISTS relation_tags (
+            id INTEGER REFERENCES relation (id),
+            key TEXT,
+            value TEXT,
+            type TEXT
+            );
+            ''',
+    'tag_stats': '''
+        CREATE TABLE IF NOT EXISTS tag_stats (
+            key TEXT,
+            type TEXT,
+            value TEXT,
+            nodes INTEGER,
+            ways INTEGER,
+            relations INTEGER,
+            PRIMARY KEY (key, type, value)
+            );
+            ''',
+    'user_stats': '''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            uid INTEGER,
+            user TEXT,
+            nodes INTEGER,
+            ways INTEGER,
+            relations INTEGER,
+            PRIMARY KEY (uid, user)
+            );
+            '''
+}
+
+# All the tags in one place, for queries that do not care about the element
+VIEWS = [
+    '''
+    CREATE VIEW IF NOT EXISTS tags AS
+    SELECT 'node' AS element, id, key, value, type FROM node_tags
+    UNION ALL
+    SELECT 'way' AS element, id, key, value, type FROM way_tags
+    UNION ALL
+    SELECT 'relation' AS element, id, key, value, type FROM relation_tags;
+    '''
+]
+
+# Secondary indexes are only built once all the rows are in, so they are
+# created in one sorted pass instead of being updated row by row
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS node_tags_id ON node_tags (id);',
+    'CREATE INDEX IF NOT EXISTS way_nodes_id ON way_nodes (id);',
+    'CREATE INDEX IF NOT EXISTS way_nodes_node_id ON way_nodes (node_id);',
+    'CREATE INDEX IF NOT EXISTS way_tags_id ON way_tags (id);',
+    'CREATE INDEX IF NOT EXISTS relation_members_id '
+    'ON relation_members (id);',
+    'CREATE INDEX IF NOT EXISTS relation_members_member_id '
+    'ON relation_members (member_id);',
+    'CREATE INDEX IF NOT EXISTS relation_tags_id ON relation_tags (id);',
+    'CREATE INDEX IF NOT EXISTS node_tags_key_value '
+    'ON node_tags (key, value);',
+    'CREATE INDEX IF NOT EXISTS way_tags_key_value ON way_tags (key, value);',
+    'CREATE INDEX IF NOT EXISTS relation_tags_key_value '
+    'ON relation_tags (key, value);'
+]
 
-    conn.commit()
 
-    with open('data/way.csv', 'rb') as f:
-        dr = csv.DictReader(f)
-        to_db = [(i['id'], i['user'].decode('utf-8'), i['uid'], i['version'], i['changeset'], i['timestamp']) for i in dr]
+def insert_statement(table, verb='INSERT'):
+    fields = FIELDS[table]
+    return '{} INTO {}({}) VALUES ({});'.format(
+        verb, table, ', '.join(fields), ', '.join(['?'] * len(fields)))
 
-    cur.executemany('INSERT INTO way(id, user, uid, version, changeset, timestamp) VALUES (?, ?, ?, ?, ?, ?);', to_db)
 
+# to_row() turns a record (see records.py) into an insert tuple. Values
+# dropped by fix.py (and keys it leaves out) are stored as empty strings,
+# same as they end up after the csv round trip.
+def to_row(row):
+    return tuple('' if v is None else v for v in row)
+
+
+# Tables, views and indexes are only created if they are not there yet, so
+# that a resumed load can run the same statements again
+def create_tables(conn):
+    cur = conn.cursor()
+    for table in TABLES + STATS_TABLES:
+        cur.execute(CREATE[table])
+    for view in VIEWS:
+        cur.execute(view)
     conn.commit()
 
-    cur.execute('''
-        CREATE TABLE way_nodes (
-            id INTEGER REFERENCES way (id),
-            node_id INTEGER,
-            position INTEGER
-            );
-            ''')
 
+def create_indexes(conn):
+    cur = conn.cursor()
+    for index in INDEXES:
+        cur.execute(index)
     conn.commit()
 
-    with open('data/way_nodes.csv', 'rb') as f:
-        dr = csv.DictReader(f)
-        to_db = [(i['id'], i['node_id'], i['position']) for i in dr]
 
-    cur.executemany('INSERT INTO way_nodes(id, node_id, position) VALUES (?, ?, ?);', to_db)
+# build_indexes() runs once all the data is in: secondary indexes first, then
+# the R*Tree spatial index over nodes and way bounding boxes and the
+# full-text index of the addresses (see address.py)
+def build_indexes(conn):
+    start = time.time()
+    create_indexes(conn)
+    print "indexes: built in %.1fs" % (time.time() - start)
 
-    conn.commit()
+    start = time.time()
+    spatial.build_rtree(conn)
+    print "rtree: built in %.1fs" % (time.time() - start)
 
-    cur.execute('''
-        CREATE TABLE way_tags (
-            id INTEGER REFERENCES way (id),
-            key TEXT,
-            value TEXT,
-            type TEXT
-            );
-            ''')
+    start = time.time()
+    address.build_index(conn)
+    print "address index: built in %.1fs" % (time.time() - start)
 
-    conn.commit()
 
-    with open('data/way_tags.csv', 'rb') as f:
-        dr = csv.DictReader(f)
-        to_db = [(i['id'], i['key'], i['value'].decode('utf-8'), i['type']) for i in dr]
+def connect(checkpoints=False):
+    conn = sqlite3.connect(SQLITE_FILE)
+    conn.text_factory = str
+    for pragma in BULK_PRAGMAS + (CHECKPOINT_PRAGMAS if checkpoints else []):
+        conn.execute(pragma)
+    return conn
 
-    cur.executemany('INSERT INTO way_tags(id, key, value, type) VALUES (?, ?, ?, ?);', to_db)
 
-    conn.commit()
+# open_database() connects to the database of a load and returns it with
+# the checkpoint.Checkpoint of the load. A load starts over from an empty
+# database, unless resume=True and the database has a checkpoint, whose
+# load is continued; checkpoint.complete is True when the load was done.
+def open_database(file_in, checkpoints=False, resume=False):
+    if resume and os.path.exists(SQLITE_FILE):
+        conn = connect()
+        saved = checkpoint.Checkpoint(file_in, checkpoints, resume, conn)
+        if saved.resumed:
+            for pragma in CHECKPOINT_PRAGMAS:
+                conn.execute(pragma)
+        if saved.resumed or saved.complete:
+            return conn, saved
+        conn.close()
+        print "no checkpoint in %s, starting over" % SQLITE_FILE
+
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(SQLITE_FILE + suffix):
+            os.remove(SQLITE_FILE + suffix)
+    conn = connect(checkpoints or resume)
+    saved = checkpoint.Checkpoint(file_in, checkpoints, resume, conn)
+    create_tables(conn)
+    return conn, saved
+
 
+# close_database() ends a load once everything is in, leaving a database
+# without checkpoint nor write ahead log
+def close_database(conn, saved):
+    saved.finish()
+    if saved.enabled:
+        conn.execute('PRAGMA journal_mode = DELETE;')
     conn.close()
+
+
+# write_batch() and insert_batch() write a batch of rows of _load_map() to
+# the csv file and the database table, metrics.py times them per table
+def write_batch(writer, table, batch):
+    writer.writerows(batch)
+
+
+def insert_batch(cur, table, statement, batch):
+    cur.executemany(statement, batch)
+
+
+# print_rate() prints the rows of a table loaded in elapsed seconds. what
+# says what was timed, when it is not the whole load of the table.
+def print_rate(table, rows, elapsed, what=None):
+    rate = rows / elapsed if elapsed > 0 else 0
+    print "%s: %d rows in %.1fs%s (%d rows/s)" % (
+        table, rows, elapsed, ' of ' + what if what else '', rate)
+
+
+# main() loads the csv files written by to_csv.process_map(). With
+# checkpoints=True the table being loaded and its rows already in are saved
+# with every batch, and resume=True continues from there.
+def main(checkpoints=False, resume=False):
+    conn, saved = open_database(None, checkpoints, resume)
+    if saved.complete:
+        print "%s is already loaded" % SQLITE_FILE
+        conn.close()
+        return
+
+    tables = TABLES
+    if saved.resumed:
+        tables = tables[tables.index(saved.get('table')):]
+
+    for table in tables:
+        start = time.time()
+        skip = saved.get('rows', 0) if table == saved.get('table') else 0
+        commit = True
+        if saved.enabled:
+            commit = lambda rows: saved.save(table=table, rows=skip + rows)
+
+        with open(CSV_PATHS[table], 'rb') as f:
+            dr = itertools.islice(csv.DictReader(f), skip, None)
+            rows = load_csv(conn, table, dr, commit)
+
+        print_rate(table, rows, time.time() - start)
+
+    build_stats(conn)
+    build_indexes(conn)
+
+    close_database(conn, saved)
+
+
+# load_csv() streams the rows of a csv.DictReader into the table, see
+# insert_rows(). Returns the number of rows inserted.
+def load_csv(conn, table, dr, commit=True):
+    fields = FIELDS[table]
+    utf8_fields = UTF8_FIELDS[table]
+
+    rows = (tuple(i[k].decode('utf-8') if k in utf8_fields else i[k]
+                  for k in fields) for i in dr)
+    return insert_rows(conn, table, rows, commit)
+
+
+# insert_rows() inserts an iterable of row tuples in chunks of BATCH_SIZE,
+# one transaction per chunk, so memory stays constant no matter how many
+# rows there are. Returns the number of rows inserted.
+# commit=False leaves the transaction open, for the loads that commit with
+# their checkpoints; a function is called instead of conn.commit() with the
+# number of rows inserted so far, to commit them with a checkpoint.
+def insert_rows(conn, table, rows, commit=True):
+    cur = conn.cursor()
+    statement = insert_statement(table)
+
+    count = 0
+    while True:
+        chunk = list(itertools.islice(rows, BATCH_SIZE))
+        if not chunk:
+            break
+        cur.executemany(statement, chunk)
+        count += len(chunk)
+        if callable(commit):
+            commit(count)
+        elif commit:
+            conn.commit()
+    return count
+
+
+# load_map() is the direct loader: it parses the .osm file and inserts the
+# shaped elements into the database in a single streaming pass, without
+# going through the intermediate csv files. The csv files can still be
+# written as a side output with csv_out=True.
+# With workers > 1 the file is parsed in parallel byte ranges and the
+# partial csv files of each range are loaded in file order (for .bz2 and
+# .osm.pbf files the workers decompress or decode blocks instead, and
+# stdin is split in batches as it is read, see parallel.map_stream()).
+# With quarantine=True the elements that fail validation are written to
+# to_csv.QUARANTINE_PATH instead of aborting the run.
+# parser picks the XML backend, see to_csv.iter_shaped().
+# With checkpoints=True the rows are committed together with a checkpoint
+# every few hundred MB of input, and resume=True continues an interrupted
+# load from the last one, see checkpoint.py.
+def load_map(file_in, validate, csv_out=False, workers=1, quarantine=False,
+             parser='etree', checkpoints=False, resume=False):
+    conn, saved = open_database(file_in, checkpoints, resume)
+    if saved.complete:
+        print "%s is already loaded" % SQLITE_FILE
+        conn.close()
+        return
+
+    fix.STREETS.clear_stats()
+    load = _load_chunks if workers > 1 and parallel.is_parallel(file_in) \
+        else _load_map
+    with validation.open_quarantine(to_csv.QUARANTINE_PATH, quarantine,
+                                    count=saved.quarantined()) as rejected:
+        if csv_out:
+            with to_csv.open_writers(append=saved.resumed) as writers:
+                load(conn, saved, file_in, validate, writers, workers,
+                     rejected, parser)
+        else:
+            load(conn, saved, file_in, validate, None, workers, rejected,
+                 parser)
+
+
+def _load_chunks(conn, saved, file_in, validate, writers, workers, rejected,
+                 parser):
+    counts = saved.get('counts') or dict((table, 0) for table in TABLES)
+    inserted = dict((table, 0) for table in TABLES)
+    seconds = dict((table, 0.0) for table in TABLES)
+    position = saved.get('position') or {'offset': 0}
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(SQLITE_FILE))
+    index = saved.node_index()
+    saved.track(writers, rejected, index, counts)
+    # With checkpoints, a chunk is committed as a whole with its checkpoint
+    commit = not saved.enabled
+
+    try:
+        for end, paths, rejected_path in parallel.map_input(
+                file_in, validate, workers, tmp_dir, rejected is not None,
+                parser, position['offset']):
+            if rejected is not None:
+                rejected.append_file(rejected_path)
+
+            for table in TABLES:
+                start = time.time()
+                with open(paths[table], 'rb') as f:
+                    dr = csv.DictReader(f, fieldnames=FIELDS[table])
+                    rows = load_csv(conn, table, dr, commit)
+                seconds[table] += time.time() - start
+                inserted[table] += rows
+                counts[table] += rows
+
+                if writers is not None:
+                    parallel.append_file(writers[table], paths[table])
+
+            # The workers cannot resolve way geometries, since the nodes of
+            # a way can be in any earlier chunk
+            rows = list(geometry.chunk_geometry(index, paths))
+            if writers is not None:
+                writers['way_geometry'].writerows(rows)
+            start = time.time()
+            insert_rows(conn, 'way_geometry', (to_row(row) for row in rows),
+                        commit)
+            seconds['way_geometry'] += time.time() - start
+            inserted['way_geometry'] += len(rows)
+            counts['way_geometry'] += len(rows)
+            saved.save({'offset': end, 'last': None})
+    finally:
+        index.close()
+        shutil.rmtree(tmp_dir)
+
+    # The rows of this run (not those before a resumed checkpoint), and the
+    # time spent reading them from the chunk files and inserting them
+    for table in TABLES:
+        print_rate(table, inserted[table], seconds[table], 'chunk loads')
+    fix.STREETS.print_stats()
+
+    build_stats(conn)
+    build_indexes(conn)
+
+    close_database(conn, saved)
+
+
+# build_stats() computes the summary tables once the elements are in
+def build_stats(conn):
+    start = time.time()
+    for table, rows in sorted(stats.build_tables(conn).iteritems()):
+        print "%s: %d rows" % (table, rows)
+    print "stats: built in %.1fs" % (time.time() - start)
+
+
+def _load_map(conn, saved, file_in, validate, writers, workers, rejected,
+              parser):
+    cur = conn.cursor()
+    statements = dict((table, insert_statement(table)) for table in TABLES)
+    batches = dict((table, []) for table in TABLES)
+    counts = saved.get('counts') or dict((table, 0) for table in TABLES)
+    inserted = dict((table, 0) for table in TABLES)
+    seconds = dict((table, 0.0) for table in TABLES)
+    index = saved.node_index()
+
+    def insert(table):
+        batch = batches[table]
+        if writers is not None:
+            write_batch(writers[table], table, batch)
+        start = time.time()
+        insert_batch(cur, table, statements[table], batch)
+        seconds[table] += time.time() - start
+        inserted[table] += len(batch)
+        counts[table] += len(batch)
+        del batch[:]
+
+    # Every row read before a checkpoint is inserted and committed with it
+    def flush():
+        for table in TABLES:
+            if batches[table]:
+                insert(table)
+
+    saved.track(writers, rejected, index, counts, flush)
+
+    for el in saved.shaped(workers, parser):
+        if validate is True and not to_csv.check_element(el, rejected):
+            continue
+
+        geometry.add_geometry(el, index)
+
+        # Rows are taken one at a time, the members of a relation are a
+        # generator that can be much longer than a batch and can only be
+        # read once, so the csv rows are written from the batches too
+        for table in TABLES:
+            if table not in el:
+                continue
+            rows = [el[table]] if table in to_csv.ELEMENTS else el[table]
+            batch = batches[table]
+            for row in rows:
+                batch.append(to_row(row))
+
+                if len(batch) >= BATCH_SIZE:
+                    insert(table)
+                    # With checkpoints, rows are only committed with them
+                    if not saved.enabled:
+                        conn.commit()
+
+    flush()
+    conn.commit()
+    index.close()
+
+    # Tables are filled side by side while the file is parsed, each one is
+    # timed on its own inserts, of this run only when resuming
+    for table in TABLES:
+        print_rate(table, inserted[table], seconds[table], 'inserts')
+    fix.STREETS.print_stats()
+
+    build_stats(conn)
+    build_indexes(conn)
+
+    close_database(conn, saved)
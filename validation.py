@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import collections
+import contextlib
+import json
+
+# Number of rejected elements buffered before they are written to the
+# quarantine file
+QUARANTINE_BATCH = 1000
+
+# Python types accepted by each schema type, same as cerberus
+TYPES = {
+    'integer': (int, long),
+    'float': (float,),
+    'string': (basestring,),
+    'dict': (collections.Mapping,),
+    'list': (collections.Sequence,)
+}
+
+# Error messages, same as cerberus. When a field has more than one error
+# cerberus lists them in this order.
+NULL = 'null value not allowed'
+TYPE = 'must be of {} type'
+COERCE = "field '{}' cannot be coerced: {}"
+REQUIRED = 'required field'
+UNKNOWN = 'unknown field'
+
+
+# compile_schema() turns a cerberus style schema (see schema.py) into a
+# function that takes a document and returns its errors, in the same
+# structure and with the same messages as cerberus.Validator.errors. An
+# empty dict means the document is valid. The rules of every field are
+# resolved once here, instead of on every call like cerberus does.
+def compile_schema(schema):
+    checks = dict((field, compile_field(field, rules))
+                  for field, rules in schema.iteritems())
+    required = [field for field, rules in schema.iteritems()
+                if rules.get('required')]
+
+    def validate(document):
+        errors = {}
+        for field, value in document.iteritems():
+            check = checks.get(field)
+            if check is None:
+                errors[field] = [UNKNOWN]
+                continue
+            e = check(value)
+            if e:
+                errors[field] = e
+        for field in required:
+            if field not in document:
+                errors[field] = [REQUIRED]
+        return errors
+
+    return validate
+
+
+# compile_field() returns the check function of a single field. A check
+# takes the value and returns its list of errors, or None if it is valid.
+def compile_field(field, rules):
+    types = TYPES[rules['type']]
+    type_error = TYPE.format(rules['type'])
+
+    if rules['type'] == 'dict' and 'schema' in rules:
+        validate = compile_schema(rules['schema'])
+
+        def check_dict(value):
+            if value is None:
+                return [NULL]
+            if not isinstance(value, types):
+                return [type_error]
+            errors = validate(value)
+            if errors:
+                return [errors]
+
+        return check_dict
+
+    if rules['type'] == 'list' and 'schema' in rules:
+        check_item = compile_field(field, rules['schema'])
+
+        def check_list(value):
+            if value is None:
+                return [NULL]
+            if not isinstance(value, types) or isinstance(value, basestring):
+                return [type_error]
+            errors = {}
+            for i, item in enumerate(value):
+                e = check_item(item)
+                if e:
+                    errors[i] = e
+            if errors:
+                return [errors]
+
+        return check_list
+
+    coerce = rules.get('coerce')
+
+    if coerce is None:
+        def check_value(value):
+            if value is None:
+                return [NULL]
+            if not isinstance(value, types):
+                return [type_error]
+
+        return check_value
+
+    def check_coerced(value):
+        errors = []
+        try:
+            value = coerce(value)
+            coerce_error = None
+        except Exception as e:
+            coerce_error = COERCE.format(field, e)
+
+        if value is None:
+            errors.append(NULL)
+        elif not isinstance(value, types):
+            errors.append(type_error)
+        if coerce_error:
+            errors.append(coerce_error)
+        return errors or None
+
+    return check_coerced
+
+
+class Quarantine(object):
+    """Side file for the elements rejected by the validator.
+
+    Each rejected element is written as a line of JSON with its errors,
+    in batches of batch_size lines. count is the number of lines already in
+    the file when a run is resumed (see checkpoint.py), they are kept and
+    the new ones appended; by default the file is started over.
+    """
+
+    def __init__(self, path, batch_size=QUARANTINE_BATCH, count=None):
+        self.path = path
+        self.f = open(path, 'wb' if count is None else 'ab')
+        self.batch_size = batch_size
+        self.batch = []
+        self.count = count or 0
+
+    def add(self, element, errors):
+        self.batch.append(json.dumps({'errors': errors, 'element': element}))
+        self.count += 1
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.batch:
+            self.f.write('\n'.join(self.batch) + '\n')
+            del self.batch[:]
+
+    def append_file(self, path):
+        """Copy the lines of another quarantine file, used to merge the
+        quarantine files of the parallel workers"""
+        self.flush()
+        with open(path, 'rb') as f:
+            for line in f:
+                self.f.write(line)
+                self.count += 1
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# open_quarantine() yields a Quarantine writing to path, or None when
+# enabled is False so that invalid elements abort the run as before.
+# report=False skips the final count (used by the parallel workers), count
+# appends to the file of a resumed run, see Quarantine.
+@contextlib.contextmanager
+def open_quarantine(path, enabled=True, report=True, count=None):
+    if not enabled:
+        yield None
+        return
+
+    with Quarantine(path, count=count) as quarantine:
+        yield quarantine
+
+    if report and quarantine.count:
+        print "quarantined %d invalid elements in %s" % (quarantine.count,
+                                                          path)